@@ -6,7 +6,7 @@ import ida_kernwin
 
 from d810.conf import D810Configuration
 from d810.manager import D810State, D810_LOG_DIR_NAME
-from d810.log import configure_loggers, clear_logs
+from d810.log import configure_loggers, clear_logs, stop_background_logging
 
 
 D810_VERSION = "0.1"
@@ -69,6 +69,7 @@ class D810Plugin(idaapi.plugin_t):
         print("Terminating D-810...")
         if self.state is not None:
             self.state.stop_plugin()
+        stop_background_logging()
 
         self.initialized = False
 
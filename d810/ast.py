@@ -1,4 +1,5 @@
 from __future__ import annotations
+import time
 import logging
 from typing import List, Union, Dict, Tuple
 
@@ -7,46 +8,65 @@ from ida_hexrays import *
 from d810.utils import unsigned_to_signed, signed_to_unsigned, \
     get_add_cf, get_add_of, get_sub_of, get_parity_flag
 from d810.hexrays_helpers import OPCODES_INFO, MBA_RELATED_OPCODES, Z3_SPECIAL_OPERANDS, MINSN_TO_AST_FORBIDDEN_OPCODES, \
-    equal_mops_ignore_size, AND_TABLE
+    equal_mops_ignore_size, get_mop_key, AND_TABLE
 from d810.hexrays_formatters import format_minsn_t, format_mop_t
 from d810.errors import AstEvaluationException
+from d810.profiler import get_profiler, PROFILE_AST_BUILD
 
 logger = logging.getLogger('D810')
 
 
-def check_and_add_to_list(new_ast: Union[AstNode, AstLeaf], known_ast_list: List[Union[AstNode, AstLeaf]]):
-    is_new_ast_known = False
-    for existing_elt in known_ast_list:
-        if equal_mops_ignore_size(new_ast.mop, existing_elt.mop):
-            new_ast.ast_index = existing_elt.ast_index
-            is_new_ast_known = True
-            break
-
-    if not is_new_ast_known:
+def check_and_add_to_list(new_ast: Union[AstNode, AstLeaf], known_ast_list: List[Union[AstNode, AstLeaf]],
+                          known_ast_index_by_key: Dict = None):
+    if known_ast_index_by_key is None:
+        known_ast_index_by_key = {get_mop_key(existing_elt.mop): existing_elt.ast_index
+                                  for existing_elt in reversed(known_ast_list)}
+    new_ast_key = new_ast.mop_key if new_ast.mop_key is not None else get_mop_key(new_ast.mop)
+    ast_index = known_ast_index_by_key.get(new_ast_key)
+    if ast_index is None:
         ast_index = len(known_ast_list)
-        new_ast.ast_index = ast_index
+        known_ast_index_by_key[new_ast_key] = ast_index
         known_ast_list.append(new_ast)
+    new_ast.ast_index = ast_index
 
 
-def mop_to_ast_internal(mop: mop_t, ast_list: List[Union[AstNode, AstLeaf]]) -> Union[None, AstNode, AstLeaf]:
+def mop_to_ast_internal(mop: mop_t, ast_list: List[Union[AstNode, AstLeaf]], ast_index_by_key: Dict = None,
+                        ast_by_sized_key: Dict = None) -> Union[None, AstNode, AstLeaf]:
     if mop is None:
         return None
+    if ast_index_by_key is None:
+        ast_index_by_key = {}
+    if ast_by_sized_key is None:
+        ast_by_sized_key = {}
 
     if mop.t != mop_d or (mop.d.opcode not in MBA_RELATED_OPCODES):
-        tree = AstLeaf(format_mop_t(mop))
+        sized_key = get_mop_key(mop, with_size=True)
+        tree = ast_by_sized_key.get(sized_key)
+        if tree is not None:
+            return tree
+        tree = AstLeaf(None)
         tree.mop = mop
+        tree.mop_key = get_mop_key(mop)
         dest_size = mop.size if mop.t != mop_d else mop.d.d.size
         tree.dest_size = dest_size
     else:
-        left_ast = mop_to_ast_internal(mop.d.l, ast_list)
-        right_ast = mop_to_ast_internal(mop.d.r, ast_list)
-        dst_ast = mop_to_ast_internal(mop.d.d, ast_list)
+        left_ast = mop_to_ast_internal(mop.d.l, ast_list, ast_index_by_key, ast_by_sized_key)
+        right_ast = mop_to_ast_internal(mop.d.r, ast_list, ast_index_by_key, ast_by_sized_key)
+        dst_ast = mop_to_ast_internal(mop.d.d, ast_list, ast_index_by_key, ast_by_sized_key)
+        # Identical sub-expressions (same structure and same sizes) are shared instead of being built twice
+        sized_key = (mop_d, mop.d.opcode, left_ast.sized_key, right_ast.sized_key, dst_ast.sized_key, mop.size)
+        tree = ast_by_sized_key.get(sized_key)
+        if tree is not None:
+            return tree
         tree = AstNode(mop.d.opcode, left_ast, right_ast, dst_ast)
         tree.mop = mop
+        tree.mop_key = (mop_d, mop.d.opcode, left_ast.mop_key, right_ast.mop_key, dst_ast.mop_key)
         tree.dest_size = mop.d.d.size
         tree.ea = mop.d.ea
 
-    check_and_add_to_list(tree, ast_list)
+    tree.sized_key = sized_key
+    ast_by_sized_key[sized_key] = tree
+    check_and_add_to_list(tree, ast_list, ast_index_by_key)
     return tree
 
 
@@ -57,6 +77,16 @@ def mop_to_ast(mop: mop_t) -> Union[None, AstNode, AstLeaf]:
 
 
 def minsn_to_ast(instruction: minsn_t) -> Union[None, AstNode, AstLeaf]:
+    profiler = get_profiler()
+    if not profiler.is_enabled:
+        return _minsn_to_ast(instruction)
+    start_time = time.perf_counter()
+    tmp = _minsn_to_ast(instruction)
+    profiler.add_counter(PROFILE_AST_BUILD, time.perf_counter() - start_time)
+    return tmp
+
+
+def _minsn_to_ast(instruction: minsn_t) -> Union[None, AstNode, AstLeaf]:
     try:
         if instruction.opcode in MINSN_TO_AST_FORBIDDEN_OPCODES:
             # To avoid error 50278
@@ -82,6 +112,8 @@ def minsn_to_ast(instruction: minsn_t) -> Union[None, AstNode, AstLeaf]:
 
 
 class AstInfo(object):
+    __slots__ = ["ast", "number_of_use"]
+
     def __init__(self, ast: Union[AstNode, AstLeaf], number_of_use: int):
         self.ast = ast
         self.number_of_use = number_of_use
@@ -90,9 +122,11 @@ class AstInfo(object):
         return "{0} used {1} times: {2}".format(self.ast, self.number_of_use, format_mop_t(self.ast.mop))
 
 
-class AstNode(dict):
+class AstNode(object):
+    __slots__ = ["opcode", "left", "right", "dst", "dst_mop", "opcodes", "mop", "mop_key", "sized_key",
+                 "is_candidate_ok", "leafs", "leafs_by_name", "ast_index", "sub_ast_info_by_index", "dest_size", "ea"]
+
     def __init__(self, opcode, left=None, right=None, dst=None):
-        super(dict, self).__init__()
         self.opcode = opcode
         self.left = left
         self.right = right
@@ -101,6 +135,8 @@ class AstNode(dict):
 
         self.opcodes = []
         self.mop = None
+        self.mop_key = None
+        self.sized_key = None
         self.is_candidate_ok = False
 
         self.leafs = []
@@ -116,20 +152,20 @@ class AstNode(dict):
     def size(self):
         return self.mop.d.d.size
 
-    def compute_sub_ast(self):
+    def compute_sub_ast(self, computed_ast_ids=None):
+        # Sub-trees may be shared (see mop_to_ast_internal), so each of them is only computed once
+        if computed_ast_ids is None:
+            computed_ast_ids = set()
+        computed_ast_ids.add(id(self))
         self.sub_ast_info_by_index = {}
         self.sub_ast_info_by_index[self.ast_index] = AstInfo(self, 1)
 
-        if self.left is not None:
-            self.left.compute_sub_ast()
-            for ast_index, ast_info in self.left.sub_ast_info_by_index.items():
-                if ast_index not in self.sub_ast_info_by_index.keys():
-                    self.sub_ast_info_by_index[ast_index] = AstInfo(ast_info.ast, 0)
-                self.sub_ast_info_by_index[ast_index].number_of_use += ast_info.number_of_use
-
-        if self.right is not None:
-            self.right.compute_sub_ast()
-            for ast_index, ast_info in self.right.sub_ast_info_by_index.items():
+        for child in [self.left, self.right]:
+            if child is None:
+                continue
+            if id(child) not in computed_ast_ids:
+                child.compute_sub_ast(computed_ast_ids)
+            for ast_index, ast_info in child.sub_ast_info_by_index.items():
                 if ast_index not in self.sub_ast_info_by_index.keys():
                     self.sub_ast_info_by_index[ast_index] = AstInfo(ast_info.ast, 0)
                 self.sub_ast_info_by_index[ast_index].number_of_use += ast_info.number_of_use
@@ -223,6 +259,30 @@ class AstNode(dict):
             self.leafs_by_name[leaf.name] = leaf
         return self.is_candidate_ok
 
+    def copy_mops_from_match(self, ast: Union[AstNode, AstLeaf], leafs: List[AstLeaf],
+                             matched_asts: List[Union[AstNode, AstLeaf]]) -> bool:
+        # Same as check_pattern_and_copy_mops, but when the shape of ast is already known to match the pattern.
+        # leafs are the leafs of the pattern (in get_leaf_list order) and matched_asts the sub-ASTs bound to them
+        self.mop = ast.mop
+        self.dst_mop = ast.dst_mop
+        self.dest_size = ast.dest_size
+        self.ea = ast.ea
+        self.leafs = list(leafs)
+        self.leafs_by_name = {}
+        self.is_candidate_ok = True
+
+        mop_key_by_name = {}
+        for leaf, matched_ast in zip(leafs, matched_asts):
+            leaf.mop = matched_ast.mop
+            matched_ast_key = matched_ast.mop_key if matched_ast.mop_key is not None else get_mop_key(matched_ast.mop)
+            if leaf.name in mop_key_by_name.keys():
+                if mop_key_by_name[leaf.name] != matched_ast_key:
+                    self.is_candidate_ok = False
+            else:
+                mop_key_by_name[leaf.name] = matched_ast_key
+            self.leafs_by_name[leaf.name] = leaf
+        return self.is_candidate_ok
+
     def update_leafs_mop(self, other: Union[AstNode, AstLeaf], other2: Union[None, AstNode, AstLeaf] = None) -> bool:
         self.leafs = self.get_leaf_list()
         all_leafs_found = True
@@ -425,11 +485,16 @@ class AstNode(dict):
 
 
 class AstLeaf(object):
+    __slots__ = ["_name", "ast_index", "mop", "mop_key", "sized_key", "z3_var", "z3_var_name", "dest_size", "ea",
+                 "sub_ast_info_by_index"]
+
     def __init__(self, name):
-        self.name = name
+        self._name = name
         self.ast_index = None
 
         self.mop = None
+        self.mop_key = None
+        self.sized_key = None
         self.z3_var = None
         self.z3_var_name = None
 
@@ -443,6 +508,17 @@ class AstLeaf(object):
             return self
         raise KeyError
 
+    @property
+    def name(self):
+        # Leafs created from an instruction are only named (which is costly) if the name is needed
+        if self._name is None and self.mop is not None:
+            self._name = format_mop_t(self.mop)
+        return self._name
+
+    @name.setter
+    def name(self, name):
+        self._name = name
+
     @property
     def size(self):
         return self.mop.size
@@ -462,7 +538,7 @@ class AstLeaf(object):
         else:
             return None
 
-    def compute_sub_ast(self):
+    def compute_sub_ast(self, computed_ast_ids=None):
         self.sub_ast_info_by_index = {}
         self.sub_ast_info_by_index[self.ast_index] = AstInfo(self, 1)
 
@@ -511,6 +587,10 @@ class AstLeaf(object):
         self.mop = other.mop
         return True
 
+    def copy_mops_from_match(self, ast, leafs, matched_asts):
+        self.mop = ast.mop
+        return True
+
     @staticmethod
     def _check_implicit_equalities():
         # An AstLeaf does not have any implicit equalities to be checked, so we always returns True
@@ -560,6 +640,8 @@ class AstLeaf(object):
 
 
 class AstConstant(AstLeaf):
+    __slots__ = ["expected_value", "expected_size"]
+
     def __init__(self, name, expected_value=None, expected_size=None):
         super().__init__(name)
         self.expected_value = expected_value
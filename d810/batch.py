@@ -0,0 +1,253 @@
+"""
+Headless batch deobfuscation with D-810.
+
+Run D-810 on every function of a database with several headless IDA processes:
+    python d810/batch.py launch --idat /path/to/idat --jobs 4 --project default_unflattening_ollvm.json \
+        --output out_dir binary.i64
+
+Each IDA process runs this script on one shard of the function list (this is done by the launch command):
+    idat -A -S"d810/batch.py run --shard 0 --nb-shards 4 --project default_unflattening_ollvm.json --output out_dir" \
+        binary.i64
+
+Shard results are merged in the output directory (results.json, pseudocode.c and rule_statistics.json).
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import subprocess
+from typing import List, Dict
+
+D810_PLUGIN_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if D810_PLUGIN_DIR not in sys.path:
+    sys.path.append(D810_PLUGIN_DIR)
+
+logger = logging.getLogger('D810')
+
+SHARD_RESULT_FILENAME = "shard_{0}.json"
+SHARD_DATABASE_DIRNAME = "shard_{0}"
+SHARD_LOG_DIRNAME = "shard_{0}_logs"
+SHARD_IDA_LOG_FILENAME = "shard_{0}_ida.log"
+MERGED_RESULT_FILENAME = "results.json"
+MERGED_PSEUDOCODE_FILENAME = "pseudocode.c"
+MERGED_STATISTICS_FILENAME = "rule_statistics.json"
+
+
+def get_project_index(state, project_name: str) -> int:
+    if project_name is None:
+        return state.current_project_index
+    for project_index, project in enumerate(state.projects):
+        if os.path.basename(project.path) == os.path.basename(project_name):
+            return project_index
+    raise ValueError("Unknown D-810 project configuration: {0}".format(project_name))
+
+
+def add_statistics(total_statistics: Dict[str, int], statistics: Dict[str, int]):
+    for name, nb_use in statistics.items():
+        total_statistics[name] = total_statistics.get(name, 0) + nb_use
+
+
+def get_function_rule_statistics(manager) -> Dict[str, Dict[str, int]]:
+    instruction_optimizer = manager.instruction_optimizer
+    block_optimizer = manager.block_optimizer
+    ins_rule_statistics = {}
+    for ins_optimizer in instruction_optimizer.instruction_optimizers:
+        add_statistics(ins_rule_statistics, ins_optimizer.rules_usage_info)
+    return {
+        "optimizers": {name: nb_use for name, nb_use in instruction_optimizer.optimizer_usage_info.items()
+                       if nb_use > 0},
+        "ins_rules": {name: nb_use for name, nb_use in ins_rule_statistics.items() if nb_use > 0},
+        "blk_rules": {name: sum(nb_patch_list) for name, nb_patch_list in block_optimizer.cfg_rules_usage_info.items()
+                      if len(nb_patch_list) > 0},
+    }
+
+
+def run_shard(shard_index: int, nb_shards: int, project_name: str, output_dir: str):
+    # Executed inside a headless IDA process
+    import idautils
+    import ida_auto
+    import ida_funcs
+    import ida_hexrays
+    from d810.conf import D810Configuration
+    from d810.manager import D810State, D810_LOG_DIR_NAME
+    from d810.log import configure_loggers, clear_logs, stop_background_logging
+    from d810.microcode_dump import get_microcode_dump_writer
+
+    ida_auto.auto_wait()
+    if not ida_hexrays.init_hexrays_plugin():
+        raise RuntimeError("Hex-Rays decompiler is not available")
+
+    os.makedirs(output_dir, exist_ok=True)
+    d810_config = D810Configuration()
+    # Each shard logs in its own directory, the configuration file itself is never saved
+    d810_config.set("log_dir", os.path.join(output_dir, SHARD_LOG_DIRNAME.format(shard_index)))
+    real_log_dir = os.path.join(d810_config.get("log_dir"), D810_LOG_DIR_NAME)
+    clear_logs(real_log_dir)
+    configure_loggers(real_log_dir)
+
+    state = D810State(d810_config)
+    state.load_project(get_project_index(state, project_name))
+    state.start_d810(save_config=False)
+
+    shard_results = {
+        "shard_index": shard_index,
+        "nb_shards": nb_shards,
+        "project": os.path.basename(state.current_project.path),
+        "functions": {},
+        "rule_statistics": {"optimizers": {}, "ins_rules": {}, "blk_rules": {}},
+    }
+    try:
+        for func_index, func_ea in enumerate(idautils.Functions()):
+            if func_index % nb_shards != shard_index:
+                continue
+            func_result = {"name": ida_funcs.get_func_name(func_ea), "status": "ok", "error": None,
+                           "pseudocode": None}
+            start_time = time.time()
+            try:
+                cfunc = ida_hexrays.decompile(func_ea, None, ida_hexrays.DECOMP_NO_CACHE)
+                if cfunc is None:
+                    func_result["status"] = "failed"
+                else:
+                    func_result["pseudocode"] = str(cfunc)
+            except ida_hexrays.DecompilationFailure as e:
+                func_result["status"] = "failed"
+                func_result["error"] = str(e)
+            func_result["duration"] = time.time() - start_time
+            func_result["rule_statistics"] = get_function_rule_statistics(state.manager)
+            for statistic_type, statistics in func_result["rule_statistics"].items():
+                add_statistics(shard_results["rule_statistics"][statistic_type], statistics)
+            shard_results["functions"]["0x{0:x}".format(func_ea)] = func_result
+            logger.info("Batch shard {0}: function 0x{1:x} {2} in {3:.2f}s"
+                        .format(shard_index, func_ea, func_result["status"], func_result["duration"]))
+    finally:
+        state.stop_d810()
+        get_microcode_dump_writer().stop()
+        with open(os.path.join(output_dir, SHARD_RESULT_FILENAME.format(shard_index)), "w") as fp:
+            json.dump(shard_results, fp, indent=2)
+        stop_background_logging()
+
+
+def merge_shard_results(output_dir: str, nb_shards: int):
+    os.makedirs(output_dir, exist_ok=True)
+    merged_results = {"functions": {}, "missing_shards": [],
+                      "rule_statistics": {"optimizers": {}, "ins_rules": {}, "blk_rules": {}}}
+    for shard_index in range(nb_shards):
+        shard_result_path = os.path.join(output_dir, SHARD_RESULT_FILENAME.format(shard_index))
+        try:
+            with open(shard_result_path, "r") as fp:
+                shard_results = json.load(fp)
+        except (OSError, ValueError) as e:
+            print("Can't load results of shard {0}: {1}".format(shard_index, e))
+            merged_results["missing_shards"].append(shard_index)
+            continue
+        merged_results["project"] = shard_results["project"]
+        merged_results["functions"].update(shard_results["functions"])
+        for statistic_type, statistics in shard_results["rule_statistics"].items():
+            add_statistics(merged_results["rule_statistics"][statistic_type], statistics)
+
+    sorted_func_eas = sorted(merged_results["functions"].keys(), key=lambda x: int(x, 16))
+    merged_results["functions"] = {func_ea: merged_results["functions"][func_ea] for func_ea in sorted_func_eas}
+    with open(os.path.join(output_dir, MERGED_RESULT_FILENAME), "w") as fp:
+        json.dump(merged_results, fp, indent=2)
+    with open(os.path.join(output_dir, MERGED_STATISTICS_FILENAME), "w") as fp:
+        json.dump(merged_results["rule_statistics"], fp, indent=2)
+    with open(os.path.join(output_dir, MERGED_PSEUDOCODE_FILENAME), "w") as fp:
+        for func_ea, func_result in merged_results["functions"].items():
+            fp.write("// {0} at {1}: {2}\n".format(func_result["name"], func_ea, func_result["status"]))
+            if func_result["pseudocode"] is not None:
+                fp.write(func_result["pseudocode"])
+            fp.write("\n\n")
+    nb_failed = len([x for x in merged_results["functions"].values() if x["status"] != "ok"])
+    print("{0} functions processed ({1} failed), results written in {2}"
+          .format(len(merged_results["functions"]), nb_failed, output_dir))
+    return merged_results
+
+
+def quote_ida_script_argument(argument: str) -> str:
+    # IDA splits the -S value on spaces, except inside double quotes
+    return "\"{0}\"".format(argument) if " " in argument else argument
+
+
+def launch_shards(idat_path: str, database_path: str, nb_jobs: int, project_name: str, output_dir: str):
+    # Executed outside IDA: one headless IDA process per shard, each one working on its own copy of the database
+    output_dir = os.path.abspath(output_dir)
+    os.makedirs(output_dir, exist_ok=True)
+    script_path = os.path.abspath(__file__)
+    database_extension = os.path.splitext(database_path)[1].lower()
+    processes = []
+    for shard_index in range(nb_jobs):
+        shard_dir = os.path.join(output_dir, SHARD_DATABASE_DIRNAME.format(shard_index))
+        os.makedirs(shard_dir, exist_ok=True)
+        script_args = ["run", "--shard", str(shard_index), "--nb-shards", str(nb_jobs), "--output", output_dir]
+        if project_name is not None:
+            script_args += ["--project", project_name]
+        ida_args = [idat_path, "-A",
+                    "-S{0}".format(" ".join(quote_ida_script_argument(x) for x in [script_path] + script_args)),
+                    "-L{0}".format(os.path.join(output_dir, SHARD_IDA_LOG_FILENAME.format(shard_index)))]
+        if database_extension in [".idb", ".i64"]:
+            shard_database_path = os.path.join(shard_dir, os.path.basename(database_path))
+            shutil.copyfile(database_path, shard_database_path)
+            ida_args.append(shard_database_path)
+        else:
+            shard_database_path = os.path.join(shard_dir, os.path.basename(database_path) + ".i64")
+            ida_args += ["-o{0}".format(shard_database_path), os.path.abspath(database_path)]
+        print("Starting shard {0}/{1}".format(shard_index + 1, nb_jobs))
+        processes.append(subprocess.Popen(ida_args))
+
+    for shard_index, process in enumerate(processes):
+        return_code = process.wait()
+        if return_code != 0:
+            print("Shard {0} exited with code {1}".format(shard_index, return_code))
+    return merge_shard_results(output_dir, nb_jobs)
+
+
+def parse_arguments(args: List[str]):
+    parser = argparse.ArgumentParser(description="Headless batch deobfuscation with D-810")
+    subparsers = parser.add_subparsers(dest="command")
+    parser_launch = subparsers.add_parser("launch", help="Run D-810 on a database with several IDA processes")
+    parser_launch.add_argument("database", help="Database (or binary) to deobfuscate")
+    parser_launch.add_argument("--idat", required=True, help="Path to the idat executable")
+    parser_launch.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="Number of IDA processes")
+    parser_launch.add_argument("--project", default=None, help="D-810 project configuration name")
+    parser_launch.add_argument("--output", required=True, help="Output directory")
+    parser_run = subparsers.add_parser("run", help="Run D-810 on one shard (inside IDA)")
+    parser_run.add_argument("--shard", type=int, default=0)
+    parser_run.add_argument("--nb-shards", type=int, default=1)
+    parser_run.add_argument("--project", default=None, help="D-810 project configuration name")
+    parser_run.add_argument("--output", required=True, help="Output directory")
+    parser_merge = subparsers.add_parser("merge", help="Merge the results of all shards")
+    parser_merge.add_argument("--nb-shards", type=int, required=True)
+    parser_merge.add_argument("--output", required=True, help="Output directory")
+    return parser.parse_args(args)
+
+
+def main():
+    try:
+        import idc
+        is_in_ida = True
+        script_args = idc.ARGV[1:]
+    except ImportError:
+        is_in_ida = False
+        script_args = sys.argv[1:]
+
+    args = parse_arguments(script_args)
+    if args.command == "run":
+        exit_code = 0
+        try:
+            run_shard(args.shard, args.nb_shards, args.project, args.output)
+        except Exception as e:
+            logger.error("Batch shard {0} failed: {1}".format(args.shard, e))
+            exit_code = 1
+        if is_in_ida:
+            idc.qexit(exit_code)
+    elif args.command == "launch":
+        launch_shards(args.idat, args.database, args.jobs, args.project, args.output)
+    elif args.command == "merge":
+        merge_shard_results(args.output, args.nb_shards)
+
+
+if __name__ == "__main__":
+    main()
@@ -37,7 +37,7 @@ def insert_goto_instruction(blk: mblock_t, goto_blk_serial: int, nop_previous_in
     goto_ins.l.make_blkref(goto_blk_serial)
 
 
-def change_1way_call_block_successor(call_blk: mblock_t, call_blk_successor_serial: int) -> bool:
+def change_1way_call_block_successor(call_blk: mblock_t, call_blk_successor_serial: int, verify: bool = True) -> bool:
     if call_blk.nsucc() != 1:
         return False
 
@@ -45,9 +45,9 @@ def change_1way_call_block_successor(call_blk: mblock_t, call_blk_successor_seri
     previous_call_blk_successor_serial = call_blk.succset[0]
     previous_call_blk_successor = mba.get_mblock(previous_call_blk_successor_serial)
 
-    nop_blk = insert_nop_blk(call_blk)
+    nop_blk = insert_nop_blk(call_blk, verify=verify)
     insert_goto_instruction(nop_blk, call_blk_successor_serial, nop_previous_instruction=True)
-    is_ok = change_1way_block_successor(nop_blk, call_blk_successor_serial)
+    is_ok = change_1way_block_successor(nop_blk, call_blk_successor_serial, verify=verify)
     if not is_ok:
         return False
 
@@ -61,6 +61,8 @@ def change_1way_call_block_successor(call_blk: mblock_t, call_blk_successor_seri
         previous_call_blk_successor.mark_lists_dirty()
 
     mba.mark_chains_dirty()
+    if not verify:
+        return True
     try:
         mba.verify(True)
         return True
@@ -71,7 +73,7 @@ def change_1way_call_block_successor(call_blk: mblock_t, call_blk_successor_seri
         raise e
 
 
-def change_1way_block_successor(blk: mblock_t, blk_successor_serial: int) -> bool:
+def change_1way_block_successor(blk: mblock_t, blk_successor_serial: int, verify: bool = True) -> bool:
     if blk.nsucc() != 1:
         return False
 
@@ -91,7 +93,7 @@ def change_1way_block_successor(blk: mblock_t, blk_successor_serial: int) -> boo
     elif blk.tail.opcode == m_call:
         #  Before maturity MMAT_CALLS, we can't add a goto after a call instruction
         if mba.maturity < MMAT_CALLS:
-            return change_1way_call_block_successor(blk, blk_successor_serial)
+            return change_1way_call_block_successor(blk, blk_successor_serial, verify=verify)
         else:
             insert_goto_instruction(blk, blk_successor_serial, nop_previous_instruction=False)
     else:
@@ -118,6 +120,8 @@ def change_1way_block_successor(blk: mblock_t, blk_successor_serial: int) -> boo
         new_blk_successor.mark_lists_dirty()
 
     mba.mark_chains_dirty()
+    if not verify:
+        return True
     try:
         mba.verify(True)
         return True
@@ -165,7 +169,7 @@ def change_0way_block_successor(blk: mblock_t, blk_successor_serial: int) -> boo
         raise e
 
 
-def change_2way_block_conditional_successor(blk: mblock_t, blk_successor_serial: int) -> bool:
+def change_2way_block_conditional_successor(blk: mblock_t, blk_successor_serial: int, verify: bool = True) -> bool:
     if blk.nsucc() != 2:
         return False
 
@@ -192,6 +196,8 @@ def change_2way_block_conditional_successor(blk: mblock_t, blk_successor_serial:
 
     # Step4: Final stuff and checks
     mba.mark_chains_dirty()
+    if not verify:
+        return True
     try:
         mba.verify(True)
     except RuntimeError as e:
@@ -316,7 +322,7 @@ def update_block_successors(blk: mblock_t, blk_succ_serial_list: List[int]):
     blk.mark_lists_dirty()
 
 
-def insert_nop_blk(blk: mblock_t) -> mblock_t:
+def insert_nop_blk(blk: mblock_t, verify: bool = True) -> mblock_t:
     mba = blk.mba
     nop_block = mba.copy_block(blk, blk.serial + 1)
     cur_ins = nop_block.head
@@ -346,6 +352,8 @@ def insert_nop_blk(blk: mblock_t) -> mblock_t:
         new_blk_successor.mark_lists_dirty()
 
     mba.mark_chains_dirty()
+    if not verify:
+        return nop_block
     try:
         mba.verify(True)
         return nop_block
@@ -366,21 +374,21 @@ def ensure_last_block_is_goto(mba: mbl_array_t) -> int:
         raise ControlFlowException("Last block {0} is not one way (not supported yet)".format(last_blk.serial))
 
 
-def duplicate_block(block_to_duplicate: mblock_t) -> Tuple[mblock_t, mblock_t]:
+def duplicate_block(block_to_duplicate: mblock_t, verify: bool = True) -> Tuple[mblock_t, mblock_t]:
     mba = block_to_duplicate.mba
     duplicated_blk = mba.copy_block(block_to_duplicate, mba.qty - 1)
     helper_logger.debug("  Duplicated {0} -> {1}".format(block_to_duplicate.serial, duplicated_blk.serial))
     duplicated_blk_default = None
     if (block_to_duplicate.tail is not None) and is_mcode_jcond(block_to_duplicate.tail.opcode):
         block_to_duplicate_default_successor = mba.get_mblock(block_to_duplicate.serial + 1)
-        duplicated_blk_default = insert_nop_blk(duplicated_blk)
-        change_1way_block_successor(duplicated_blk_default, block_to_duplicate.serial + 1)
+        duplicated_blk_default = insert_nop_blk(duplicated_blk, verify=verify)
+        change_1way_block_successor(duplicated_blk_default, block_to_duplicate.serial + 1, verify=verify)
         helper_logger.debug("  {0} is conditional, so created a default child {1} for {2} which goto {3}"
                             .format(block_to_duplicate.serial, duplicated_blk_default.serial, duplicated_blk.serial,
                                     block_to_duplicate_default_successor.serial))
     elif duplicated_blk.nsucc() == 1:
         helper_logger.debug("  Making {0} goto {1}".format(duplicated_blk.serial, block_to_duplicate.succset[0]))
-        change_1way_block_successor(duplicated_blk, block_to_duplicate.succset[0])
+        change_1way_block_successor(duplicated_blk, block_to_duplicate.succset[0], verify=verify)
     elif duplicated_blk.nsucc() == 0:
         helper_logger.debug("  Duplicated block {0} has no successor => Nothing to do".format(duplicated_blk.serial))
 
@@ -0,0 +1,152 @@
+import json
+import hashlib
+import logging
+from typing import Union, List, Dict
+
+import idautils
+import ida_bytes
+import ida_nalt
+import ida_typeinf
+from ida_hexrays import mbl_array_t, get_hexrays_version
+
+logger = logging.getLogger('D810')
+
+
+def get_function_bytes_hash(func_entry_ea: int) -> Union[None, str]:
+    func_hash = hashlib.sha256()
+    nb_chunks = 0
+    for chunk_start_ea, chunk_end_ea in idautils.Chunks(func_entry_ea):
+        chunk_bytes = ida_bytes.get_bytes(chunk_start_ea, chunk_end_ea - chunk_start_ea)
+        if chunk_bytes is None:
+            return None
+        func_hash.update("{0:x}:{1:x}:".format(chunk_start_ea, chunk_end_ea).encode())
+        func_hash.update(chunk_bytes)
+        nb_chunks += 1
+    if nb_chunks == 0:
+        return None
+    return func_hash.hexdigest()
+
+
+def get_function_type_hash(func_entry_ea: int) -> str:
+    # The microcode also depends on the function prototype, so it is part of the function key
+    func_type = ida_typeinf.tinfo_t()
+    func_type_str = func_type.dstr() if ida_nalt.get_tinfo(func_type, func_entry_ea) else ""
+    return hashlib.sha256(func_type_str.encode()).hexdigest()
+
+
+def get_rules_configuration_key(ins_rules, blk_rules, **kwargs) -> str:
+    rules_configuration = {
+        "ins_rules": [[rule.name, rule.config] for rule in ins_rules],
+        "blk_rules": [[rule.name, rule.config] for rule in blk_rules],
+        "additional_configuration": kwargs
+    }
+    return hashlib.sha256(json.dumps(rules_configuration, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class FunctionRewritePlan(object):
+    # Records, for one decompilation of a function, which rules fired:
+    #  - ins_rules_by_maturity_ea: (maturity, instruction ea) -> list of instruction rule names which fired
+    #    (an empty list means that instructions at this address were optimized but no rule fired)
+    #  - blk_rules_by_maturity: maturity -> list of block rule names which patched the function
+    def __init__(self, func_key: str):
+        self.func_key = func_key
+        self.is_complete = False
+        self.ins_rules_by_maturity_ea: Dict[tuple, List[str]] = {}
+        self.blk_rules_by_maturity: Dict[int, List[str]] = {}
+
+    def add_instruction_visit(self, maturity: int, ea: int):
+        if (maturity, ea) not in self.ins_rules_by_maturity_ea.keys():
+            self.ins_rules_by_maturity_ea[(maturity, ea)] = []
+
+    def add_instruction_rule(self, maturity: int, ea: int, rule_name: str):
+        rule_names = self.ins_rules_by_maturity_ea.setdefault((maturity, ea), [])
+        if rule_name not in rule_names:
+            rule_names.append(rule_name)
+
+    def add_block_visit(self, maturity: int):
+        if maturity not in self.blk_rules_by_maturity.keys():
+            self.blk_rules_by_maturity[maturity] = []
+
+    def add_block_rule(self, maturity: int, rule_name: str):
+        rule_names = self.blk_rules_by_maturity.setdefault(maturity, [])
+        if rule_name not in rule_names:
+            rule_names.append(rule_name)
+
+
+class DecompilationCache(object):
+    # Keeps the rewrite plan of the last complete decompilation of each function.
+    # When a function is decompiled again with the same bytes, prototype, decompiler flags and rule configuration, the
+    # previous plan is replayed: rules which did not fire previously are not tried again.
+    # Changes which are not part of the key (e.g. prototypes of callees or decompiler options) may change the
+    # microcode without invalidating the plan, which is why the cache is disabled by default.
+    def __init__(self):
+        self.is_enabled = False
+        self.config_key = None
+        self.plan_by_func_ea: Dict[int, FunctionRewritePlan] = {}
+        self.recording_plan: Union[None, FunctionRewritePlan] = None
+        self.replay_plan: Union[None, FunctionRewritePlan] = None
+
+    def reset(self, is_enabled: bool = False, config_key: Union[None, str] = None):
+        self.is_enabled = is_enabled
+        self.config_key = config_key
+        self.plan_by_func_ea = {}
+        self.recording_plan = None
+        self.replay_plan = None
+
+    def start_function(self, mba: mbl_array_t, decomp_flags: int = 0):
+        self.recording_plan = None
+        self.replay_plan = None
+        if not self.is_enabled:
+            return
+        func_bytes_hash = get_function_bytes_hash(mba.entry_ea)
+        if func_bytes_hash is None:
+            return
+        func_key = "{0}:{1}:{2}:{3:x}:{4}".format(func_bytes_hash, get_function_type_hash(mba.entry_ea),
+                                                  get_hexrays_version(), decomp_flags, self.config_key)
+        previous_plan = self.plan_by_func_ea.get(mba.entry_ea)
+        if (previous_plan is not None) and previous_plan.is_complete and (previous_plan.func_key == func_key):
+            logger.info("Replaying rewrite plan of function at 0x{0:x}".format(mba.entry_ea))
+            self.replay_plan = previous_plan
+        self.recording_plan = FunctionRewritePlan(func_key)
+
+    def end_function(self, mba: mbl_array_t, is_complete: bool = True):
+        # A plan is not complete if some rules couldn't be fully evaluated (e.g. Z3 queries which timed out): replaying
+        # it would prevent these rules from being tried again
+        if self.recording_plan is None:
+            return
+        if not is_complete:
+            logger.info("Rewrite plan of function at 0x{0:x} not kept: it is incomplete".format(mba.entry_ea))
+            self.recording_plan = None
+            return
+        self.recording_plan.is_complete = True
+        self.plan_by_func_ea[mba.entry_ea] = self.recording_plan
+
+    def get_instruction_rule_names(self, maturity: int, ea: int) -> Union[None, List[str]]:
+        # Returns None if all rules must be tried, otherwise the list of rules that may fire
+        if self.replay_plan is None:
+            return None
+        return self.replay_plan.ins_rules_by_maturity_ea.get((maturity, ea))
+
+    def is_block_rule_skipped(self, maturity: int, rule_name: str) -> bool:
+        if self.replay_plan is None:
+            return False
+        rule_names = self.replay_plan.blk_rules_by_maturity.get(maturity)
+        if rule_names is None:
+            return False
+        return rule_name not in rule_names
+
+    def add_instruction_visit(self, maturity: int, ea: int):
+        if self.recording_plan is not None:
+            self.recording_plan.add_instruction_visit(maturity, ea)
+
+    def add_instruction_rule(self, maturity: int, ea: int, rule_name: str):
+        if self.recording_plan is not None:
+            self.recording_plan.add_instruction_rule(maturity, ea, rule_name)
+
+    def add_block_visit(self, maturity: int):
+        if self.recording_plan is not None:
+            self.recording_plan.add_block_visit(maturity)
+
+    def add_block_rule(self, maturity: int, rule_name: str):
+        if self.recording_plan is not None:
+            self.recording_plan.add_block_rule(maturity, rule_name)
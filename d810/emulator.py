@@ -5,12 +5,13 @@ from idaapi import getseg, get_qword, SEGPERM_WRITE
 from ida_hexrays import *
 
 from d810.utils import unsigned_to_signed, signed_to_unsigned, get_add_cf, get_add_of, get_sub_of, ror, get_parity_flag
-from d810.hexrays_helpers import equal_mops_ignore_size, get_mop_index, AND_TABLE, CONTROL_FLOW_OPCODES, \
+from d810.hexrays_helpers import get_mop_key, AND_TABLE, CONTROL_FLOW_OPCODES, \
     CONDITIONAL_JUMP_OPCODES
 from d810.hexrays_formatters import format_minsn_t, format_mop_t, mop_type_to_string, opcode_to_string
 from d810.cfg_utils import get_block_serials_by_address
 from d810.errors import EmulationException, EmulationIndirectJumpException, UnresolvedMopException, \
-    WritableMemoryReadException
+    WritableMemoryReadException, UnsupportedInstructionException
+from d810.profiler import get_profiler, PROFILE_EMULATOR_STEPS
 
 emulator_log = logging.getLogger('D810.emulator')
 
@@ -270,9 +271,11 @@ class MicroCodeInterpreter(object):
                 stack_mop = mop_t()
                 stack_mop.erase()
                 stack_mop._make_stkvar(environment.cur_blk.mba, load_address)
-                emulator_log.debug("Searching for stack mop {0}".format(format_mop_t(stack_mop)))
+                if emulator_log.isEnabledFor(logging.DEBUG):
+                    emulator_log.debug("Searching for stack mop {0}".format(format_mop_t(stack_mop)))
                 stack_mop_value = environment.lookup(stack_mop)
-                emulator_log.debug("  stack mop {0} value : {1}".format(format_mop_t(stack_mop), stack_mop_value))
+                if emulator_log.isEnabledFor(logging.DEBUG):
+                    emulator_log.debug("  stack mop {0} value : {1}".format(format_mop_t(stack_mop), stack_mop_value))
                 return stack_mop_value & res_mask
             else:
                 mem_seg = getseg(load_address)
@@ -304,10 +307,12 @@ class MicroCodeInterpreter(object):
             return self._eval_instruction(mop.d, environment)
         elif mop.t == mop_a:
             if mop.a.t == mop_v:
-                emulator_log.debug("Reading a mop_a '{0}' -> {1:x}".format(format_mop_t(mop), mop.a.g))
+                if emulator_log.isEnabledFor(logging.DEBUG):
+                    emulator_log.debug("Reading a mop_a '{0}' -> {1:x}".format(format_mop_t(mop), mop.a.g))
                 return mop.a.g
             elif mop.a.t == mop_S:
-                emulator_log.debug("Reading a mop_a '{0}' -> {1:x}".format(format_mop_t(mop), mop.a.s.off))
+                if emulator_log.isEnabledFor(logging.DEBUG):
+                    emulator_log.debug("Reading a mop_a '{0}' -> {1:x}".format(format_mop_t(mop), mop.a.s.off))
                 return mop.a.s.off
             raise UnresolvedMopException("Calling get_cst with unsupported mop type {0} - {1}: '{2}'"
                                          .format(mop.t, mop.a.t, format_mop_t(mop)))
@@ -315,7 +320,8 @@ class MicroCodeInterpreter(object):
             mem_seg = getseg(mop.g)
             seg_perm = mem_seg.perm
             if (seg_perm & SEGPERM_WRITE) != 0:
-                emulator_log.debug("Reading a (writable) mop_v {0}".format(format_mop_t(mop)))
+                if emulator_log.isEnabledFor(logging.DEBUG):
+                    emulator_log.debug("Reading a (writable) mop_v {0}".format(format_mop_t(mop)))
                 return environment.lookup(mop)
             else:
                 memory_value = get_qword(mop.g)
@@ -329,9 +335,11 @@ class MicroCodeInterpreter(object):
         try:
             if environment is None:
                 environment = self.global_environment
-            emulator_log.info("Evaluating microcode instruction : '{0}'".format(format_minsn_t(ins)))
+            if emulator_log.isEnabledFor(logging.INFO):
+                emulator_log.info("Evaluating microcode instruction : '{0}'".format(format_minsn_t(ins)))
             if ins is None:
                 return False
+            get_profiler().add_counter(PROFILE_EMULATOR_STEPS)
             self._eval_instruction_and_update_environment(blk, ins, environment)
             return True
         except EmulationException as e:
@@ -366,57 +374,68 @@ class MicroCodeInterpreter(object):
 
 
 class MopMapping(object):
+    # Mops are indexed by get_mop_key, thus two mops equal according to equal_mops_ignore_size share the same entry.
+    # Copies are copy-on-write: the dictionaries are only duplicated when a shared mapping is modified.
     def __init__(self):
-        self.mops = []
-        self.mops_values = []
+        self._mop_by_key = {}
+        self._value_by_key = {}
+        self._is_shared = False
+
+    def _unshare(self):
+        if self._is_shared:
+            self._mop_by_key = dict(self._mop_by_key)
+            self._value_by_key = dict(self._value_by_key)
+            self._is_shared = False
 
     def __setitem__(self, mop: mop_t, mop_value: int):
-        mop_index = get_mop_index(mop, self.mops)
+        self._unshare()
+        mop_key = get_mop_key(mop)
         mop_value &= AND_TABLE[mop.size]
-        if mop_index != -1:
-            self.mops_values[mop_index] = mop_value
-            return
-        self.mops.append(mop)
-        self.mops_values.append(mop_value)
+        if mop_key not in self._mop_by_key:
+            self._mop_by_key[mop_key] = mop
+        self._value_by_key[mop_key] = mop_value
 
     def __getitem__(self, mop: mop_t) -> int:
-        mop_index = get_mop_index(mop, self.mops)
-        if mop_index == -1:
-            raise KeyError
-        return self.mops_values[mop_index]
+        return self._value_by_key[get_mop_key(mop)]
+
+    def get(self, mop: mop_t, default: Union[None, int] = None) -> Union[None, int]:
+        return self._value_by_key.get(get_mop_key(mop), default)
 
     def __len__(self):
-        return len(self.mops)
+        return len(self._mop_by_key)
 
     def __delitem__(self, mop: mop_t):
-        mop_index = get_mop_index(mop, self.mops)
-        if mop_index == -1:
+        mop_key = get_mop_key(mop)
+        if mop_key not in self._mop_by_key:
             raise KeyError
-        del self.mops[mop_index]
-        del self.mops_values[mop_index]
+        self._unshare()
+        del self._mop_by_key[mop_key]
+        del self._value_by_key[mop_key]
 
     def clear(self):
-        self.mops = []
-        self.mops_values = []
+        self._mop_by_key = {}
+        self._value_by_key = {}
+        self._is_shared = False
 
     def copy(self):
         new_mapping = MopMapping()
-        for mop, mop_value in self.items():
-            new_mapping[mop] = mop_value
+        new_mapping._mop_by_key = self._mop_by_key
+        new_mapping._value_by_key = self._value_by_key
+        new_mapping._is_shared = True
+        self._is_shared = True
         return new_mapping
 
     def has_key(self, mop: mop_t):
-        mop_index = get_mop_index(mop, self.mops)
-        return mop_index != -1
+        return get_mop_key(mop) in self._mop_by_key
 
     def keys(self) -> List[mop_t]:
-        return self.mops
+        return list(self._mop_by_key.values())
 
     def values(self) -> List[int]:
-        return self.mops_values
+        return list(self._value_by_key.values())
 
     def items(self):
-        return [(x, y) for x, y in zip(self.mops, self.mops_values)]
+        return [(mop, self._value_by_key[mop_key]) for mop_key, mop in self._mop_by_key.items()]
 
     def __contains__(self, mop: mop_t):
         return self.has_key(mop)
@@ -441,10 +460,8 @@ class MicroCodeEnvironment(object):
         if parent_copy is not None and copy_parent:
             parent_copy = self.parent.get_copy(copy_parent=True)
         new_env = MicroCodeEnvironment(parent_copy)
-        for mop, mop_value in self.mop_r_record.items():
-            new_env.define(mop, mop_value)
-        for mop, mop_value in self.mop_S_record.items():
-            new_env.define(mop, mop_value)
+        new_env.mop_r_record = self.mop_r_record.copy()
+        new_env.mop_S_record = self.mop_S_record.copy()
         new_env.cur_blk = self.cur_blk
         new_env.cur_ins = self.cur_ins
         new_env.next_blk = self.next_blk
@@ -463,8 +480,9 @@ class MicroCodeEnvironment(object):
             if self.next_ins is None:
                 self.next_blk = self.cur_blk.mba.get_mblock(self.cur_blk.serial + 1)
                 self.next_ins = self.next_blk.head
-        emulator_log.debug(
-            "Setting next block {0} and next ins {1}".format(self.next_blk.serial, format_minsn_t(self.next_ins)))
+        if emulator_log.isEnabledFor(logging.DEBUG):
+            emulator_log.debug("Setting next block {0} and next ins {1}"
+                               .format(self.next_blk.serial, format_minsn_t(self.next_ins)))
 
     def set_next_flow(self, next_blk: mblock_t, next_ins: minsn_t):
         self.next_blk = next_blk
@@ -480,14 +498,14 @@ class MicroCodeEnvironment(object):
         raise EmulationException("Defining an unsupported mop type '{0}': '{1}'"
                                  .format(mop_type_to_string(mop.t), format_mop_t(mop)))
 
-    def _lookup_mop(self, searched_mop: mop_t, mop_value_dict: Dict[mop_t, int], new_mop_value: Union[None, int] = None,
+    def _lookup_mop(self, searched_mop: mop_t, mop_value_dict: MopMapping, new_mop_value: Union[None, int] = None,
                     auto_define=True, raise_exception=True) -> int:
-        for known_mop, mop_value in mop_value_dict.items():
-            if equal_mops_ignore_size(searched_mop, known_mop):
-                if new_mop_value is not None:
-                    mop_value_dict[searched_mop] = new_mop_value
-                    return new_mop_value
-                return mop_value
+        mop_value = mop_value_dict.get(searched_mop)
+        if mop_value is not None:
+            if new_mop_value is not None:
+                mop_value_dict[searched_mop] = new_mop_value
+                return new_mop_value
+            return mop_value
         if (new_mop_value is not None) and auto_define:
             self.define(searched_mop, new_mop_value)
             return new_mop_value
@@ -509,3 +527,181 @@ class MicroCodeEnvironment(object):
             return self._lookup_mop(mop, self.mop_S_record, value, auto_define)
         raise EmulationException("Assigning an unsupported mop type '{0}': '{1}'"
                                  .format(mop_type_to_string(mop.t), format_mop_t(mop)))
+
+
+COMPILED_BINARY_OPERATIONS = {
+    m_add: lambda x, y: x + y,
+    m_sub: lambda x, y: x - y,
+    m_mul: lambda x, y: x * y,
+    m_udiv: lambda x, y: x // y,
+    m_umod: lambda x, y: x % y,
+    m_or: lambda x, y: x | y,
+    m_and: lambda x, y: x & y,
+    m_xor: lambda x, y: x ^ y,
+    m_shl: lambda x, y: x << y,
+    m_shr: lambda x, y: x >> y,
+    m_setnz: lambda x, y: 1 if x != y else 0,
+    m_setz: lambda x, y: 1 if x == y else 0,
+    m_setae: lambda x, y: 1 if x >= y else 0,
+    m_setb: lambda x, y: 1 if x < y else 0,
+    m_seta: lambda x, y: 1 if x > y else 0,
+    m_setbe: lambda x, y: 1 if x <= y else 0,
+}
+
+COMPILED_SIGNED_SET_OPERATIONS = {
+    m_setg: lambda x, y: 1 if x > y else 0,
+    m_setge: lambda x, y: 1 if x >= y else 0,
+    m_setl: lambda x, y: 1 if x < y else 0,
+    m_setle: lambda x, y: 1 if x <= y else 0,
+}
+
+COMPILED_CONDITIONAL_JUMPS = {
+    m_jnz: lambda x, y: x != y,
+    m_jz: lambda x, y: x == y,
+    m_jae: lambda x, y: x >= y,
+    m_jb: lambda x, y: x < y,
+    m_ja: lambda x, y: x > y,
+    m_jbe: lambda x, y: x <= y,
+}
+
+COMPILED_SIGNED_CONDITIONAL_JUMPS = {
+    m_jg: lambda x, y: x > y,
+    m_jge: lambda x, y: x >= y,
+    m_jl: lambda x, y: x < y,
+    m_jle: lambda x, y: x <= y,
+}
+
+
+class CompiledMicroCodeBlock(object):
+    # A block lowered into Python closures working on a dictionary mop key -> value:
+    #  - assignments: list of (destination key, destination mask, value closure)
+    #  - get_next_serial: closure returning the serial of the next block to execute (one of successor_serials)
+    def __init__(self, blk: mblock_t, assignments: List, get_next_serial, successor_serials: List[int],
+                 instructions: List[minsn_t]):
+        self.serial = blk.serial
+        self.assignments = assignments
+        self.get_next_serial = get_next_serial
+        self.successor_serials = successor_serials
+        self.instructions = instructions
+
+    def execute(self, values: Dict) -> int:
+        for dst_key, dst_mask, get_value in self.assignments:
+            values[dst_key] = get_value(values) & dst_mask
+        return self.get_next_serial(values)
+
+
+class MicroCodeCompiler(object):
+    # Lowers microcode blocks into Python closures, so that blocks executed many times (e.g. dispatcher blocks) are
+    # decoded only once. Only instructions working on registers, stack variables and constants are supported,
+    # with the same semantic as MicroCodeInterpreter: UnsupportedInstructionException is raised for anything else,
+    # and MicroCodeInterpreter should be used instead.
+    def compile_block(self, blk: mblock_t) -> CompiledMicroCodeBlock:
+        if blk.head is None:
+            raise UnsupportedInstructionException("Can't compile empty block {0}".format(blk.serial))
+        assignments = []
+        instructions = []
+        get_next_serial = None
+        successor_serials = [blk.serial + 1]
+        cur_ins = blk.head
+        while cur_ins is not None:
+            instructions.append(cur_ins)
+            if cur_ins.opcode in CONTROL_FLOW_OPCODES:
+                if cur_ins.next is not None:
+                    raise UnsupportedInstructionException("Control flow instruction in the middle of block {0}"
+                                                          .format(blk.serial))
+                get_next_serial = self._compile_control_flow_instruction(blk, cur_ins)
+                if cur_ins.opcode == m_goto:
+                    successor_serials = [cur_ins.l.b]
+                else:
+                    successor_serials = [cur_ins.d.b, blk.serial + 1]
+            else:
+                if cur_ins.d.t not in [mop_r, mop_S]:
+                    raise UnsupportedInstructionException("Can't compile instruction '{0}'"
+                                                          .format(format_minsn_t(cur_ins)))
+                assignments.append((get_mop_key(cur_ins.d), AND_TABLE[cur_ins.d.size],
+                                    self._compile_instruction(cur_ins)))
+            cur_ins = cur_ins.next
+        if get_next_serial is None:
+            next_serial = blk.serial + 1
+            get_next_serial = lambda values: next_serial
+        return CompiledMicroCodeBlock(blk, assignments, get_next_serial, successor_serials, instructions)
+
+    def _compile_mop(self, mop: mop_t):
+        if mop.t == mop_n:
+            mop_value = mop.nnn.value
+            return lambda values: mop_value
+        elif mop.t in [mop_r, mop_S]:
+            mop_key = get_mop_key(mop)
+            return lambda values: values[mop_key]
+        elif mop.t == mop_d:
+            return self._compile_instruction(mop.d)
+        raise UnsupportedInstructionException("Can't compile mop type '{0}': '{1}'"
+                                              .format(mop_type_to_string(mop.t), format_mop_t(mop)))
+
+    def _compile_instruction(self, ins: minsn_t):
+        res_mask = AND_TABLE[ins.d.size]
+        if ins.opcode in [m_mov, m_xdu, m_low]:
+            get_l = self._compile_mop(ins.l)
+            return lambda values: get_l(values) & res_mask
+        elif ins.opcode == m_neg:
+            get_l = self._compile_mop(ins.l)
+            return lambda values: (- get_l(values)) & res_mask
+        elif ins.opcode == m_bnot:
+            get_l = self._compile_mop(ins.l)
+            return lambda values: (get_l(values) ^ res_mask) & res_mask
+        elif ins.opcode == m_xds:
+            get_l = self._compile_mop(ins.l)
+            l_size, d_size = ins.l.size, ins.d.size
+            return lambda values: signed_to_unsigned(unsigned_to_signed(get_l(values), l_size), d_size) & res_mask
+        elif ins.opcode == m_sets:
+            get_l = self._compile_mop(ins.l)
+            l_size = ins.l.size
+            return lambda values: (1 if unsigned_to_signed(get_l(values), l_size) < 0 else 0) & res_mask
+        elif ins.opcode == m_sar:
+            get_l = self._compile_mop(ins.l)
+            get_r = self._compile_mop(ins.r)
+            l_size, d_size = ins.l.size, ins.d.size
+            return lambda values: signed_to_unsigned(unsigned_to_signed(get_l(values), l_size) >> get_r(values),
+                                                     d_size) & res_mask
+        elif ins.opcode in COMPILED_BINARY_OPERATIONS.keys():
+            operation = COMPILED_BINARY_OPERATIONS[ins.opcode]
+            get_l = self._compile_mop(ins.l)
+            get_r = self._compile_mop(ins.r)
+            return lambda values: operation(get_l(values), get_r(values)) & res_mask
+        elif ins.opcode in COMPILED_SIGNED_SET_OPERATIONS.keys():
+            operation = COMPILED_SIGNED_SET_OPERATIONS[ins.opcode]
+            get_l = self._compile_mop(ins.l)
+            get_r = self._compile_mop(ins.r)
+            l_size, r_size = ins.l.size, ins.r.size
+            return lambda values: operation(unsigned_to_signed(get_l(values), l_size),
+                                            unsigned_to_signed(get_r(values), r_size)) & res_mask
+        raise UnsupportedInstructionException("Can't compile instruction opcode '{0}': '{1}'"
+                                              .format(opcode_to_string(ins.opcode), format_minsn_t(ins)))
+
+    def _compile_control_flow_instruction(self, blk: mblock_t, ins: minsn_t):
+        direct_child_serial = blk.serial + 1
+        if ins.opcode == m_goto and ins.l.t == mop_b:
+            target_serial = ins.l.b
+            return lambda values: target_serial
+        if ins.d.t != mop_b:
+            raise UnsupportedInstructionException("Can't compile control flow instruction '{0}'"
+                                                  .format(format_minsn_t(ins)))
+        target_serial = ins.d.b
+        if ins.opcode == m_jcnd:
+            get_l = self._compile_mop(ins.l)
+            return lambda values: target_serial if get_l(values) != 0 else direct_child_serial
+        elif ins.opcode in COMPILED_CONDITIONAL_JUMPS.keys():
+            condition = COMPILED_CONDITIONAL_JUMPS[ins.opcode]
+            get_l = self._compile_mop(ins.l)
+            get_r = self._compile_mop(ins.r)
+            return lambda values: target_serial if condition(get_l(values), get_r(values)) else direct_child_serial
+        elif ins.opcode in COMPILED_SIGNED_CONDITIONAL_JUMPS.keys():
+            condition = COMPILED_SIGNED_CONDITIONAL_JUMPS[ins.opcode]
+            get_l = self._compile_mop(ins.l)
+            get_r = self._compile_mop(ins.r)
+            l_size, r_size = ins.l.size, ins.r.size
+            return lambda values: target_serial if condition(unsigned_to_signed(get_l(values), l_size),
+                                                             unsigned_to_signed(get_r(values), r_size)) \
+                else direct_child_serial
+        raise UnsupportedInstructionException("Can't compile control flow instruction '{0}'"
+                                              .format(format_minsn_t(ins)))
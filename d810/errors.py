@@ -10,6 +10,10 @@ class AstEvaluationException(AstException):
     pass
 
 
+class UnsupportedAstException(AstException):
+    pass
+
+
 class D810Z3Exception(D810Exception):
     pass
 
@@ -1,13 +1,31 @@
 import os
 import logging
-from typing import List
+from typing import List, Union
 
 from d810.hexrays_helpers import OPCODES_INFO, MATURITY_TO_STRING_DICT, STRING_TO_MATURITY_DICT, MOP_TYPE_TO_STRING_DICT
+from d810.microcode_dump import get_microcode_dump_writer
 from ida_hexrays import minsn_t, mop_t, vd_printer_t, mbl_array_t
 
 
 logger = logging.getLogger('D810.helper')
 
+# Microcode dumps are disabled or restricted to a few functions when not needed, printing a whole mba is expensive
+is_microcode_dump_enabled = True
+microcode_dump_function_eas = set()
+
+
+def set_microcode_dump_functions(is_enabled: bool, func_ea_list: Union[None, List[int]] = None):
+    # An empty list of functions means that the microcode of all functions is dumped
+    global is_microcode_dump_enabled, microcode_dump_function_eas
+    is_microcode_dump_enabled = is_enabled
+    microcode_dump_function_eas = set(func_ea_list) if func_ea_list is not None else set()
+
+
+def is_microcode_dump_enabled_for(func_ea: int) -> bool:
+    if not is_microcode_dump_enabled:
+        return False
+    return (len(microcode_dump_function_eas) == 0) or (func_ea in microcode_dump_function_eas)
+
 
 def format_minsn_t(ins: minsn_t) -> str:
     if ins is None:
@@ -76,20 +94,26 @@ class block_printer(vd_printer_t):
         return 1
 
 
-def write_mc_to_file(mba: mbl_array_t, filename: str, mba_flags: int = 0) -> bool:
-    if not mba:
-        return False
-
+def get_mc_lines(mba: mbl_array_t, mba_flags: int = 0) -> List[str]:
     vp = mba_printer()
     mba.set_mba_flags(mba_flags)
     mba._print(vp)
+    return vp.get_mc()
+
+
+def write_mc_to_file(mba: mbl_array_t, filename: str, mba_flags: int = 0) -> bool:
+    if not mba:
+        return False
 
     with open(filename, "w") as f:
-        f.writelines(vp.get_mc())
+        f.writelines(get_mc_lines(mba, mba_flags))
     return True
 
 
 def dump_microcode_for_debug(mba: mbl_array_t, log_dir_path: str, name: str = ""):
-    mc_filename = os.path.join(log_dir_path, "{0:x}_maturity_{1}_{2}.log".format(mba.entry_ea, mba.maturity, name))
-    logger.info("Dumping microcode in file {0}...".format(mc_filename))
-    write_mc_to_file(mba, mc_filename)
+    if not is_microcode_dump_enabled_for(mba.entry_ea):
+        return
+    logger.info("Dumping microcode '{0}' of function 0x{1:x} at maturity {2}..."
+                .format(name, mba.entry_ea, mba.maturity))
+    # Only the printing of the mba is done here, files are written by a background thread
+    get_microcode_dump_writer().add_dump(log_dir_path, mba.entry_ea, mba.maturity, name, get_mc_lines(mba))
@@ -240,6 +240,103 @@ def equal_mops_ignore_size(lo: mop_t, ro: mop_t) -> bool:
         return False
 
 
+def get_mop_key(mop: mop_t, with_size=False):
+    """
+    Return a hashable structural key of a mop.
+    By default, two mops have the same key iff they are equal according to equal_mops_ignore_size, which allows to
+    replace linear searches with equal_mops_ignore_size by dictionary lookups.
+    If with_size is True, the size of each mop is also part of the key.
+
+    :param mop: the mop to hash
+    :param with_size: whether mop sizes should be taken into account
+    :return: a hashable tuple
+    """
+    if mop is None:
+        return None
+    if mop.t == mop_z:
+        key = (mop_z,)
+    elif mop.t == mop_n:
+        key = (mop_n, mop.nnn.value)
+    elif mop.t == mop_S:
+        key = (mop_S, mop.s.off)
+    elif mop.t == mop_v:
+        key = (mop_v, mop.g)
+    elif mop.t == mop_d:
+        key = get_minsn_key(mop.d, with_size)
+    elif mop.t == mop_b:
+        key = (mop_b, mop.b)
+    elif mop.t == mop_r:
+        key = (mop_r, mop.r)
+    elif mop.t == mop_l:
+        key = (mop_l, mop.l.idx, mop.l.off)
+    elif mop.t == mop_a:
+        key = (mop_a, mop.a.insize, mop.a.outsize, get_mop_key(mop.a, with_size))
+    elif mop.t == mop_h:
+        key = (mop_h, mop.helper)
+    elif mop.t == mop_str:
+        key = (mop_str, mop.cstr)
+    elif mop.t in [mop_fn, mop_c]:
+        key = (mop.t, mop.dstr())
+    elif mop.t == mop_p:
+        key = (mop_p, get_mop_key(mop.pair.lop, with_size), get_mop_key(mop.pair.hop, with_size))
+    else:
+        # mop_f, mop_sc and unknown types are never considered equal (see equal_mops_ignore_size)
+        key = (mop.t, object())
+    if with_size:
+        return key + (mop.size,)
+    return key
+
+
+def get_minsn_key(ins: minsn_t, with_size=False):
+    return (mop_d, ins.opcode, get_mop_key(ins.l, with_size), get_mop_key(ins.r, with_size),
+            get_mop_key(ins.d, with_size))
+
+
+def is_unique_key(key: tuple) -> bool:
+    """
+    Return True if a key built by get_mop_key or get_minsn_key contains a placeholder (used for mops which are never
+    considered equal), i.e. if the key can't be equal to any other key.
+
+    :param key: the key
+    :return: True if the key is unique
+    """
+    for elt in key:
+        if type(elt) is object:
+            return True
+        if isinstance(elt, tuple) and is_unique_key(elt):
+            return True
+    return False
+
+
+def get_bnot_mop_keys(mop: mop_t) -> List[tuple]:
+    """
+    Return the bnot keys of a non constant mop, which allow to replace pairwise equal_bnot_mop tests by dictionary
+    lookups. A bnot key is a (class key, polarity) tuple: two mops are equal_bnot_mop iff one bnot key of the first
+    one is the complement (same class key, other polarity) of a bnot key of the second one.
+
+    :param mop: the mop
+    :return: list of bnot keys
+    """
+    bnot_keys = [(get_mop_key(mop), 0)]
+    if mop.t != mop_d:
+        return bnot_keys
+    if mop.d.opcode == m_bnot:
+        # ~x and x
+        bnot_keys.append((get_mop_key(mop.d.l), 1))
+    elif mop.d.opcode == m_neg:
+        # Hexrays may have optimized using ~(-x) = x - 1
+        bnot_keys.append((("neg", get_mop_key(mop.d.l)), 1))
+    elif (mop.d.opcode == m_sub) and (mop.d.r.t == mop_n) and (mop.d.r.nnn.value == 1):
+        bnot_keys.append((("neg", get_mop_key(mop.d.l)), 0))
+    elif mop.d.opcode == m_xds:
+        bnot_keys += get_bnot_mop_keys(mop.d.l)
+    return bnot_keys
+
+
+def get_complement_bnot_key(bnot_key: tuple) -> tuple:
+    return bnot_key[0], 1 - bnot_key[1]
+
+
 def is_check_mop(lo: mop_t) -> bool:
     if lo.t != mop_d:
         return False
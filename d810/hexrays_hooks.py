@@ -1,17 +1,22 @@
 from __future__ import annotations
+import time
 import logging
+from collections import OrderedDict
 
 from ida_hexrays import *
 
 from d810.optimizers.instructions import PatternOptimizer, ChainOptimizer, Z3Optimizer, EarlyOptimizer, \
-    InstructionAnalyzer
-from d810.hexrays_helpers import check_ins_mop_size_are_ok, append_mop_if_not_in_list
+    MbaOptimizer, InstructionAnalyzer
+from d810.optimizers.instructions.handler import InstructionContext
+from d810.hexrays_helpers import check_ins_mop_size_are_ok, append_mop_if_not_in_list, get_minsn_key, is_unique_key
 from d810.hexrays_formatters import format_minsn_t, format_mop_t, maturity_to_string, mop_type_to_string, \
     dump_microcode_for_debug
 from d810.errors import D810Exception
-from d810.z3_utils import log_z3_instructions
+from d810.z3_utils import log_z3_instructions, get_z3_query_cache, get_z3_budget
+from d810.profiler import get_profiler, PROFILE_OPTIMIZER, PROFILE_BLK_RULE
+from d810.verification import get_verification_policy
 
-from typing import TYPE_CHECKING, List
+from typing import TYPE_CHECKING, List, Union
 if TYPE_CHECKING:
     from d810.manager import D810Manager
     from d810.optimizers.instructions.handler import InstructionOptimizer, InstructionOptimizationRule
@@ -25,7 +30,36 @@ DEFAULT_OPTIMIZATION_PATTERN_MATURITIES = [MMAT_PREOPTIMIZED, MMAT_LOCOPT, MMAT_
 DEFAULT_OPTIMIZATION_CHAIN_MATURITIES = [MMAT_PREOPTIMIZED, MMAT_LOCOPT, MMAT_CALLS, MMAT_GLBOPT1]
 DEFAULT_OPTIMIZATION_Z3_MATURITIES = [MMAT_LOCOPT, MMAT_CALLS, MMAT_GLBOPT1]
 DEFAULT_OPTIMIZATION_EARLY_MATURITIES = [MMAT_GENERATED, MMAT_PREOPTIMIZED]
+DEFAULT_OPTIMIZATION_MBA_MATURITIES = [MMAT_PREOPTIMIZED, MMAT_LOCOPT, MMAT_CALLS, MMAT_GLBOPT1]
 DEFAULT_ANALYZER_MATURITIES = [MMAT_PREOPTIMIZED, MMAT_LOCOPT, MMAT_CALLS, MMAT_GLBOPT1]
+DEFAULT_UNOPTIMIZABLE_INSTRUCTION_MEMO_SIZE = 8192
+
+
+class UnoptimizableInstructionMemo(object):
+    # LRU set of (maturity, instruction structural key) for which no instruction rule applied during the current
+    # function, so that Hex-Rays calling us again on the same instruction only costs a lookup.
+    # It must be cleared whenever the set of rules changes.
+    def __init__(self, max_size: int = DEFAULT_UNOPTIMIZABLE_INSTRUCTION_MEMO_SIZE):
+        self.max_size = max_size
+        self.keys: OrderedDict = OrderedDict()
+        self.nb_hits = 0
+
+    def contains(self, memo_key: tuple) -> bool:
+        if memo_key not in self.keys:
+            return False
+        self.keys.move_to_end(memo_key)
+        self.nb_hits += 1
+        return True
+
+    def add(self, memo_key: tuple):
+        self.keys[memo_key] = None
+        self.keys.move_to_end(memo_key)
+        if len(self.keys) > self.max_size:
+            self.keys.popitem(last=False)
+
+    def clear(self):
+        self.keys = OrderedDict()
+        self.nb_hits = 0
 
 
 class InstructionDefUseCollector(mop_visitor_t):
@@ -83,6 +117,9 @@ class InstructionOptimizerManager(optinsn_t):
 
         self.instruction_optimizers = []
         self.optimizer_usage_info = {}
+        self.unoptimizable_ins_memo = UnoptimizableInstructionMemo()
+        # Linear MBA are solved before trying the (many) pattern matching rules
+        self.add_optimizer(MbaOptimizer(DEFAULT_OPTIMIZATION_MBA_MATURITIES, log_dir=self.manager.log_dir))
         self.add_optimizer(PatternOptimizer(DEFAULT_OPTIMIZATION_PATTERN_MATURITIES, log_dir=self.manager.log_dir))
         self.add_optimizer(ChainOptimizer(DEFAULT_OPTIMIZATION_CHAIN_MATURITIES, log_dir=self.manager.log_dir))
         self.add_optimizer(Z3Optimizer(DEFAULT_OPTIMIZATION_Z3_MATURITIES, log_dir=self.manager.log_dir))
@@ -92,6 +129,8 @@ class InstructionOptimizerManager(optinsn_t):
     def func(self, blk: mblock_t, ins: minsn_t) -> bool:
         self.log_info_on_input(blk, ins)
         try:
+            if blk is not None:
+                get_verification_policy().check_maturity(blk.mba)
             optimization_performed = self.optimize(blk, ins)
 
             if not optimization_performed:
@@ -102,7 +141,7 @@ class InstructionOptimizerManager(optinsn_t):
 
                 if blk is not None:
                     blk.mark_lists_dirty()
-                    blk.mba.verify(True)
+                    get_verification_policy().after_rewrite(blk.mba)
 
             return optimization_performed
         except RuntimeError as e:
@@ -111,6 +150,8 @@ class InstructionOptimizerManager(optinsn_t):
         except D810Exception as e:
             optimizer_logger.error("D810Exception while optimizing ins {0} with {1}: {2}"
                                    .format(format_minsn_t(ins), self._last_optimizer_tried, e))
+        if blk is not None:
+            get_verification_policy().on_error(blk.mba)
         return False
 
     def reset_rule_usage_statistic(self):
@@ -157,16 +198,52 @@ class InstructionOptimizerManager(optinsn_t):
         for ins_optimizer in self.instruction_optimizers:
             ins_optimizer.add_rule(rule)
         self.analyzer.add_rule(rule)
+        self.unoptimizable_ins_memo.clear()
+
+    def start_function(self):
+        self.reset_rule_usage_statistic()
+        self.unoptimizable_ins_memo.clear()
 
     def configure(self, generate_z3_code=False, dump_intermediate_microcode=False, **kwargs):
         self.generate_z3_code = generate_z3_code
         self.dump_intermediate_microcode = dump_intermediate_microcode
 
+    @staticmethod
+    def get_memo_key(blk: mblock_t, ins: minsn_t) -> Union[None, tuple]:
+        # Calls (whose destination is a mop_f) and other instructions with mops which are never considered equal
+        # would only fill the memo with keys that can't be found again
+        if ins.opcode in [m_call, m_icall]:
+            return None
+        ins_key = get_minsn_key(ins, with_size=True)
+        if is_unique_key(ins_key):
+            return None
+        return blk.mba.maturity, ins_key
+
     def optimize(self, blk: mblock_t, ins: minsn_t) -> bool:
         # optimizer_log.info("Trying to optimize {0}".format(format_minsn_t(ins)))
+        decompilation_cache = self.manager.decompilation_cache
+        ins_ea = ins.ea
+        rule_names = None
+        memo_key = None
+        if blk is not None:
+            # When replaying a known rewrite plan, only rules which fired previously at this address are tried
+            rule_names = decompilation_cache.get_instruction_rule_names(blk.mba.maturity, ins_ea)
+            decompilation_cache.add_instruction_visit(blk.mba.maturity, ins_ea)
+            if (rule_names is not None) and (len(rule_names) == 0):
+                return False
+            memo_key = self.get_memo_key(blk, ins)
+            if (memo_key is not None) and self.unoptimizable_ins_memo.contains(memo_key):
+                return False
+
+        # The AST of the instruction is shared by all optimizers and the analyzer
+        context = InstructionContext(ins)
+        profiler = get_profiler()
         for ins_optimizer in self.instruction_optimizers:
             self._last_optimizer_tried = ins_optimizer
-            new_ins = ins_optimizer.get_optimized_instruction(blk, ins)
+            start_time = time.perf_counter()
+            new_ins = ins_optimizer.get_optimized_instruction(blk, ins, rule_names, context=context)
+            profiler.record(PROFILE_OPTIMIZER, ins_optimizer.name, ins_optimizer.cur_maturity,
+                            time.perf_counter() - start_time, is_hit=new_ins is not None)
 
             if new_ins is not None:
                 if not check_ins_mop_size_are_ok(new_ins):
@@ -179,6 +256,11 @@ class InstructionOptimizerManager(optinsn_t):
                 else:
                     ins.swap(new_ins)
                     self.optimizer_usage_info[ins_optimizer.name] += 1
+                    if blk is not None:
+                        decompilation_cache.add_instruction_rule(blk.mba.maturity, ins_ea,
+                                                                 ins_optimizer.last_matched_rule_name)
+                        get_verification_policy().add_rewrite(blk.mba, ins_ea, blk.serial, ins_optimizer.name,
+                                                              ins_optimizer.last_matched_rule_name)
                     if self.generate_z3_code:
                         try:
                             log_z3_instructions(new_ins, ins)
@@ -186,7 +268,10 @@ class InstructionOptimizerManager(optinsn_t):
                             pass
                     return True
 
-        self.analyzer.analyze(blk, ins)
+        self.analyzer.analyze(blk, ins, context=context)
+        # When replaying a rewrite plan, only some rules were tried: another rule may still apply
+        if (memo_key is not None) and (rule_names is None):
+            self.unoptimizable_ins_memo.add(memo_key)
         return False
 
 
@@ -212,6 +297,11 @@ class BlockOptimizerManager(optblock_t):
 
     def func(self, blk: mblock_t):
         self.log_info_on_input(blk)
+        try:
+            get_verification_policy().check_maturity(blk.mba)
+        except RuntimeError:
+            # Already logged by the verification policy
+            pass
         nb_patch = self.optimize(blk)
         return nb_patch
 
@@ -237,12 +327,21 @@ class BlockOptimizerManager(optblock_t):
             self.current_maturity = mba.maturity
 
     def optimize(self, blk: mblock_t):
+        decompilation_cache = self.manager.decompilation_cache
+        maturity = blk.mba.maturity
+        decompilation_cache.add_block_visit(maturity)
         for cfg_rule in self.cfg_rules:
+            if decompilation_cache.is_block_rule_skipped(maturity, cfg_rule.name):
+                continue
             if self.check_if_rule_is_activated_for_address(cfg_rule, blk.mba.entry_ea):
+                start_time = time.perf_counter()
                 nb_patch = cfg_rule.optimize(blk)
+                get_profiler().record(PROFILE_BLK_RULE, cfg_rule.name, maturity, time.perf_counter() - start_time,
+                                      is_hit=nb_patch > 0)
                 if nb_patch > 0:
                     optimizer_logger.info("Rule {0} matched: {1} patches".format(cfg_rule.name, nb_patch))
                     self.cfg_rules_usage_info[cfg_rule.name].append(nb_patch)
+                    decompilation_cache.add_block_rule(maturity, cfg_rule.name)
                     return nb_patch
         return 0
 
@@ -269,12 +368,31 @@ class HexraysDecompilationHook(Hexrays_Hooks):
 
     def prolog(self, mba: mbl_array_t, fc, reachable_blocks, decomp_flags) -> "int":
         main_logger.info("Starting decompilation of function at 0x{0:x}".format(mba.entry_ea))
-        self.manager.instruction_optimizer.reset_rule_usage_statistic()
+        self.manager.instruction_optimizer.start_function()
         self.manager.block_optimizer.reset_rule_usage_statistic()
+        self.manager.decompilation_cache.start_function(mba, decomp_flags)
+        get_profiler().start_function(mba.entry_ea)
+        get_z3_budget().start_function(mba.entry_ea)
+        get_verification_policy().start_function()
         return 0
 
     def glbopt(self, mba: mbl_array_t) -> "int":
         main_logger.info("glbopt finished for function at 0x{0:x}".format(mba.entry_ea))
         self.manager.instruction_optimizer.show_rule_usage_statistic()
         self.manager.block_optimizer.show_rule_usage_statistic()
+        z3_budget = get_z3_budget()
+        self.manager.decompilation_cache.end_function(mba, is_complete=z3_budget.nb_unknown_queries == 0)
+        try:
+            get_verification_policy().end_function(mba)
+        except RuntimeError:
+            pass
+        get_z3_query_cache().save()
+        main_logger.debug("{0} instruction optimizations skipped for function at 0x{1:x} (no rule applied before)"
+                          .format(self.manager.instruction_optimizer.unoptimizable_ins_memo.nb_hits, mba.entry_ea))
+        if z3_budget.nb_unknown_queries > 0:
+            main_logger.info("{0} Z3 queries skipped or timed out for function at 0x{1:x} ({2:.2f}s spent in Z3)"
+                             .format(z3_budget.nb_unknown_queries, mba.entry_ea, z3_budget.time_spent))
+        profile_path = get_profiler().end_function(self.manager.log_dir)
+        if profile_path is not None:
+            main_logger.info("Profile of function at 0x{0:x} written in {1}".format(mba.entry_ea, profile_path))
         return 0
@@ -11,6 +11,8 @@ else:
     from PyQt5 import QtCore, QtWidgets, QtGui
 
 from d810.conf import ProjectConfiguration, RuleConfiguration
+from d810.profiler import get_profiler, PROFILE_EXPORT_FORMATS
+from d810.verification import VERIFICATION_POLICIES
 
 logger = logging.getLogger('D810.ui')
 
@@ -53,9 +55,76 @@ class PluginConfigurationFileForm_t(QtWidgets.QDialog):
         self.checkbox_dump_intermediate_microcode = QtWidgets.QCheckBox("Dump functions microcode at each maturity", self)
         self.checkbox_dump_intermediate_microcode.setChecked(self.state.d810_config.get("dump_intermediate_microcode"))
         self.config_layout.addWidget(self.checkbox_dump_intermediate_microcode)
+        self.layout_dump_microcode_functions = QtWidgets.QHBoxLayout()
+        self.lbl_dump_microcode_functions = QtWidgets.QLabel(self)
+        self.lbl_dump_microcode_functions.setText("Only dump functions (comma separated addresses, empty: all): ")
+        self.layout_dump_microcode_functions.addWidget(self.lbl_dump_microcode_functions)
+        self.in_dump_microcode_functions = QtWidgets.QLineEdit(self)
+        self.in_dump_microcode_functions.setText(", ".join(self.state.d810_config.get("dump_microcode_functions")))
+        self.layout_dump_microcode_functions.addWidget(self.in_dump_microcode_functions)
+        self.config_layout.addLayout(self.layout_dump_microcode_functions)
+        self.checkbox_compress_microcode_dumps = QtWidgets.QCheckBox("Store microcode dumps of a function as diffs in a zip archive", self)
+        self.checkbox_compress_microcode_dumps.setChecked(self.state.d810_config.get("compress_microcode_dumps"))
+        self.config_layout.addWidget(self.checkbox_compress_microcode_dumps)
         self.checkbox_erase_logs_on_reload = QtWidgets.QCheckBox("Erase log directory content when plugin is reloaded", self)
         self.checkbox_erase_logs_on_reload.setChecked(self.state.d810_config.get("erase_logs_on_reload"))
         self.config_layout.addWidget(self.checkbox_erase_logs_on_reload)
+        self.checkbox_reload_modules_on_start = QtWidgets.QCheckBox("Reload plugin modules when plugin is restarted (development)", self)
+        self.checkbox_reload_modules_on_start.setChecked(self.state.d810_config.get("reload_modules_on_start"))
+        self.config_layout.addWidget(self.checkbox_reload_modules_on_start)
+        self.checkbox_use_pattern_cache = QtWidgets.QCheckBox("Cache generated rule patterns on disk", self)
+        self.checkbox_use_pattern_cache.setChecked(self.state.d810_config.get("use_pattern_cache"))
+        self.config_layout.addWidget(self.checkbox_use_pattern_cache)
+        self.checkbox_use_decompilation_cache = QtWidgets.QCheckBox("Replay rewrite plans of unchanged functions", self)
+        self.checkbox_use_decompilation_cache.setChecked(self.state.d810_config.get("use_decompilation_cache"))
+        self.config_layout.addWidget(self.checkbox_use_decompilation_cache)
+        self.checkbox_persist_z3_query_cache = QtWidgets.QCheckBox("Save Z3 query results on disk", self)
+        self.checkbox_persist_z3_query_cache.setChecked(self.state.d810_config.get("persist_z3_query_cache"))
+        self.config_layout.addWidget(self.checkbox_persist_z3_query_cache)
+        self.checkbox_use_vectorized_evaluation = QtWidgets.QCheckBox("Test expressions on many inputs with numpy before calling Z3", self)
+        self.checkbox_use_vectorized_evaluation.setChecked(self.state.d810_config.get("use_vectorized_evaluation"))
+        self.config_layout.addWidget(self.checkbox_use_vectorized_evaluation)
+        self.layout_z3_budget = QtWidgets.QHBoxLayout()
+        self.lbl_z3_query_timeout = QtWidgets.QLabel(self)
+        self.lbl_z3_query_timeout.setText("Z3 query timeout in ms (0: no limit): ")
+        self.layout_z3_budget.addWidget(self.lbl_z3_query_timeout)
+        self.spinbox_z3_query_timeout = QtWidgets.QSpinBox(self)
+        self.spinbox_z3_query_timeout.setRange(0, 3600000)
+        self.spinbox_z3_query_timeout.setValue(self.state.d810_config.get("z3_query_timeout_ms"))
+        self.layout_z3_budget.addWidget(self.spinbox_z3_query_timeout)
+        self.lbl_z3_function_budget = QtWidgets.QLabel(self)
+        self.lbl_z3_function_budget.setText("Z3 budget per function in ms (0: no limit): ")
+        self.layout_z3_budget.addWidget(self.lbl_z3_function_budget)
+        self.spinbox_z3_function_budget = QtWidgets.QSpinBox(self)
+        self.spinbox_z3_function_budget.setRange(0, 3600000)
+        self.spinbox_z3_function_budget.setValue(self.state.d810_config.get("z3_function_budget_ms"))
+        self.layout_z3_budget.addWidget(self.spinbox_z3_function_budget)
+        self.config_layout.addLayout(self.layout_z3_budget)
+        self.layout_profiler = QtWidgets.QHBoxLayout()
+        self.checkbox_profile_rules = QtWidgets.QCheckBox("Profile rules of each decompiled function, export format:", self)
+        self.checkbox_profile_rules.setChecked(self.state.d810_config.get("profile_rules"))
+        self.layout_profiler.addWidget(self.checkbox_profile_rules)
+        self.combobox_profile_export_format = QtWidgets.QComboBox(self)
+        self.combobox_profile_export_format.addItems(PROFILE_EXPORT_FORMATS)
+        self.combobox_profile_export_format.setCurrentText(self.state.d810_config.get("profile_export_format"))
+        self.layout_profiler.addWidget(self.combobox_profile_export_format)
+        self.config_layout.addLayout(self.layout_profiler)
+        self.layout_verification = QtWidgets.QHBoxLayout()
+        self.lbl_verification_policy = QtWidgets.QLabel(self)
+        self.lbl_verification_policy.setText("Microcode verification: ")
+        self.layout_verification.addWidget(self.lbl_verification_policy)
+        self.combobox_verification_policy = QtWidgets.QComboBox(self)
+        self.combobox_verification_policy.addItems(VERIFICATION_POLICIES)
+        self.combobox_verification_policy.setCurrentText(self.state.d810_config.get("verification_policy"))
+        self.layout_verification.addWidget(self.combobox_verification_policy)
+        self.lbl_verification_sample_period = QtWidgets.QLabel(self)
+        self.lbl_verification_sample_period.setText("every N rewrites (sampled): ")
+        self.layout_verification.addWidget(self.lbl_verification_sample_period)
+        self.spinbox_verification_sample_period = QtWidgets.QSpinBox(self)
+        self.spinbox_verification_sample_period.setRange(1, 1000000)
+        self.spinbox_verification_sample_period.setValue(self.state.d810_config.get("verification_sample_period"))
+        self.layout_verification.addWidget(self.spinbox_verification_sample_period)
+        self.config_layout.addLayout(self.layout_verification)
 
         self.layout_button = QtWidgets.QHBoxLayout()
         self.button_save = QtWidgets.QPushButton(self)
@@ -84,12 +153,84 @@ class PluginConfigurationFileForm_t(QtWidgets.QDialog):
         if self.log_dir_changed:
             self.state.d810_config.set("log_dir", self.log_dir)
         self.state.d810_config.set("erase_logs_on_reload", self.checkbox_erase_logs_on_reload.isChecked())
+        self.state.d810_config.set("reload_modules_on_start", self.checkbox_reload_modules_on_start.isChecked())
         self.state.d810_config.set("generate_z3_code", self.checkbox_generate_z3_code.isChecked())
         self.state.d810_config.set("dump_intermediate_microcode", self.checkbox_dump_intermediate_microcode.isChecked())
+        dump_microcode_functions = []
+        for func_ea_str in self.in_dump_microcode_functions.text().split(","):
+            func_ea_str = func_ea_str.strip()
+            if func_ea_str == "":
+                continue
+            try:
+                dump_microcode_functions.append("0x{0:x}".format(int(func_ea_str, 16)))
+            except ValueError:
+                logger.warning("Invalid function address '{0}' ignored".format(func_ea_str))
+        self.state.d810_config.set("dump_microcode_functions", dump_microcode_functions)
+        self.state.d810_config.set("compress_microcode_dumps", self.checkbox_compress_microcode_dumps.isChecked())
+        self.state.d810_config.set("use_pattern_cache", self.checkbox_use_pattern_cache.isChecked())
+        self.state.d810_config.set("use_decompilation_cache", self.checkbox_use_decompilation_cache.isChecked())
+        self.state.d810_config.set("persist_z3_query_cache", self.checkbox_persist_z3_query_cache.isChecked())
+        self.state.d810_config.set("use_vectorized_evaluation", self.checkbox_use_vectorized_evaluation.isChecked())
+        self.state.d810_config.set("z3_query_timeout_ms", self.spinbox_z3_query_timeout.value())
+        self.state.d810_config.set("z3_function_budget_ms", self.spinbox_z3_function_budget.value())
+        self.state.d810_config.set("profile_rules", self.checkbox_profile_rules.isChecked())
+        self.state.d810_config.set("profile_export_format", self.combobox_profile_export_format.currentText())
+        self.state.d810_config.set("verification_policy", self.combobox_verification_policy.currentText())
+        self.state.d810_config.set("verification_sample_period", self.spinbox_verification_sample_period.value())
         self.state.d810_config.save()
         self.accept()
 
 
+class ProfileForm_t(QtWidgets.QDialog):
+    COLUMNS = [("Category", "category"), ("Name", "name"), ("Maturity", "maturity"), ("Calls", "nb_calls"),
+               ("Hits", "nb_hits"), ("Hit rate", "hit_rate"), ("Exceptions", "nb_exceptions"),
+               ("Total time (ms)", "total_time"), ("Mean time (ms)", "mean_time")]
+
+    def __init__(self, parent, profile):
+        logger.debug("Initializing ProfileForm_t")
+        super().__init__(parent)
+        self.profile = profile
+        self.resize(1000, 500)
+        self.setWindowTitle("Profile of function {0}".format(self.profile["func_ea"]))
+
+        self.profile_layout = QtWidgets.QVBoxLayout(self)
+        self.lbl_counters = QtWidgets.QLabel(self)
+        self.lbl_counters.setText(", ".join(["{0}: {1} ({2:.1f} ms)".format(name, counter["nb"],
+                                                                            1000 * counter["total_time"])
+                                             for name, counter in self.profile["counters"].items()]))
+        self.profile_layout.addWidget(self.lbl_counters)
+
+        self.table_profile = QtWidgets.QTableWidget(self)
+        self.table_profile.setColumnCount(len(self.COLUMNS))
+        self.table_profile.setHorizontalHeaderLabels([column_name for column_name, _ in self.COLUMNS])
+        self.table_profile.horizontalHeader().setStretchLastSection(True)
+        self.table_profile.verticalHeader().setVisible(False)
+        self.table_profile.setRowCount(len(self.profile["entries"]))
+        for i, entry in enumerate(self.profile["entries"]):
+            for j, (_, field_name) in enumerate(self.COLUMNS):
+                value = entry[field_name]
+                item = QtWidgets.QTableWidgetItem()
+                if field_name in ["total_time", "mean_time"]:
+                    item.setData(QtCore.Qt.DisplayRole, round(1000 * value, 3))
+                elif field_name == "hit_rate":
+                    item.setData(QtCore.Qt.DisplayRole, round(value, 3))
+                elif isinstance(value, int):
+                    item.setData(QtCore.Qt.DisplayRole, value)
+                else:
+                    item.setText(str(value))
+                item.setFlags(QtCore.Qt.ItemIsSelectable | QtCore.Qt.ItemIsEnabled)
+                self.table_profile.setItem(i, j, item)
+        self.table_profile.setSortingEnabled(True)
+        self.table_profile.resizeColumnsToContents()
+        self.profile_layout.addWidget(self.table_profile)
+
+        self.button_close = QtWidgets.QPushButton(self)
+        self.button_close.setText("Close")
+        self.button_close.clicked.connect(self.accept)
+        self.profile_layout.addWidget(self.button_close)
+        self.setLayout(self.profile_layout)
+
+
 class EditConfigurationFileForm_t(QtWidgets.QDialog):
     def __init__(self, parent, state):
         logger.debug("Initializing EditConfigurationFileForm_t")
@@ -201,9 +342,10 @@ class EditConfigurationFileForm_t(QtWidgets.QDialog):
         logger.debug("Calling update_table_ins_rule_selection")
         if activated_ins_rule_config_list is None:
             activated_ins_rule_config_list = []
-        self.table_ins_rule_selection.setRowCount(len(self.state.known_ins_rules))
-        for i, rule in enumerate(self.state.known_ins_rules):
-            rule_config = self._get_rule_config(rule.name, activated_ins_rule_config_list)
+        rule_registry = self.state.ins_rule_registry
+        self.table_ins_rule_selection.setRowCount(len(rule_registry.get_rule_names()))
+        for i, rule_name in enumerate(rule_registry.get_rule_names()):
+            rule_config = self._get_rule_config(rule_name, activated_ins_rule_config_list)
             item = QtWidgets.QTableWidgetItem()
             item.setTextAlignment(QtCore.Qt.AlignCenter)
             if rule_config is not None and rule_config.is_activated:
@@ -212,11 +354,11 @@ class EditConfigurationFileForm_t(QtWidgets.QDialog):
                 item.setCheckState(QtCore.Qt.Unchecked)
             self.table_ins_rule_selection.setItem(i, 0, item)
             item = QtWidgets.QTableWidgetItem()
-            item.setText(rule.name)
+            item.setText(rule_name)
             item.setFlags(QtCore.Qt.ItemIsEnabled)
             self.table_ins_rule_selection.setItem(i, 1, item)
             item = QtWidgets.QTableWidgetItem()
-            item.setText(rule.description)
+            item.setText(rule_registry.get_rule_description(rule_name))
             item.setFlags(QtCore.Qt.ItemIsEnabled)
             self.table_ins_rule_selection.setItem(i, 2, item)
             item = QtWidgets.QTableWidgetItem()
@@ -231,9 +373,10 @@ class EditConfigurationFileForm_t(QtWidgets.QDialog):
         logger.debug("Calling update_table_blk_rule_selection")
         if activated_blk_rule_config_list is None:
             activated_blk_rule_config_list = []
-        self.table_blk_rule_selection.setRowCount(len(self.state.known_blk_rules))
-        for i, rule in enumerate(self.state.known_blk_rules):
-            rule_config = self._get_rule_config(rule.name, activated_blk_rule_config_list)
+        rule_registry = self.state.blk_rule_registry
+        self.table_blk_rule_selection.setRowCount(len(rule_registry.get_rule_names()))
+        for i, rule_name in enumerate(rule_registry.get_rule_names()):
+            rule_config = self._get_rule_config(rule_name, activated_blk_rule_config_list)
             item = QtWidgets.QTableWidgetItem()
             item.setTextAlignment(QtCore.Qt.AlignCenter)
             if rule_config is not None and rule_config.is_activated:
@@ -242,11 +385,11 @@ class EditConfigurationFileForm_t(QtWidgets.QDialog):
                 item.setCheckState(QtCore.Qt.Unchecked)
             self.table_blk_rule_selection.setItem(i, 0, item)
             item = QtWidgets.QTableWidgetItem()
-            item.setText(rule.name)
+            item.setText(rule_name)
             item.setFlags(QtCore.Qt.ItemIsEnabled)
             self.table_blk_rule_selection.setItem(i, 1, item)
             item = QtWidgets.QTableWidgetItem()
-            item.setText(rule.description)
+            item.setText(rule_registry.get_rule_description(rule_name))
             item.setFlags(QtCore.Qt.ItemIsEnabled)
             self.table_blk_rule_selection.setItem(i, 2, item)
             item = QtWidgets.QTableWidgetItem()
@@ -386,6 +529,9 @@ class D810ConfigForm_t(ida_kernwin.PluginForm):
         self.btn_config.clicked.connect(self._configure_plugin)
         btn_split.addWidget(self.btn_config)
 
+        self.btn_profile = QtWidgets.QPushButton('Profile')
+        self.btn_profile.clicked.connect(self._show_profile)
+        btn_split.addWidget(self.btn_profile)
 
         self.btn_start = QtWidgets.QPushButton('Start')
         self.btn_start.clicked.connect(self._start_d810)
@@ -511,6 +657,15 @@ class D810ConfigForm_t(ida_kernwin.PluginForm):
             return
         return
 
+    def _show_profile(self):
+        profile = get_profiler().last_profile
+        if profile is None:
+            ida_kernwin.info("No profile available: enable rule profiling in the configuration, "
+                             "start D-810 and decompile a function")
+            return
+        profiledlg = ProfileForm_t(self.parent, profile)
+        profiledlg.exec_()
+
     def _start_d810(self):
         logger.debug("Calling _start_d810")
         self.state.start_d810()
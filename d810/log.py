@@ -1,24 +1,60 @@
 import os
+import queue
 import shutil
 import logging
 import logging.config
+import logging.handlers
 from pathlib import Path
 
 LOG_CONFIG_FILENAME = "log.ini"
 LOG_FILENAME = "d810.log"
 Z3_TEST_FILENAME = "z3_check_instructions_substitution.py"
 
+# Threads writing log records in files
+log_listeners = []
+
 
 def clear_logs(log_dir):
+    stop_background_logging()
     shutil.rmtree(log_dir, ignore_errors=True)
 
 
+def start_background_logging():
+    # Writing in log files is slow: D810 loggers send their records to a queue and the file handlers are called by a
+    # background thread
+    queue_handler_by_file_handler = {}
+    d810_loggers = [logging.getLogger(name) for name in list(logging.root.manager.loggerDict.keys())
+                    if name == "D810" or name.startswith("D810.")]
+    for d810_logger in d810_loggers:
+        for handler in list(d810_logger.handlers):
+            if not isinstance(handler, logging.FileHandler):
+                continue
+            queue_handler = queue_handler_by_file_handler.get(handler)
+            if queue_handler is None:
+                log_queue = queue.Queue(-1)
+                queue_handler = logging.handlers.QueueHandler(log_queue)
+                listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+                listener.start()
+                log_listeners.append(listener)
+                queue_handler_by_file_handler[handler] = queue_handler
+            d810_logger.removeHandler(handler)
+            d810_logger.addHandler(queue_handler)
+
+
+def stop_background_logging():
+    # Waits until all queued records are written
+    while len(log_listeners) > 0:
+        log_listeners.pop().stop()
+
+
 def configure_loggers(log_dir):
+    stop_background_logging()
     os.makedirs(log_dir, exist_ok=True)
     log_main_file = Path(log_dir) / LOG_FILENAME
     z3_test_file = Path(log_dir) / Z3_TEST_FILENAME
     log_conf_file = Path(__file__).resolve().parent / LOG_CONFIG_FILENAME
     logging.config.fileConfig(log_conf_file.as_posix(), defaults={"default_log_filename": log_main_file.as_posix(),
                                                                   "z3_log_filename": z3_test_file.as_posix()})
+    start_background_logging()
     z3_file_logger = logging.getLogger('D810.z3_test')
     z3_file_logger.info("from z3 import BitVec, BitVecVal, UDiv, URem, LShR, UGT, UGE, ULT, ULE, prove\n\n")
@@ -9,11 +9,12 @@ if TYPE_CHECKING:
     from d810.conf import D810Configuration, ProjectConfiguration
 
 
-# Note that imports are performed directly in the functions so that they are reloaded each time the plugin is restarted
-# This allow to load change code/drop new rules without having to reboot IDA
+# Note that imports are performed directly in the functions so that they can be reloaded when the plugin is restarted
+# (option reload_modules_on_start). This allow to load change code/drop new rules without having to reboot IDA
 d810_state = None
 
 D810_LOG_DIR_NAME = "d810_logs"
+D810_CACHE_DIR_NAME = "d810_cache"
 
 MANAGER_INFO_FILENAME = "manager_info.json"
 logger = logging.getLogger('D810')
@@ -41,6 +42,16 @@ class D810Manager(object):
         self.log_dir = log_dir
         self.config = {}
 
+        from d810.decompilation_cache import DecompilationCache
+        self.use_decompilation_cache = False
+        self.decompilation_cache = DecompilationCache()
+        self.use_profiler = False
+        self.profile_export_format = "json"
+        self.z3_query_timeout = 0
+        self.z3_function_budget = 0
+        self.verification_policy = "always"
+        self.verification_sample_period = 1
+
     def configure(self, **kwargs):
         self.config = kwargs
 
@@ -49,6 +60,18 @@ class D810Manager(object):
         logger.debug("Reloading manager...")
 
         from d810.hexrays_hooks import InstructionOptimizerManager, BlockOptimizerManager, HexraysDecompilationHook
+        from d810.decompilation_cache import get_rules_configuration_key
+        from d810.profiler import get_profiler
+        from d810.z3_utils import get_z3_budget
+        from d810.verification import get_verification_policy
+
+        # Rewrite plans recorded with another rule configuration can't be replayed
+        self.decompilation_cache.reset(self.use_decompilation_cache,
+                                       get_rules_configuration_key(self.instruction_optimizer_rules,
+                                                                   self.block_optimizer_rules, **self.config))
+        get_profiler().configure(self.use_profiler, self.profile_export_format)
+        get_z3_budget().configure(self.z3_query_timeout, self.z3_function_budget)
+        get_verification_policy().configure(self.verification_policy, self.verification_sample_period)
 
         self.instruction_optimizer = InstructionOptimizerManager(self)
         self.instruction_optimizer.configure(**self.instruction_optimizer_config)
@@ -77,6 +100,21 @@ class D810Manager(object):
         self.block_optimizer_rules = [rule for rule in rules]
         self.block_optimizer_config = kwargs
 
+    def configure_decompilation_cache(self, use_decompilation_cache):
+        self.use_decompilation_cache = use_decompilation_cache
+
+    def configure_z3_budget(self, z3_query_timeout=0, z3_function_budget=0):
+        self.z3_query_timeout = z3_query_timeout
+        self.z3_function_budget = z3_function_budget
+
+    def configure_verification(self, verification_policy="always", verification_sample_period=1):
+        self.verification_policy = verification_policy
+        self.verification_sample_period = verification_sample_period
+
+    def configure_profiler(self, use_profiler, profile_export_format="json"):
+        self.use_profiler = use_profiler
+        self.profile_export_format = profile_export_format
+
     def stop(self):
         if self.instruction_optimizer is not None:
             logger.debug("Removing InstructionOptimizer...")
@@ -98,16 +136,41 @@ class D810State(object):
         # Type in IDA Python shell 'from d810.manager import d810_state' to access it
         global d810_state
         d810_state = self
-        reload_all_modules()
+        # Reloading all modules is only useful to test code changes without restarting IDA: it rebuilds the rule
+        # catalogs and loses the rules already instantiated
+        if d810_config.get("reload_modules_on_start"):
+            reload_all_modules()
 
         self.d810_config = d810_config
         self.log_dir = os.path.join(self.d810_config.get("log_dir"), D810_LOG_DIR_NAME)
         self.manager = D810Manager(self.log_dir)
 
-        from d810.optimizers.instructions import KNOWN_INS_RULES
-        from d810.optimizers.flow import KNOWN_BLK_RULES
-        self.known_ins_rules = [x for x in KNOWN_INS_RULES]
-        self.known_blk_rules = [x for x in KNOWN_BLK_RULES]
+        from d810.pattern_cache import set_pattern_cache_dir
+        if self.d810_config.get("use_pattern_cache"):
+            set_pattern_cache_dir(os.path.join(self.d810_config.get("log_dir"), D810_CACHE_DIR_NAME))
+        else:
+            set_pattern_cache_dir(None)
+
+        from d810.hexrays_formatters import set_microcode_dump_functions
+        set_microcode_dump_functions(self.d810_config.get("dump_intermediate_microcode"),
+                                     [int(x, 16) for x in self.d810_config.get("dump_microcode_functions")])
+        from d810.microcode_dump import get_microcode_dump_writer
+        get_microcode_dump_writer().configure(self.d810_config.get("compress_microcode_dumps"))
+
+        from d810.vectorized_ast import set_vectorized_evaluation
+        set_vectorized_evaluation(self.d810_config.get("use_vectorized_evaluation"))
+
+        from d810.z3_utils import get_z3_query_cache, Z3_QUERY_CACHE_FILENAME
+        if self.d810_config.get("persist_z3_query_cache"):
+            get_z3_query_cache().set_cache_path(os.path.join(self.d810_config.get("log_dir"), D810_CACHE_DIR_NAME,
+                                                             Z3_QUERY_CACHE_FILENAME))
+        else:
+            get_z3_query_cache().set_cache_path(None)
+
+        from d810.optimizers.instructions import ins_rule_registry
+        from d810.optimizers.flow import blk_rule_registry
+        self.ins_rule_registry = ins_rule_registry
+        self.blk_rule_registry = blk_rule_registry
 
         self.gui = None
         self.current_project = None
@@ -150,14 +213,15 @@ class D810State(object):
         self.current_ins_rules = []
         self.current_blk_rules = []
 
-        for rule in self.known_ins_rules:
+        # Only the rules used by the project are instantiated, and new instances are created at each load
+        for rule in self.ins_rule_registry.create_rules([rule_conf.name for rule_conf in self.current_project.ins_rules]):
             for rule_conf in self.current_project.ins_rules:
                 if rule.name == rule_conf.name:
                     rule.configure(rule_conf.config)
                     rule.set_log_dir(self.log_dir)
                     self.current_ins_rules.append(rule)
         logger.debug("Instruction rules configured")
-        for blk_rule in self.known_blk_rules:
+        for blk_rule in self.blk_rule_registry.create_rules([rule_conf.name for rule_conf in self.current_project.blk_rules]):
             for rule_conf in self.current_project.blk_rules:
                 if blk_rule.name == rule_conf.name:
                     blk_rule.configure(rule_conf.config)
@@ -167,7 +231,7 @@ class D810State(object):
         self.manager.configure(**self.current_project.additional_configuration)
         logger.debug("Project loaded.")
 
-    def start_d810(self):
+    def start_d810(self, save_config=True):
         print("D-810 ready to deobfuscate...")
         self.manager.configure_instruction_optimizer([rule for rule in self.current_ins_rules],
                                                      generate_z3_code=self.d810_config.get("generate_z3_code"),
@@ -176,9 +240,17 @@ class D810State(object):
                                                      **self.current_project.additional_configuration)
         self.manager.configure_block_optimizer([rule for rule in self.current_blk_rules],
                                                **self.current_project.additional_configuration)
+        self.manager.configure_decompilation_cache(self.d810_config.get("use_decompilation_cache"))
+        self.manager.configure_z3_budget(self.d810_config.get("z3_query_timeout_ms"),
+                                         self.d810_config.get("z3_function_budget_ms"))
+        self.manager.configure_profiler(self.d810_config.get("profile_rules"),
+                                        self.d810_config.get("profile_export_format"))
+        self.manager.configure_verification(self.d810_config.get("verification_policy"),
+                                            self.d810_config.get("verification_sample_period"))
         self.manager.reload()
-        self.d810_config.set("last_project_index", self.current_project_index)
-        self.d810_config.save()
+        if save_config:
+            self.d810_config.set("last_project_index", self.current_project_index)
+            self.d810_config.save()
 
     def stop_d810(self):
         print("Stopping D-810...")
@@ -190,7 +262,9 @@ class D810State(object):
         self.gui.show_windows()
 
     def stop_plugin(self):
+        from d810.microcode_dump import get_microcode_dump_writer
         self.manager.stop()
+        get_microcode_dump_writer().stop()
         if self.gui:
             self.gui.term()
             self.gui = None
@@ -0,0 +1,105 @@
+import os
+import queue
+import difflib
+import logging
+import zipfile
+import threading
+from typing import List, Dict
+
+logger = logging.getLogger('D810.helper')
+
+MICROCODE_DUMP_FILENAME = "{0:x}_maturity_{1}_{2}.log"
+MICROCODE_ARCHIVE_FILENAME = "{0:x}_microcode.zip"
+MICROCODE_ARCHIVE_ENTRY_FILENAME = "{0:04d}_maturity_{1}_{2}.{3}"
+MICROCODE_DUMP_QUEUE_MAX_SIZE = 64
+
+
+class MicrocodeDumpWriter(object):
+    # Microcode dumps are printed on the decompiler thread (IDA API can't be used elsewhere), then written by a
+    # background thread. When compression is enabled, all dumps of a function go in one zip archive: the first dump
+    # is stored as is and the next ones as a diff with the previous dump of the function.
+    # The queue is bounded: if the writer thread is late, the decompiler thread waits instead of keeping all the dumps
+    # in memory.
+    def __init__(self, max_queue_size: int = MICROCODE_DUMP_QUEUE_MAX_SIZE):
+        self.use_compression = False
+        self.dump_queue = queue.Queue(max_queue_size)
+        self.thread = None
+        # Archive path -> (number of entries, name and lines of the last dump), only kept for the last archive written
+        # (i.e. the function being decompiled), so that memory doesn't grow with the number of functions
+        self.archive_states: Dict[str, tuple] = {}
+
+    def configure(self, use_compression: bool = False):
+        self.flush()
+        self.use_compression = use_compression
+        self.archive_states = {}
+
+    def start(self):
+        if (self.thread is not None) and self.thread.is_alive():
+            return
+        self.thread = threading.Thread(target=self._run, name="D810MicrocodeDumpWriter", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if (self.thread is None) or (not self.thread.is_alive()):
+            self.thread = None
+            return
+        self.dump_queue.put(None)
+        self.thread.join()
+        self.thread = None
+        self.archive_states = {}
+
+    def flush(self):
+        if (self.thread is not None) and self.thread.is_alive():
+            self.dump_queue.join()
+
+    def add_dump(self, log_dir_path: str, func_ea: int, maturity: int, name: str, mc_lines: List[str]):
+        self.start()
+        self.dump_queue.put((log_dir_path, func_ea, maturity, name, mc_lines, self.use_compression))
+
+    def _run(self):
+        while True:
+            dump_info = self.dump_queue.get()
+            try:
+                if dump_info is None:
+                    return
+                log_dir_path, func_ea, maturity, name, mc_lines, use_compression = dump_info
+                if use_compression:
+                    self._write_in_archive(log_dir_path, func_ea, maturity, name, mc_lines)
+                else:
+                    self._write_in_file(log_dir_path, func_ea, maturity, name, mc_lines)
+            except Exception as e:
+                # The writer thread must never die: the decompiler thread would wait forever on the queue
+                logger.warning("Can't write microcode dump: {0}".format(e))
+            finally:
+                self.dump_queue.task_done()
+
+    @staticmethod
+    def _write_in_file(log_dir_path: str, func_ea: int, maturity: int, name: str, mc_lines: List[str]):
+        mc_filename = os.path.join(log_dir_path, MICROCODE_DUMP_FILENAME.format(func_ea, maturity, name))
+        with open(mc_filename, "w") as f:
+            f.writelines(mc_lines)
+
+    def _write_in_archive(self, log_dir_path: str, func_ea: int, maturity: int, name: str, mc_lines: List[str]):
+        archive_path = os.path.join(log_dir_path, MICROCODE_ARCHIVE_FILENAME.format(func_ea))
+        archive_state = self.archive_states.get(archive_path)
+        with zipfile.ZipFile(archive_path, "a", compression=zipfile.ZIP_DEFLATED) as archive:
+            if archive_state is None:
+                # Archive written by a previous session: we start again from a full dump
+                nb_entries, last_entry_name, last_mc_lines = len(archive.namelist()), None, None
+            else:
+                nb_entries, last_entry_name, last_mc_lines = archive_state
+            if last_mc_lines is None:
+                entry_name = MICROCODE_ARCHIVE_ENTRY_FILENAME.format(nb_entries, maturity, name, "log")
+                archive.writestr(entry_name, "".join(mc_lines))
+            else:
+                entry_name = MICROCODE_ARCHIVE_ENTRY_FILENAME.format(nb_entries, maturity, name, "diff")
+                archive.writestr(entry_name, "".join(difflib.unified_diff(last_mc_lines, mc_lines,
+                                                                          last_entry_name, entry_name)))
+        self.archive_states = {archive_path: (nb_entries + 1, entry_name, mc_lines)}
+
+
+microcode_dump_writer = MicrocodeDumpWriter()
+
+
+def get_microcode_dump_writer() -> MicrocodeDumpWriter:
+    return microcode_dump_writer
@@ -1,5 +1,8 @@
-from d810.optimizers.flow.flattening import UNFLATTENING_BLK_RULES
-from d810.optimizers.flow.jumps import JUMP_OPTIMIZATION_BLOCK_RULES, JUMP_OPTIMIZATION_RULES
-
-KNOWN_BLK_RULES = UNFLATTENING_BLK_RULES + JUMP_OPTIMIZATION_BLOCK_RULES
+from d810.optimizers.registry import RuleRegistry
+from d810.optimizers.flow.flattening import UNFLATTENING_BLK_RULE_CLASSES
+from d810.optimizers.flow.jumps import JUMP_OPTIMIZATION_RULE_CLASSES, JumpFixer, create_jump_fixer
 
+blk_rule_registry = RuleRegistry()
+for blk_rule_class in UNFLATTENING_BLK_RULE_CLASSES:
+    blk_rule_registry.register(blk_rule_class)
+blk_rule_registry.register(JumpFixer, create_jump_fixer)
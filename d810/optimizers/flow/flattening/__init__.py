@@ -4,5 +4,5 @@ from d810.optimizers.flow.flattening.unflattener_indirect import UnflattenerTigr
 from d810.optimizers.flow.flattening.unflattener_fake_jump import UnflattenerFakeJump
 from d810.optimizers.flow.flattening.fix_pred_cond_jump_block import FixPredecessorOfConditionalJumpBlock
 
-UNFLATTENING_BLK_RULES = [Unflattener(), UnflattenerSwitchCase(), UnflattenerTigressIndirect(), UnflattenerFakeJump(),
-                          FixPredecessorOfConditionalJumpBlock()]
+UNFLATTENING_BLK_RULE_CLASSES = [Unflattener, UnflattenerSwitchCase, UnflattenerTigressIndirect, UnflattenerFakeJump,
+                                FixPredecessorOfConditionalJumpBlock]
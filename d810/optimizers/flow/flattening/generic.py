@@ -1,4 +1,5 @@
 from __future__ import annotations
+import time
 import logging
 from typing import List, Union, Tuple
 
@@ -6,20 +7,41 @@ from ida_hexrays import *
 
 from d810.optimizers.flow.handler import FlowOptimizationRule
 
-from d810.tracker import MopTracker, MopHistory, remove_segment_registers, duplicate_histories
-from d810.emulator import MicroCodeEnvironment, MicroCodeInterpreter
+from d810.tracker import MopTracker, MopHistory, remove_segment_registers, duplicate_histories, \
+    get_mop_tracker_cache
+from d810.emulator import MicroCodeEnvironment, MicroCodeInterpreter, MicroCodeCompiler
 from d810.hexrays_hooks import InstructionDefUseCollector
-from d810.hexrays_helpers import extract_num_mop, get_mop_index, append_mop_if_not_in_list, CONTROL_FLOW_OPCODES, \
-    CONDITIONAL_JUMP_OPCODES
+from d810.hexrays_helpers import extract_num_mop, get_mop_index, get_mop_key, get_minsn_key, \
+    append_mop_if_not_in_list, CONTROL_FLOW_OPCODES, CONDITIONAL_JUMP_OPCODES, AND_TABLE
 from d810.hexrays_formatters import format_minsn_t, format_mop_t, dump_microcode_for_debug, format_mop_list
 from d810.cfg_utils import mba_deep_cleaning, ensure_child_has_an_unconditional_father, ensure_last_block_is_goto, \
     change_1way_block_successor, create_block
 from d810.optimizers.flow.flattening.utils import NotResolvableFatherException, NotDuplicableFatherException, \
     DispatcherUnflatteningException, get_all_possibles_values, check_if_all_values_are_found
+from d810.errors import UnsupportedInstructionException
+from d810.profiler import get_profiler, PROFILE_UNFLATTENING_STEP
+from d810.verification import get_verification_policy
 
 unflat_logger = logging.getLogger('D810.unflat')
 
 
+def get_blocks_fingerprint(mba: mbl_array_t, blk_serials: List[int]) -> Union[None, tuple]:
+    fingerprint = []
+    for blk_serial in blk_serials:
+        if blk_serial >= mba.qty:
+            return None
+        blk = mba.get_mblock(blk_serial)
+        ins_fingerprint = []
+        cur_ins = blk.head
+        while cur_ins is not None:
+            # Operands are part of the fingerprint: instruction rules may rewrite a comparison in place
+            ins_fingerprint.append((cur_ins.ea, get_minsn_key(cur_ins, with_size=True)))
+            cur_ins = cur_ins.next
+        fingerprint.append((blk.start, blk.end, blk.type, tuple([x for x in blk.predset]),
+                            tuple([x for x in blk.succset]), tuple(ins_fingerprint)))
+    return tuple(fingerprint)
+
+
 class GenericDispatcherBlockInfo(object):
 
     def __init__(self, blk, father=None):
@@ -110,6 +132,14 @@ class GenericDispatcherInfo(object):
         self.comparison_values = []
         self.dispatcher_internal_blocks = []
         self.dispatcher_exit_blocks = []
+        # Dispatcher blocks lowered into closures and state values -> (exit block serial, instructions executed).
+        # They stay valid when blocks are inserted before the last block (as done by create_block), unless they
+        # refer to the last block.
+        self.compiled_blocks = {}
+        self.compiled_blocks_mba_qty = None
+        self.is_compilation_supported = True
+        self.target_by_state_values = {}
+        self.is_target_map_built = False
 
     def reset(self):
         self.mop_compared = None
@@ -117,22 +147,55 @@ class GenericDispatcherInfo(object):
         self.comparison_values = []
         self.dispatcher_internal_blocks = []
         self.dispatcher_exit_blocks = []
+        self.invalidate_compiled_blocks()
+
+    def invalidate_compiled_blocks(self):
+        self.compiled_blocks = {}
+        self.compiled_blocks_mba_qty = None
+        self.is_compilation_supported = True
+        self.target_by_state_values = {}
+        self.is_target_map_built = False
+
+    def check_compiled_blocks_validity(self):
+        if self.compiled_blocks_mba_qty == self.mba.qty:
+            return
+        if self.compiled_blocks_mba_qty is not None:
+            previous_last_serial = self.compiled_blocks_mba_qty - 1
+            used_serials = set([target_serial for target_serial, _ in self.target_by_state_values.values()])
+            for compiled_blk in self.compiled_blocks.values():
+                used_serials.add(compiled_blk.serial)
+                used_serials.update(compiled_blk.successor_serials)
+            if previous_last_serial in used_serials:
+                self.invalidate_compiled_blocks()
+        self.compiled_blocks_mba_qty = self.mba.qty
 
     def explore(self, blk: mblock_t) -> bool:
         return False
 
+    def get_internal_block_serials(self) -> set:
+        return set([blk_info.blk.serial for blk_info in self.dispatcher_internal_blocks])
+
+    def get_explored_block_serials(self) -> set:
+        # Blocks whose content may change the result of explore
+        if self.entry_block is None:
+            return set()
+        explored_block_serials = self.get_internal_block_serials()
+        explored_block_serials.update([blk_info.blk.serial for blk_info in self.dispatcher_exit_blocks])
+        explored_block_serials.add(self.entry_block.blk.serial)
+        explored_block_serials.update([x for x in self.entry_block.blk.predset])
+        return explored_block_serials
+
     def get_shared_internal_blocks(self, other_dispatcher: GenericDispatcherInfo) -> List[mblock_t]:
-        my_dispatcher_block_serial = [blk_info.blk.serial for blk_info in self.dispatcher_internal_blocks]
-        other_dispatcher_block_serial = [blk_info.blk.serial
-                                         for blk_info in other_dispatcher.dispatcher_internal_blocks]
-        return [self.mba.get_mblock(blk_serial) for blk_serial in my_dispatcher_block_serial
-                if blk_serial in other_dispatcher_block_serial]
-
-    def is_sub_dispatcher(self, other_dispatcher: GenericDispatcherInfo) -> bool:
-        shared_blocks = self.get_shared_internal_blocks(other_dispatcher)
-        if (len(shared_blocks) > 0) and (self.entry_block.blk.npred() < other_dispatcher.entry_block.blk.npred()):
-            return True
-        return False
+        shared_block_serials = self.get_internal_block_serials() & other_dispatcher.get_internal_block_serials()
+        return [self.mba.get_mblock(blk_serial) for blk_serial in sorted(shared_block_serials)]
+
+    def is_sub_dispatcher(self, other_dispatcher: GenericDispatcherInfo,
+                          other_internal_block_serials: Union[None, set] = None) -> bool:
+        if self.entry_block.blk.npred() >= other_dispatcher.entry_block.blk.npred():
+            return False
+        if other_internal_block_serials is None:
+            other_internal_block_serials = other_dispatcher.get_internal_block_serials()
+        return not self.get_internal_block_serials().isdisjoint(other_internal_block_serials)
 
     def should_emulation_continue(self, cur_blk: mblock_t) -> bool:
         exit_block_serial_list = [exit_block.serial for exit_block in self.dispatcher_exit_blocks]
@@ -140,9 +203,80 @@ class GenericDispatcherInfo(object):
             return True
         return False
 
+    def get_compiled_block(self, blk: mblock_t):
+        self.check_compiled_blocks_validity()
+        compiled_blk = self.compiled_blocks.get(blk.serial)
+        if compiled_blk is None:
+            compiled_blk = MicroCodeCompiler().compile_block(blk)
+            self.compiled_blocks[blk.serial] = compiled_blk
+        return compiled_blk
+
+    def emulate_compiled_dispatcher(self, initial_values: dict) -> Union[None, Tuple[mblock_t, List[minsn_t]]]:
+        # Returns None if the dispatcher can't be executed with compiled blocks
+        self.check_compiled_blocks_validity()
+        if not self.is_compilation_supported:
+            return None
+        values = dict(initial_values)
+        instructions_executed = []
+        cur_blk = self.entry_block.blk
+        try:
+            while self.should_emulation_continue(cur_blk):
+                compiled_blk = self.get_compiled_block(cur_blk)
+                next_serial = compiled_blk.execute(values)
+                instructions_executed += compiled_blk.instructions
+                cur_blk = self.mba.get_mblock(next_serial)
+        except UnsupportedInstructionException as e:
+            unflat_logger.debug("Dispatcher {0} can't be compiled: {1}".format(self.entry_block.serial, e))
+            self.is_compilation_supported = False
+            return None
+        except (KeyError, ZeroDivisionError):
+            # Undefined variable or invalid operation: the interpreter reports where the emulation stops
+            return None
+        return cur_blk, instructions_executed
+
+    def build_state_target_map(self):
+        # The dispatcher is solved once for each of its comparison values, so that most fathers are resolved with a
+        # lookup. Values which are not in the map (e.g. the state variable is transformed before being compared) are
+        # emulated and added to the map.
+        self.check_compiled_blocks_validity()
+        if self.is_target_map_built:
+            return
+        self.is_target_map_built = True
+        if len(self.entry_block.use_before_def_list) != 1:
+            return
+        state_mop = self.entry_block.use_before_def_list[0]
+        state_key = get_mop_key(state_mop)
+        state_mask = AND_TABLE[state_mop.size]
+        for comparison_value in set(self.comparison_values):
+            state_values = (comparison_value & state_mask,)
+            if state_values in self.target_by_state_values.keys():
+                continue
+            compiled_result = self.emulate_compiled_dispatcher({state_key: state_values[0]})
+            if compiled_result is None:
+                if not self.is_compilation_supported:
+                    return
+                continue
+            self.add_state_target(state_values, compiled_result)
+        unflat_logger.debug("Dispatcher {0}: {1} state values resolved without emulation"
+                            .format(self.entry_block.serial, len(self.target_by_state_values)))
+
+    def add_state_target(self, state_values: tuple, emulation_result: Tuple[mblock_t, List[minsn_t]]):
+        target_blk, instructions_executed = emulation_result
+        target_serial = target_blk.serial if target_blk is not None else None
+        self.target_by_state_values[state_values] = (target_serial, instructions_executed)
+
+    def get_state_target(self, state_values: tuple) -> Union[None, Tuple[mblock_t, List[minsn_t]]]:
+        self.build_state_target_map()
+        state_target = self.target_by_state_values.get(state_values)
+        if state_target is None:
+            return None
+        target_serial, instructions_executed = state_target
+        target_blk = self.mba.get_mblock(target_serial) if target_serial is not None else None
+        return target_blk, instructions_executed
+
     def emulate_dispatcher_with_father_history(self, father_history: MopHistory) -> Tuple[mblock_t, List[minsn_t]]:
-        microcode_interpreter = MicroCodeInterpreter()
         microcode_environment = MicroCodeEnvironment()
+        initial_values = {}
         dispatcher_input_info = []
         # First, we setup the MicroCodeEnvironment with the state variables (self.entry_block.use_before_def_list)
         # used by the dispatcher
@@ -154,19 +288,37 @@ class GenericDispatcherInfo(object):
                                                    .format(self.entry_block.serial, father_history.block_serial_path))
             # We store this value in the MicroCodeEnvironment
             microcode_environment.define(initialization_mop, initialization_mop_value)
+            initial_values[get_mop_key(initialization_mop)] = initialization_mop_value & \
+                AND_TABLE[initialization_mop.size]
             dispatcher_input_info.append("{0} = {1:x}".format(format_mop_t(initialization_mop),
                                                               initialization_mop_value))
 
+        state_values = tuple(initial_values.values())
+        state_target = self.get_state_target(state_values)
+        if state_target is not None:
+            unflat_logger.info("Dispatcher {0} resolved with: {1}"
+                               .format(self.entry_block.blk.serial, ", ".join(dispatcher_input_info)))
+            return state_target
+
         unflat_logger.info("Executing dispatcher {0} with: {1}"
                            .format(self.entry_block.blk.serial, ", ".join(dispatcher_input_info)))
 
+        # Dispatcher blocks are executed many times (once per father): they are compiled once into closures, and
+        # interpreted only if they contain instructions which are not supported by the compiler
+        compiled_result = self.emulate_compiled_dispatcher(initial_values)
+        if compiled_result is not None:
+            self.add_state_target(state_values, compiled_result)
+            return compiled_result
+
         # Now, we start the emulation of the code at the dispatcher entry block
+        microcode_interpreter = MicroCodeInterpreter()
         instructions_executed = []
         cur_blk = self.entry_block.blk
         cur_ins = cur_blk.head
         # We will continue emulation while we are in one of the dispatcher blocks
         while self.should_emulation_continue(cur_blk):
-            unflat_logger.debug("  Executing: {0}.{1}".format(cur_blk.serial, format_minsn_t(cur_ins)))
+            if unflat_logger.isEnabledFor(logging.DEBUG):
+                unflat_logger.debug("  Executing: {0}.{1}".format(cur_blk.serial, format_minsn_t(cur_ins)))
             # We evaluate the current instruction of the dispatcher to determine
             # which block and instruction should be executed next
             is_ok = microcode_interpreter.eval_instruction(cur_blk, cur_ins, microcode_environment)
@@ -177,6 +329,7 @@ class GenericDispatcherInfo(object):
             cur_ins = microcode_environment.next_ins
         # We return the first block executed which is not part of the dispatcher
         # and all instructions which have been executed by the dispatcher
+        self.add_state_target(state_values, (cur_blk, instructions_executed))
         return cur_blk, instructions_executed
 
     def print_info(self, verbose=False):
@@ -215,7 +368,11 @@ class GenericDispatcherCollector(minsn_visitor_t):
     def __init__(self):
         super().__init__()
         self.dispatcher_list = []
-        self.explored_blk_serials = []
+        self.explored_blk_serials = set()
+        # Candidate entry block serial -> (explored block serials, fingerprint of these blocks) for candidates which
+        # were explored and rejected. They are not explored again while these blocks don't change.
+        self.rejected_candidates = {}
+        self.rejected_candidates_mba_key = None
         self.dispatcher_min_internal_block = self.DEFAULT_DISPATCHER_MIN_INTERNAL_BLOCK
         self.dispatcher_min_exit_block = self.DEFAULT_DISPATCHER_MIN_EXIT_BLOCK
         self.dispatcher_min_comparison_value = self.DEFAULT_DISPATCHER_MIN_COMPARISON_VALUE
@@ -230,7 +387,7 @@ class GenericDispatcherCollector(minsn_visitor_t):
 
     def specific_checks(self, disp_info: GenericDispatcherInfo) -> bool:
         unflat_logger.debug("DispatcherInfo {0} : {1} internals, {2} exits, {3} comparison"
-                            .format(self.blk.serial, len(disp_info.dispatcher_internal_blocks),
+                            .format(disp_info.entry_block.serial, len(disp_info.dispatcher_internal_blocks),
                                     len(disp_info.dispatcher_exit_blocks), len(set(disp_info.comparison_values))))
         if len(disp_info.dispatcher_internal_blocks) < self.dispatcher_min_internal_block:
             return False
@@ -241,25 +398,64 @@ class GenericDispatcherCollector(minsn_visitor_t):
         self.dispatcher_list.append(disp_info)
         return True
 
-    def visit_minsn(self):
-        if self.blk.serial in self.explored_blk_serials:
-            return 0
-        self.explored_blk_serials.append(self.blk.serial)
-        disp_info = self.DISPATCHER_CLASS(self.blk.mba)
-        is_good_candidate = disp_info.explore(self.blk)
+    def is_rejected_candidate(self, blk: mblock_t) -> bool:
+        rejected_candidate = self.rejected_candidates.get(blk.serial)
+        if rejected_candidate is None:
+            return False
+        explored_block_serials, fingerprint = rejected_candidate
+        if get_blocks_fingerprint(blk.mba, explored_block_serials) == fingerprint:
+            return True
+        del self.rejected_candidates[blk.serial]
+        return False
+
+    def add_rejected_candidate(self, blk: mblock_t, disp_info: GenericDispatcherInfo):
+        # Candidates rejected before being explored are cheap to check again
+        explored_block_serials = sorted(disp_info.get_explored_block_serials())
+        if len(explored_block_serials) == 0:
+            return
+        self.rejected_candidates[blk.serial] = (explored_block_serials,
+                                                get_blocks_fingerprint(blk.mba, explored_block_serials))
+
+    def visit_block(self, blk: mblock_t):
+        if blk.serial in self.explored_blk_serials:
+            return
+        self.explored_blk_serials.add(blk.serial)
+        if self.is_rejected_candidate(blk):
+            return
+        disp_info = self.DISPATCHER_CLASS(blk.mba)
+        is_good_candidate = disp_info.explore(blk)
         if not is_good_candidate:
-            return 0
+            self.add_rejected_candidate(blk, disp_info)
+            return
         if not self.specific_checks(disp_info):
-            return 0
+            self.add_rejected_candidate(blk, disp_info)
+            return
         self.dispatcher_list.append(disp_info)
+
+    def visit_minsn(self):
+        self.visit_block(self.blk)
         return 0
 
+    def collect(self, mba: mbl_array_t):
+        # Same as mba.for_all_topinsns(self), but each block is visited once instead of once per instruction
+        mba_key = (mba.entry_ea, mba.maturity)
+        if mba_key != self.rejected_candidates_mba_key:
+            self.rejected_candidates = {}
+            self.rejected_candidates_mba_key = mba_key
+        for blk_serial in range(mba.qty):
+            blk = mba.get_mblock(blk_serial)
+            if blk.head is None:
+                continue
+            self.visit_block(blk)
+
     def remove_sub_dispatchers(self):
         main_dispatcher_list = []
+        internal_block_serials_list = [dispatcher.get_internal_block_serials() for dispatcher in self.dispatcher_list]
         for dispatcher_1 in self.dispatcher_list:
             is_dispatcher_1_sub_dispatcher = False
-            for dispatcher_2 in self.dispatcher_list:
-                if dispatcher_1.is_sub_dispatcher(dispatcher_2):
+            for dispatcher_2, dispatcher_2_internal_block_serials in zip(self.dispatcher_list,
+                                                                          internal_block_serials_list):
+                if dispatcher_1.is_sub_dispatcher(dispatcher_2, dispatcher_2_internal_block_serials):
                     is_dispatcher_1_sub_dispatcher = True
                     break
             if not is_dispatcher_1_sub_dispatcher:
@@ -268,7 +464,7 @@ class GenericDispatcherCollector(minsn_visitor_t):
 
     def reset(self):
         self.dispatcher_list = []
-        self.explored_blk_serials = []
+        self.explored_blk_serials = set()
 
     def get_dispatcher_list(self) -> List[GenericDispatcherInfo]:
         self.remove_sub_dispatchers()
@@ -287,6 +483,8 @@ class GenericUnflatteningRule(FlowOptimizationRule):
         self.maturities = self.DEFAULT_UNFLATTENING_MATURITIES
 
     def check_if_rule_should_be_used(self, blk: mblock_t) -> bool:
+        # The CFG may have been modified since the last time trackers were used
+        get_mop_tracker_cache().reset()
         if self.cur_maturity == self.mba.maturity:
             self.cur_maturity_pass += 1
         else:
@@ -312,6 +510,10 @@ class GenericDispatcherUnflatteningRule(GenericUnflatteningRule):
         self.max_passes = self.DEFAULT_MAX_PASSES
         self.non_significant_changes = 0
 
+    def record_step(self, step_name: str, start_time: float, is_hit: bool = False, is_exception: bool = False):
+        get_profiler().record(PROFILE_UNFLATTENING_STEP, "{0}.{1}".format(self.name, step_name), self.cur_maturity,
+                              time.perf_counter() - start_time, is_hit=is_hit, is_exception=is_exception)
+
     def check_if_rule_should_be_used(self, blk: mblock_t) -> bool:
         if not super().check_if_rule_should_be_used(blk):
             return False
@@ -332,7 +534,7 @@ class GenericDispatcherUnflatteningRule(GenericUnflatteningRule):
     def retrieve_all_dispatchers(self):
         self.dispatcher_list = []
         self.dispatcher_collector.reset()
-        self.mba.for_all_topinsns(self.dispatcher_collector)
+        self.dispatcher_collector.collect(self.mba)
         self.dispatcher_list = [x for x in self.dispatcher_collector.get_dispatcher_list()]
 
     def ensure_all_dispatcher_fathers_are_direct(self) -> int:
@@ -410,11 +612,16 @@ class GenericDispatcherUnflatteningRule(GenericUnflatteningRule):
                                                    .format(dispatcher_info.entry_block.serial, dispatcher_father.serial,
                                                            mop_searched_values_list))
 
+        start_time = time.perf_counter()
         target_blk, disp_ins = dispatcher_info.emulate_dispatcher_with_father_history(dispatcher_father_histories[0])
+        self.record_step("emulate_dispatcher", start_time, is_hit=target_blk is not None)
         if target_blk is not None:
             unflat_logger.debug("Unflattening graph: Making {0} goto {1}"
                                 .format(dispatcher_father.serial, target_blk.serial))
             ins_to_copy = [ins for ins in disp_ins if ((ins is not None) and (ins.opcode not in CONTROL_FLOW_OPCODES))]
+            # The father is patched and a block may be inserted before the last block
+            get_mop_tracker_cache().invalidate_blocks([dispatcher_father.serial])
+            get_mop_tracker_cache().invalidate_from_serial(self.mba.qty - 1)
             if len(ins_to_copy) > 0:
                 unflat_logger.info("Instruction copied: {0}: {1}"
                                    .format(len(ins_to_copy),
@@ -425,6 +632,8 @@ class GenericDispatcherUnflatteningRule(GenericUnflatteningRule):
                 change_1way_block_successor(dispatcher_side_effect_blk, target_blk.serial)
             else:
                 change_1way_block_successor(dispatcher_father, target_blk.serial)
+            if dispatcher_father.serial in dispatcher_info.compiled_blocks.keys():
+                dispatcher_info.invalidate_compiled_blocks()
             return 2
 
         raise NotResolvableFatherException("Can't fix block {0}: no block for key: {1}"
@@ -434,6 +643,7 @@ class GenericDispatcherUnflatteningRule(GenericUnflatteningRule):
         total_nb_change = 0
         self.non_significant_changes = ensure_last_block_is_goto(self.mba)
         self.non_significant_changes += self.ensure_all_dispatcher_fathers_are_direct()
+        get_mop_tracker_cache().reset()
         for dispatcher_info in self.dispatcher_list:
             dump_microcode_for_debug(self.mba, self.log_dir, "unflat_{0}_dispatcher_{1}_before_duplication"
                                      .format(self.cur_maturity_pass, dispatcher_info.entry_block.serial))
@@ -442,21 +652,29 @@ class GenericDispatcherUnflatteningRule(GenericUnflatteningRule):
                                        format_mop_list(dispatcher_info.entry_block.use_before_def_list)))
             dispatcher_father_list = [self.mba.get_mblock(x) for x in dispatcher_info.entry_block.blk.predset]
             for dispatcher_father in dispatcher_father_list:
+                start_time = time.perf_counter()
                 try:
-                    total_nb_change += self.ensure_dispatcher_father_is_resolvable(dispatcher_father,
-                                                                                   dispatcher_info.entry_block)
+                    nb_change = self.ensure_dispatcher_father_is_resolvable(dispatcher_father,
+                                                                            dispatcher_info.entry_block)
+                    total_nb_change += nb_change
+                    self.record_step("duplicate_father", start_time, is_hit=nb_change > 0)
                 except NotDuplicableFatherException as e:
+                    self.record_step("duplicate_father", start_time, is_exception=True)
                     unflat_logger.warning(e)
                     pass
             dump_microcode_for_debug(self.mba, self.log_dir, "unflat_{0}_dispatcher_{1}_after_duplication"
                                      .format(self.cur_maturity_pass, dispatcher_info.entry_block.serial))
             # During the previous step we changed dispatcher entry block fathers, so we need to reload them
+            dispatcher_info.invalidate_compiled_blocks()
             dispatcher_father_list = [self.mba.get_mblock(x) for x in dispatcher_info.entry_block.blk.predset]
             nb_flattened_branches = 0
             for dispatcher_father in dispatcher_father_list:
+                start_time = time.perf_counter()
                 try:
                     nb_flattened_branches += self.resolve_dispatcher_father(dispatcher_father, dispatcher_info)
+                    self.record_step("resolve_father", start_time, is_hit=True)
                 except NotResolvableFatherException as e:
+                    self.record_step("resolve_father", start_time, is_exception=True)
                     unflat_logger.warning(e)
                     pass
             dump_microcode_for_debug(self.mba, self.log_dir, "unflat_{0}_dispatcher_{1}_after_unflattening"
@@ -473,7 +691,9 @@ class GenericDispatcherUnflatteningRule(GenericUnflatteningRule):
         self.last_pass_nb_patch_done = 0
         unflat_logger.info("Unflattening at maturity {0} pass {1}".format(self.cur_maturity, self.cur_maturity_pass))
         dump_microcode_for_debug(self.mba, self.log_dir, "unflat_{0}_start".format(self.cur_maturity_pass))
+        start_time = time.perf_counter()
         self.retrieve_all_dispatchers()
+        self.record_step("retrieve_dispatchers", start_time, is_hit=len(self.dispatcher_list) > 0)
         if len(self.dispatcher_list) == 0:
             unflat_logger.info("No dispatcher found at maturity {0}".format(self.mba.maturity))
             return 0
@@ -484,10 +704,14 @@ class GenericDispatcherUnflatteningRule(GenericUnflatteningRule):
             self.last_pass_nb_patch_done = self.remove_flattening()
         unflat_logger.info("Unflattening at maturity {0} pass {1}: {2} changes"
                            .format(self.cur_maturity, self.cur_maturity_pass, self.last_pass_nb_patch_done))
+        start_time = time.perf_counter()
         nb_clean = mba_deep_cleaning(self.mba, False)
+        self.record_step("deep_cleaning", start_time, is_hit=nb_clean > 0)
         dump_microcode_for_debug(self.mba, self.log_dir, "unflat_{0}_after_cleaning".format(self.cur_maturity_pass))
+        verification_policy = get_verification_policy()
         if self.last_pass_nb_patch_done + nb_clean + self.non_significant_changes > 0:
             self.mba.mark_chains_dirty()
             self.mba.optimize_local(0)
-        self.mba.verify(True)
+            verification_policy.add_rewrite(self.mba, self.mba.entry_ea, None, self.__class__.__name__, self.name)
+        verification_policy.after_rewrite(self.mba)
         return self.last_pass_nb_patch_done
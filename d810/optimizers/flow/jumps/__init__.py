@@ -4,8 +4,11 @@ from d810.optimizers.flow.jumps.opaque import *
 from d810.optimizers.flow.jumps.tricks import *
 
 
-JUMP_OPTIMIZATION_RULES = [x() for x in get_all_subclasses(JumpOptimizationRule)]
-jump_fixer = JumpFixer()
-for jump_optimization_rule in JUMP_OPTIMIZATION_RULES:
-    jump_fixer.register_rule(jump_optimization_rule)
-JUMP_OPTIMIZATION_BLOCK_RULES = [jump_fixer]
+JUMP_OPTIMIZATION_RULE_CLASSES = get_all_subclasses(JumpOptimizationRule)
+
+
+def create_jump_fixer() -> JumpFixer:
+    jump_fixer = JumpFixer()
+    for jump_optimization_rule_class in JUMP_OPTIMIZATION_RULE_CLASSES:
+        jump_fixer.register_rule(jump_optimization_rule_class())
+    return jump_fixer
@@ -5,6 +5,7 @@ from typing import Union
 from d810.optimizers.instructions.handler import InstructionOptimizationRule
 from d810.optimizers.instructions.pattern_matching.handler import ast_generator
 from d810.ast import mop_to_ast, AstNode
+from d810.pattern_cache import get_fuzzed_pattern_candidates
 from d810.hexrays_formatters import format_minsn_t, opcode_to_string
 from d810.optimizers.flow.handler import FlowOptimizationRule
 from d810.cfg_utils import make_2way_block_goto, is_conditional_jump, change_2way_block_conditional_successor
@@ -38,22 +39,48 @@ class JumpOptimizationRule(InstructionOptimizationRule):
         super().configure(kwargs)
         if fuzz_pattern is not None:
             self.fuzz_patterns = fuzz_pattern
-        self._generate_pattern_candidates()
+        # Pattern candidates are generated (or loaded from cache) the first time they are needed
+        self._left_pattern_candidates = None
+        self._right_pattern_candidates = None
+
+    @property
+    def left_pattern_candidates(self):
+        if self._left_pattern_candidates is None:
+            self._generate_pattern_candidates()
+        return self._left_pattern_candidates
+
+    @left_pattern_candidates.setter
+    def left_pattern_candidates(self, pattern_candidates):
+        self._left_pattern_candidates = pattern_candidates
+
+    @property
+    def right_pattern_candidates(self):
+        if self._right_pattern_candidates is None:
+            self._generate_pattern_candidates()
+        return self._right_pattern_candidates
+
+    @right_pattern_candidates.setter
+    def right_pattern_candidates(self, pattern_candidates):
+        self._right_pattern_candidates = pattern_candidates
 
     def _generate_pattern_candidates(self):
         self.fuzz_patterns = self.FUZZ_PATTERNS
+        self._left_pattern_candidates = []
+        self._right_pattern_candidates = []
         if self.LEFT_PATTERN is not None:
             self.LEFT_PATTERN.reset_mops()
             if not self.fuzz_patterns:
-                self.left_pattern_candidates = [self.LEFT_PATTERN]
+                self._left_pattern_candidates = [self.LEFT_PATTERN]
             else:
-                self.left_pattern_candidates = ast_generator(self.LEFT_PATTERN)
+                self._left_pattern_candidates = get_fuzzed_pattern_candidates(self, "left", self.LEFT_PATTERN,
+                                                                              ast_generator)
         if self.RIGHT_PATTERN is not None:
             self.RIGHT_PATTERN.reset_mops()
             if not self.fuzz_patterns:
-                self.right_pattern_candidates = [self.RIGHT_PATTERN]
+                self._right_pattern_candidates = [self.RIGHT_PATTERN]
             else:
-                self.right_pattern_candidates = ast_generator(self.RIGHT_PATTERN)
+                self._right_pattern_candidates = get_fuzzed_pattern_candidates(self, "right", self.RIGHT_PATTERN,
+                                                                               ast_generator)
 
     def check_candidate(self, opcode, left_candidate: AstNode, right_candidate: AstNode):
         return False
@@ -130,12 +157,12 @@ class JumpOptimizationRule(InstructionOptimizationRule):
             new_ins.d = new_dst_mop
         return new_ins
 
-    @property
-    def description(self):
-        self.LEFT_PATTERN.reset_mops()
-        self.RIGHT_PATTERN.reset_mops()
-        return "{0}: {1}, {2}".format(",".join([opcode_to_string(x) for x in self.JMP_OPCODES]),
-                                      self.LEFT_PATTERN, self.RIGHT_PATTERN)
+    @classmethod
+    def get_rule_description(cls) -> str:
+        cls.LEFT_PATTERN.reset_mops()
+        cls.RIGHT_PATTERN.reset_mops()
+        return "{0}: {1}, {2}".format(",".join([opcode_to_string(x) for x in cls.JMP_OPCODES]),
+                                      cls.LEFT_PATTERN, cls.RIGHT_PATTERN)
 
 
 class JumpFixer(FlowOptimizationRule):
@@ -23,14 +23,23 @@ class OptimizationRule(object):
         if "maturities" in self.config.keys():
             self.maturities = [string_to_maturity(x) for x in self.config["maturities"]]
 
+    @classmethod
+    def get_rule_name(cls) -> str:
+        if cls.NAME is not None:
+            return cls.NAME
+        return cls.__name__
+
+    @classmethod
+    def get_rule_description(cls) -> str:
+        # Computed from the class, so that the rule catalog can be displayed without instantiating the rules
+        if cls.DESCRIPTION is not None:
+            return cls.DESCRIPTION
+        return "No description available"
+
     @property
     def name(self):
-        if self.NAME is not None:
-            return self.NAME
-        return self.__class__.__name__
+        return self.get_rule_name()
 
     @property
     def description(self):
-        if self.DESCRIPTION is not None:
-            return self.DESCRIPTION
-        return "No description available"
+        return self.get_rule_description()
@@ -1,7 +1,14 @@
-from d810.optimizers.instructions.chain import CHAIN_RULES, ChainOptimizer
-from d810.optimizers.instructions.pattern_matching import PATTERN_MATCHING_RULES, PatternOptimizer
-from d810.optimizers.instructions.z3 import Z3_RULES, Z3Optimizer
-from d810.optimizers.instructions.analysis import INSTRUCTION_ANALYSIS_RULES, InstructionAnalyzer
-from d810.optimizers.instructions.early import EARLY_RULES, EarlyOptimizer
+from d810.optimizers.registry import RuleRegistry
+from d810.optimizers.instructions.chain import CHAIN_RULE_CLASSES, ChainOptimizer
+from d810.optimizers.instructions.pattern_matching import PATTERN_MATCHING_RULE_CLASSES, PatternOptimizer
+from d810.optimizers.instructions.z3 import Z3_RULE_CLASSES, Z3Optimizer
+from d810.optimizers.instructions.analysis import INSTRUCTION_ANALYSIS_RULE_CLASSES, InstructionAnalyzer
+from d810.optimizers.instructions.early import EARLY_RULE_CLASSES, EarlyOptimizer
+from d810.optimizers.instructions.mba import MBA_RULE_CLASSES, MbaOptimizer
 
-KNOWN_INS_RULES = PATTERN_MATCHING_RULES + CHAIN_RULES + Z3_RULES + EARLY_RULES + INSTRUCTION_ANALYSIS_RULES
+KNOWN_INS_RULE_CLASSES = PATTERN_MATCHING_RULE_CLASSES + CHAIN_RULE_CLASSES + Z3_RULE_CLASSES + EARLY_RULE_CLASSES + \
+                         MBA_RULE_CLASSES + INSTRUCTION_ANALYSIS_RULE_CLASSES
+
+ins_rule_registry = RuleRegistry()
+for ins_rule_class in KNOWN_INS_RULE_CLASSES:
+    ins_rule_registry.register(ins_rule_class)
@@ -1,14 +1,18 @@
+import time
 import logging
+from typing import Union
 from ida_hexrays import *
 from d810.hexrays_formatters import format_minsn_t
-from d810.optimizers.instructions.handler import InstructionOptimizer, InstructionOptimizationRule
+from d810.profiler import get_profiler, PROFILE_ANALYSIS_RULE
+from d810.optimizers.instructions.handler import InstructionOptimizer, InstructionOptimizationRule, \
+    InstructionContext
 
 
 optimizer_logger = logging.getLogger('D810.optimizer')
 
 
 class InstructionAnalysisRule(InstructionOptimizationRule):
-    def analyze_instruction(self, blk, ins):
+    def analyze_instruction(self, blk, ins, ast=None, context=None):
         raise NotImplementedError
 
 
@@ -20,18 +24,28 @@ class InstructionAnalyzer(InstructionOptimizer):
         for rule in self.rules:
             rule.set_maturity(self.cur_maturity)
 
-    def analyze(self, blk: mblock_t, ins: minsn_t):
+    def analyze(self, blk: mblock_t, ins: minsn_t, context: Union[None, InstructionContext] = None):
         if blk is not None:
             self.cur_maturity = blk.mba.maturity
 
         if self.cur_maturity not in self.maturities:
             return None
 
-        for rule in self.rules:
+        if context is None:
+            context = InstructionContext(ins)
+        profiler = get_profiler()
+        for rule in self.get_rules_for_instruction(self.cur_maturity, ins.opcode):
+            tmp = context.ast if rule.USE_AST else None
+            is_hit = False
+            is_exception = False
+            start_time = time.perf_counter()
             try:
-                rule.analyze_instruction(blk, ins)
+                is_hit = rule.analyze_instruction(blk, ins, ast=tmp, context=context) is True
             except RuntimeError:
+                is_exception = True
                 optimizer_logger.error("error during rule {0} for instruction {1}".format(rule, format_minsn_t(ins)))
+            profiler.record(PROFILE_ANALYSIS_RULE, rule.name, self.cur_maturity, time.perf_counter() - start_time,
+                            is_hit=is_hit, is_exception=is_exception)
         return None
 
 
@@ -10,6 +10,7 @@ from d810.optimizers.instructions.analysis.utils import get_possible_patterns
 
 class ExampleGuessingRule(InstructionAnalysisRule):
     DESCRIPTION = "Detect pattern with variable used multiple times and with multiple different opcodes"
+    USE_AST = True
 
     def __init__(self):
         super().__init__()
@@ -55,13 +56,13 @@ class ExampleGuessingRule(InstructionAnalysisRule):
         if self.max_nb_diff_opcodes == -1:
             self.max_nb_diff_opcodes = 0xff
 
-    def analyze_instruction(self, blk, ins):
+    def analyze_instruction(self, blk, ins, ast=None, context=None):
         if self.cur_maturity not in self.maturities:
             return None
         formatted_ins = str(format_minsn_t(ins))
         if formatted_ins in self.cur_ins_guessed:
             return False
-        tmp = minsn_to_ast(ins)
+        tmp = ast if ast is not None else minsn_to_ast(ins)
         if tmp is None:
             return False
         is_good_candidate = self.check_if_possible_pattern(tmp)
@@ -1,12 +1,12 @@
 import logging
 from functools import reduce
+from typing import Union
 from ida_hexrays import *
 
 
 from d810.optimizers.instructions.chain.handler import ChainSimplificationRule
-from d810.hexrays_helpers import equal_bnot_mop, equal_mops_ignore_size, \
-    SUB_TABLE, AND_TABLE
-from d810.hexrays_formatters import format_minsn_t
+from d810.hexrays_helpers import get_mop_key, get_bnot_mop_keys, get_complement_bnot_key, SUB_TABLE, AND_TABLE
+from d810.hexrays_formatters import format_minsn_t, opcode_to_string
 
 rules_chain_logger = logging.getLogger('D810.rules.chain')
 
@@ -66,43 +66,65 @@ class ChainSimplification(object):
             return []
         elif len(self.non_cst_mop_list) == 1:
             return self.non_cst_mop_list
-        else:
-            is_always_0 = False
-            index_removed = []
-            for i in range(len(self.non_cst_mop_list)):
-                for j in range(i + 1, len(self.non_cst_mop_list)):
-                    if (i not in index_removed) and (j not in index_removed):
-                        if equal_mops_ignore_size(self.non_cst_mop_list[i], self.non_cst_mop_list[j]):
-                            if self.opcode == m_xor:
-                                # x ^ x == 0
-                                rules_chain_logger.debug("Doing non cst simplification (xor): {0}, {1} in {2}"
-                                                         .format(i, j, self.formatted_ins))
-                                index_removed += [i, j]
-                            elif self.opcode == m_and:
-                                # x & x == x
-                                rules_chain_logger.debug("Doing non cst simplification (and): {0}, {1} in {2}"
-                                                         .format(i, j, self.formatted_ins))
-                                index_removed += [j]
-                            elif self.opcode == m_or:
-                                # x | x == x
-                                rules_chain_logger.debug("Doing non cst simplification (or): {0}, {1} in {2}"
-                                                         .format(i, j, self.formatted_ins))
-                                index_removed += [j]
-                        elif equal_bnot_mop(self.non_cst_mop_list[i], self.non_cst_mop_list[j]):
-                            if self.opcode == m_and:
-                                is_always_0 = True
-
-            if len(index_removed) == 0 and not is_always_0:
-                return self.non_cst_mop_list
-            final_mop_list = []
-            self._is_instruction_simplified = True
-            if is_always_0:
-                final_mop_list.append(self.create_cst_mop(0, self.res_mop_size))
-                return final_mop_list
-            for i in range(len(self.non_cst_mop_list)):
-                if i not in index_removed:
-                    final_mop_list.append(self.non_cst_mop_list[i])
-            return final_mop_list
+        # Operands are grouped by structural key in one pass instead of being compared pairwise
+        indexes_by_key = {}
+        for i, mop in enumerate(self.non_cst_mop_list):
+            indexes_by_key.setdefault(get_mop_key(mop), []).append(i)
+        index_removed = set()
+        for indexes in indexes_by_key.values():
+            if len(indexes) < 2:
+                continue
+            if self.opcode == m_xor:
+                # x ^ x == 0
+                nb_removed = len(indexes) - (len(indexes) % 2)
+                index_removed.update(indexes[:nb_removed])
+            else:
+                # x & x == x and x | x == x
+                index_removed.update(indexes[1:])
+            rules_chain_logger.debug("Doing non cst simplification ({0}): {1} in {2}"
+                                     .format(opcode_to_string(self.opcode), indexes, self.formatted_ins))
+
+        cst_value = self.get_simplified_bnot_pairs(index_removed)
+        if len(index_removed) == 0 and cst_value is None:
+            return self.non_cst_mop_list
+        self._is_instruction_simplified = True
+        if (cst_value is not None) and (self.opcode in [m_and, m_or]):
+            # x & ~x == 0 and x | ~x == -1: the whole non constant part is replaced
+            return [self.create_cst_mop(cst_value, self.res_mop_size)]
+        if cst_value is not None:
+            self.cst_mop_list.append(self.create_cst_mop(cst_value, self.res_mop_size))
+        return [mop for i, mop in enumerate(self.non_cst_mop_list) if i not in index_removed]
+
+    def get_simplified_bnot_pairs(self, index_removed) -> Union[None, int]:
+        # Looks for operands x and ~x which are not removed yet. Returns the value which replaces the chain (and, or)
+        # or which must be xored with the chain (xor, where pairs are removed), None if there is no such pair.
+        index_by_bnot_key = {}
+        cst_value = None
+        for i, mop in enumerate(self.non_cst_mop_list):
+            if i in index_removed:
+                continue
+            bnot_keys = get_bnot_mop_keys(mop)
+            complement_index = None
+            for bnot_key in bnot_keys:
+                complement_indexes = index_by_bnot_key.get(get_complement_bnot_key(bnot_key), [])
+                complement_indexes = [j for j in complement_indexes if j not in index_removed]
+                if len(complement_indexes) > 0:
+                    complement_index = complement_indexes[0]
+                    break
+            if complement_index is not None:
+                if self.opcode == m_and:
+                    return 0
+                elif self.opcode == m_or:
+                    return AND_TABLE[self.res_mop_size]
+                # x ^ ~x == -1
+                rules_chain_logger.debug("Doing non cst simplification (xor bnot): {0}, {1} in {2}"
+                                         .format(complement_index, i, self.formatted_ins))
+                index_removed.update([complement_index, i])
+                cst_value = (cst_value if cst_value is not None else 0) ^ AND_TABLE[self.res_mop_size]
+                continue
+            for bnot_key in bnot_keys:
+                index_by_bnot_key.setdefault(bnot_key, []).append(i)
+        return cst_value
 
     def simplify(self, ins):
         self.res_mop_size = ins.d.size
@@ -156,14 +178,17 @@ class ChainSimplification(object):
 
 
 class ArithmeticChainSimplification(object):
+    # The add/sub/neg chain is normalized into a linear combination: a coefficient per non constant term (terms are
+    # grouped by structural key, x * c with a constant c counts as c times x) and a list of constants.
     def __init__(self):
         self.formatted_ins = ""
-        self.add_non_cst_mop_list = []
+        self.ins_ea = None
+        self.res_mop_size = None
         self.add_cst_mop_list = []
-        self.sub_non_cst_mop_list = []
         self.sub_cst_mop_list = []
-        self.add_other_cst_list = []
-        self.sub_other_cst_list = []
+        # Structural key -> [coefficient, mop, list of (sign, mop) occurrences in the original chain]
+        self.term_by_key = {}
+        self.nb_non_cst_terms = 0
         self._is_instruction_simplified = False
 
     def add_mop(self, sign, mop):
@@ -184,14 +209,31 @@ class ArithmeticChainSimplification(object):
                 else:
                     self.sub_cst_mop_list.append(mop)
             else:
-                if sign == 0:
-                    self.add_non_cst_mop_list.append(mop)
-                else:
-                    self.sub_non_cst_mop_list.append(mop)
+                self.add_term(sign, mop)
+
+    def add_term(self, sign, mop):
+        coefficient = 1
+        term_mop = mop
+        if (mop.t == mop_d) and (mop.d.opcode == m_mul):
+            if (mop.d.r.t == mop_n) and (mop.d.l.t != mop_n):
+                coefficient, term_mop = mop.d.r.nnn.value, mop.d.l
+            elif (mop.d.l.t == mop_n) and (mop.d.r.t != mop_n):
+                coefficient, term_mop = mop.d.l.nnn.value, mop.d.r
+        term_key = get_mop_key(term_mop)
+        term = self.term_by_key.get(term_key)
+        if term is None:
+            term = [0, term_mop, []]
+            self.term_by_key[term_key] = term
+        term[0] += -coefficient if sign == 1 else coefficient
+        term[2].append((sign, mop))
+        self.nb_non_cst_terms += 1
 
     def do_simplification(self):
         final_add_cst_list, final_sub_cst_list = self.get_simplified_constant()
-        final_add_list, final_sub_list, final_add_cst_mop = self.get_simplified_non_constant()
+        simplified_non_constant = self.get_simplified_non_constant()
+        if simplified_non_constant is None:
+            return None
+        final_add_list, final_sub_list, final_add_cst_mop = simplified_non_constant
         if final_add_cst_mop.nnn.value != 0:
             final_add_cst_list.append(final_add_cst_mop)
         return final_add_list, final_sub_list, final_add_cst_list, final_sub_cst_list
@@ -220,82 +262,88 @@ class ArithmeticChainSimplification(object):
         return [final_cst_mop], []
 
     def get_simplified_non_constant(self):
-        if len(self.add_non_cst_mop_list) == 0 and len(self.sub_non_cst_mop_list) == 0:
-            return [[], []]
-        final_add_list = self.add_non_cst_mop_list
-        final_sub_list = self.sub_non_cst_mop_list
-        index_add_removed = []
-        index_sub_removed = []
-        for (i, add_mop) in enumerate(self.add_non_cst_mop_list):
-            for (j, sub_mop) in enumerate(self.sub_non_cst_mop_list):
-                if (i not in index_add_removed) and (j not in index_sub_removed):
-                    if equal_mops_ignore_size(add_mop, sub_mop):
-                        index_add_removed.append(i)
-                        index_sub_removed.append(j)
-
-        if len(index_add_removed) > 0:
+        final_cst_size = max([term[1].size for term in self.term_by_key.values()] + [self.res_mop_size])
+        final_add_cst_mop = mop_t()
+        if self.nb_non_cst_terms == 0:
+            final_add_cst_mop.make_number(0, final_cst_size)
+            return [], [], final_add_cst_mop
+        cst_value, folded_term_keys = self.fold_bnot_terms()
+        mask = AND_TABLE[self.res_mop_size]
+        final_add_list = []
+        final_sub_list = []
+        for term_key, (coefficient, term_mop, occurrences) in self.term_by_key.items():
+            coefficient = coefficient & mask
+            if coefficient == 0:
+                continue
+            elif coefficient == 1:
+                final_add_list.append(term_mop)
+            elif coefficient == mask:
+                final_sub_list.append(term_mop)
+            elif term_mop.size == self.res_mop_size:
+                if coefficient > (mask >> 1):
+                    final_sub_list.append(self.create_mul_mop(term_mop, (-coefficient) & mask))
+                else:
+                    final_add_list.append(self.create_mul_mop(term_mop, coefficient))
+            elif term_key in folded_term_keys:
+                # The coefficient can't be used with the term size and the original terms are no longer valid
+                return None
+            else:
+                for sign, mop in occurrences:
+                    if sign == 0:
+                        final_add_list.append(mop)
+                    else:
+                        final_sub_list.append(mop)
+        if len(final_add_list) + len(final_sub_list) < self.nb_non_cst_terms:
             self._is_instruction_simplified = True
-            final_add_list = []
-            for i in range(len(self.add_non_cst_mop_list)):
-                if i not in index_add_removed:
-                    final_add_list.append(self.add_non_cst_mop_list[i])
-            final_sub_list = []
-            for i in range(len(self.sub_non_cst_mop_list)):
-                if i not in index_sub_removed:
-                    final_sub_list.append(self.sub_non_cst_mop_list[i])
-
-        final_add_list, final_sub_list, final_add_cst_mop = self.check_bnot_mop(final_add_list, final_sub_list)
+        final_add_cst_mop.make_number(cst_value & AND_TABLE[final_cst_size], final_cst_size)
         return final_add_list, final_sub_list, final_add_cst_mop
 
-    def check_bnot_mop(self, add_non_cst_mop_list, sub_non_cst_mop_list):
-        add_index_removed = []
-        sub_index_removed = []
+    def fold_bnot_terms(self):
+        # ~x == -x - 1, so c1 * x + c2 * ~x == (c1 - c2) * x - c2
         cst_value = 0
-        final_add_non_cst_mop_list = add_non_cst_mop_list
-        final_sub_non_cst_mop_list = sub_non_cst_mop_list
-        add_size_list = [c.size for c in add_non_cst_mop_list]
-        sub_size_list = [c.size for c in sub_non_cst_mop_list]
-        final_cst_size = max(add_size_list + sub_size_list)
-
-        for i in range(len(add_non_cst_mop_list)):
-            for j in range(i + 1, len(add_non_cst_mop_list)):
-                if (i not in add_index_removed) and (j not in add_index_removed):
-                    if equal_bnot_mop(add_non_cst_mop_list[i], add_non_cst_mop_list[j]):
-                        cst_value += AND_TABLE[add_non_cst_mop_list[i].size]
-                        add_index_removed += [i, j]
-
-        for i in range(len(sub_non_cst_mop_list)):
-            for j in range(i + 1, len(sub_non_cst_mop_list)):
-                if (i not in sub_index_removed) and (j not in sub_index_removed):
-                    if equal_bnot_mop(sub_non_cst_mop_list[i], sub_non_cst_mop_list[j]):
-                        cst_value += 1
-                        sub_index_removed += [i, j]
-
-        final_add_cst_mop = mop_t()
-        final_add_cst_mop.make_number(cst_value & AND_TABLE[final_cst_size], final_cst_size)
-
-        if len(add_index_removed) > 0:
-            final_add_non_cst_mop_list = []
-            self._is_instruction_simplified = True
-            for i in range(len(add_non_cst_mop_list)):
-                if i not in add_index_removed:
-                    final_add_non_cst_mop_list.append(add_non_cst_mop_list[i])
-        if len(sub_index_removed) > 0:
-            final_sub_non_cst_mop_list = []
-            self._is_instruction_simplified = True
-            for i in range(len(sub_non_cst_mop_list)):
-                if i not in sub_index_removed:
-                    final_sub_non_cst_mop_list.append(sub_non_cst_mop_list[i])
-        return final_add_non_cst_mop_list, final_sub_non_cst_mop_list, final_add_cst_mop
+        folded_term_keys = set()
+        term_keys_by_bnot_key = {}
+        for term_key, term in self.term_by_key.items():
+            for bnot_key in get_bnot_mop_keys(term[1]):
+                term_keys_by_bnot_key.setdefault(bnot_key, []).append(term_key)
+        for term_key, term in self.term_by_key.items():
+            for bnot_key in get_bnot_mop_keys(term[1]):
+                if (term[0] == 0) or (bnot_key[1] != 1):
+                    continue
+                for other_term_key in term_keys_by_bnot_key.get(get_complement_bnot_key(bnot_key), []):
+                    other_term = self.term_by_key[other_term_key]
+                    if (other_term_key == term_key) or (other_term[0] == 0):
+                        continue
+                    rules_chain_logger.debug("Doing arithmetic bnot simplification in {0}".format(self.formatted_ins))
+                    other_term[0] -= term[0]
+                    cst_value -= term[0]
+                    term[0] = 0
+                    folded_term_keys.update([term_key, other_term_key])
+                    break
+        return cst_value, folded_term_keys
+
+    def create_mul_mop(self, mop, coefficient):
+        new_ins = minsn_t(self.ins_ea)
+        new_ins.opcode = m_mul
+        new_ins.l = mop
+        new_ins.r = mop_t()
+        new_ins.r.make_number(coefficient, self.res_mop_size)
+        new_ins.d = mop_t()
+        new_ins.d.size = self.res_mop_size
+        mul_mop = mop_t()
+        mul_mop.create_from_insn(new_ins)
+        return mul_mop
 
     def simplify(self, ins):
         if ins.opcode not in [m_add, m_sub]:
             return None
         self.formatted_ins = format_minsn_t(ins)
-        self.add_non_cst_mop_list = []
+        self.ins_ea = ins.ea
+        self.res_mop_size = ins.d.size
         self.add_cst_mop_list = []
-        self.sub_non_cst_mop_list = []
         self.sub_cst_mop_list = []
+        self.term_by_key = {}
+        self.nb_non_cst_terms = 0
         self.add_mop(0, ins.l)
         if ins.opcode == m_add:
             self.add_mop(0, ins.r)
@@ -303,9 +351,10 @@ class ArithmeticChainSimplification(object):
             self.add_mop(1, ins.r)
 
         self._is_instruction_simplified = False
-        final_add_list, final_sub_list, final_add_cst_list, final_sub_cst_list = self.do_simplification()
-        if not self._is_instruction_simplified:
+        simplification_result = self.do_simplification()
+        if (simplification_result is None) or (not self._is_instruction_simplified):
             return None
+        final_add_list, final_sub_list, final_add_cst_list, final_sub_cst_list = simplification_result
 
         simplified_ins = self.create_new_chain(ins, final_add_list, final_sub_list, final_add_cst_list, final_sub_cst_list)
 
@@ -342,7 +391,10 @@ class ArithmeticChainSimplification(object):
 class XorChain(ChainSimplificationRule):
     DESCRIPTION = "Remove XOR chains with common terms. E.g. x ^ 4 ^ y ^ 6 ^ 5 ^ x ==> y ^ 7"
 
-    def check_and_replace(self, blk, ins):
+    def get_root_opcodes(self):
+        return [m_xor]
+
+    def check_and_replace(self, blk, ins, ast=None, context=None):
         xor_simplifier = ChainSimplification(m_xor)
         new_ins = xor_simplifier.simplify(ins)
         return new_ins
@@ -351,7 +403,10 @@ class XorChain(ChainSimplificationRule):
 class AndChain(ChainSimplificationRule):
     DESCRIPTION = "Remove AND chains with common terms. E.g. x & 4 & y & 6 & 5 & x ==> x & y & 4"
 
-    def check_and_replace(self, blk, ins):
+    def get_root_opcodes(self):
+        return [m_and]
+
+    def check_and_replace(self, blk, ins, ast=None, context=None):
         and_simplifier = ChainSimplification(m_and)
         new_ins = and_simplifier.simplify(ins)
         return new_ins
@@ -360,7 +415,10 @@ class AndChain(ChainSimplificationRule):
 class OrChain(ChainSimplificationRule):
     DESCRIPTION = "Remove OR chains with common terms. E.g. x | 4 | y | 6 | 5 | x ==> x | y | 7"
 
-    def check_and_replace(self, blk, ins):
+    def get_root_opcodes(self):
+        return [m_or]
+
+    def check_and_replace(self, blk, ins, ast=None, context=None):
         or_simplifier = ChainSimplification(m_or)
         new_ins = or_simplifier.simplify(ins)
         return new_ins
@@ -369,7 +427,10 @@ class OrChain(ChainSimplificationRule):
 class ArithmeticChain(ChainSimplificationRule):
     DESCRIPTION = "Remove arithmetic chains with common terms. E.g. x + 4 + y - (6 + x - 5) ==>  y + 3"
 
-    def check_and_replace(self, blk, ins):
+    def get_root_opcodes(self):
+        return [m_add, m_sub]
+
+    def check_and_replace(self, blk, ins, ast=None, context=None):
         arithmetic_simplifier = ArithmeticChainSimplification()
         new_ins = arithmetic_simplifier.simplify(ins)
         return new_ins
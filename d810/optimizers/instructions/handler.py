@@ -1,24 +1,56 @@
 from __future__ import annotations
+import time
 import logging
-from typing import List
+from typing import List, Union, Tuple
 from ida_hexrays import *
 
 from d810.optimizers.handler import OptimizationRule
 from d810.hexrays_formatters import format_minsn_t
-from d810.ast import minsn_to_ast, AstNode
+from d810.ast import minsn_to_ast, AstNode, AstLeaf, AstInfo
 from d810.errors import D810Exception
+from d810.profiler import get_profiler, PROFILE_INS_RULE
 
 
 d810_logger = logging.getLogger('D810')
 optimizer_logger = logging.getLogger('D810.optimizer')
 
 
+class InstructionContext(object):
+    # Analysis of the instruction being optimized, shared by all instruction optimizers, the analyzer and their rules
+    # during one optimization attempt: the AST and its information are computed at most once, and only if needed
+    def __init__(self, ins: minsn_t):
+        self.ins = ins
+        self._ast = None
+        self._is_ast_built = False
+        self._information = None
+
+    @property
+    def ast(self) -> Union[None, AstNode, AstLeaf]:
+        if not self._is_ast_built:
+            self._ast = minsn_to_ast(self.ins)
+            self._is_ast_built = True
+        return self._ast
+
+    def get_information(self) -> Tuple[List[AstInfo], List[int], List[int]]:
+        # Same as ast.get_information(): leafs info, constant values and opcodes of the AST
+        if self._information is None:
+            self._information = self.ast.get_information() if self.ast is not None else ([], [], [])
+        return self._information
+
+
 class InstructionOptimizationRule(OptimizationRule):
+    # If True, the rule works on the AST of the instruction: the optimizer builds it once and gives it to all rules
+    USE_AST = False
+
     def __init__(self):
         super().__init__()
         self.maturities = []
 
-    def check_and_replace(self, blk, ins):
+    def get_root_opcodes(self) -> Union[None, List[int]]:
+        # Opcodes of the instructions which may be optimized by this rule (None means any instruction)
+        return None
+
+    def check_and_replace(self, blk, ins, ast=None, context: Union[None, InstructionContext] = None):
         return None
 
 
@@ -26,6 +58,7 @@ class GenericPatternRule(InstructionOptimizationRule):
     PATTERN = None
     PATTERNS = None
     REPLACEMENT_PATTERN = None
+    USE_AST = True
 
     def __init__(self):
         super().__init__()
@@ -37,9 +70,18 @@ class GenericPatternRule(InstructionOptimizationRule):
         # Perform rule specific checks
         return False
 
-    def get_valid_candidates(self, instruction: minsn_t, stop_early=True):
+    def get_root_opcodes(self) -> Union[None, List[int]]:
+        root_opcodes = []
+        for candidate_pattern in self.pattern_candidates:
+            if (candidate_pattern is None) or candidate_pattern.is_leaf():
+                return None
+            if candidate_pattern.opcode not in root_opcodes:
+                root_opcodes.append(candidate_pattern.opcode)
+        return root_opcodes
+
+    def get_valid_candidates(self, instruction: minsn_t, stop_early=True, ast: Union[None, AstNode] = None):
         valid_candidates = []
-        tmp = minsn_to_ast(instruction)
+        tmp = ast if ast is not None else minsn_to_ast(instruction)
         if tmp is None:
             return []
         for candidate_pattern in self.pattern_candidates:
@@ -59,22 +101,23 @@ class GenericPatternRule(InstructionOptimizationRule):
         new_ins = self.REPLACEMENT_PATTERN.create_minsn(candidate.ea, candidate.dst_mop)
         return new_ins
 
-    def check_and_replace(self, blk: mblock_t, instruction: minsn_t):
-        valid_candidates = self.get_valid_candidates(instruction, stop_early=True)
+    def check_and_replace(self, blk: mblock_t, instruction: minsn_t, ast: Union[None, AstNode] = None,
+                          context: Union[None, InstructionContext] = None):
+        valid_candidates = self.get_valid_candidates(instruction, stop_early=True, ast=ast)
         if len(valid_candidates) == 0:
             return None
         new_instruction = self.get_replacement(valid_candidates[0])
         return new_instruction
 
-    @property
-    def description(self):
-        if self.DESCRIPTION is not None:
-            return self.DESCRIPTION
-        if (self.PATTERN is None) or (self.REPLACEMENT_PATTERN is None):
+    @classmethod
+    def get_rule_description(cls) -> str:
+        if cls.DESCRIPTION is not None:
+            return cls.DESCRIPTION
+        if (cls.PATTERN is None) or (cls.REPLACEMENT_PATTERN is None):
             return ""
-        self.PATTERN.reset_mops()
-        self.REPLACEMENT_PATTERN.reset_mops()
-        return "{0} => {1}".format(self.PATTERN, self.REPLACEMENT_PATTERN)
+        cls.PATTERN.reset_mops()
+        cls.REPLACEMENT_PATTERN.reset_mops()
+        return "{0} => {1}".format(cls.PATTERN, cls.REPLACEMENT_PATTERN)
 
 
 class InstructionOptimizer(object):
@@ -82,11 +125,15 @@ class InstructionOptimizer(object):
     NAME = None
 
     def __init__(self, maturities: List[int], log_dir=None):
-        self.rules = set()
+        # Rules are tried in the order they were added
+        self.rules = []
         self.rules_usage_info = {}
         self.maturities = maturities
         self.log_dir = log_dir
         self.cur_maturity = MMAT_PREOPTIMIZED
+        self.last_matched_rule_name = None
+        # (maturity, opcode) -> ordered list of rules which may optimize such an instruction, filled lazily
+        self._rules_by_maturity_opcode = {}
 
     def add_rule(self, rule: InstructionOptimizationRule):
         is_valid_rule_class = False
@@ -99,10 +146,27 @@ class InstructionOptimizer(object):
         optimizer_logger.debug("Adding rule {0}".format(rule))
         if len(rule.maturities) == 0:
             rule.maturities = self.maturities
-        self.rules.add(rule)
+        if rule not in self.rules:
+            self.rules.append(rule)
         self.rules_usage_info[rule.name] = 0
+        self._rules_by_maturity_opcode = {}
         return True
 
+    def get_rules_for_instruction(self, maturity: int, opcode: int) -> List[InstructionOptimizationRule]:
+        rules_key = (maturity, opcode)
+        rules = self._rules_by_maturity_opcode.get(rules_key)
+        if rules is None:
+            rules = []
+            for rule in self.rules:
+                if maturity not in rule.maturities:
+                    continue
+                root_opcodes = rule.get_root_opcodes()
+                if (root_opcodes is not None) and (opcode not in root_opcodes):
+                    continue
+                rules.append(rule)
+            self._rules_by_maturity_opcode[rules_key] = rules
+        return rules
+
     def reset_rule_usage_statistic(self):
         self.rules_usage_info = {}
         for rule in self.rules:
@@ -113,26 +177,46 @@ class InstructionOptimizer(object):
             if rule_nb_match > 0:
                 d810_logger.info("Instruction Rule '{0}' has been used {1} times".format(rule_name, rule_nb_match))
 
-    def get_optimized_instruction(self, blk: mblock_t, ins: minsn_t):
+    def get_optimized_instruction(self, blk: mblock_t, ins: minsn_t, rule_names: List[str] = None,
+                                  context: Union[None, InstructionContext] = None):
+        # If rule_names is not None, only rules whose name is in rule_names are tried
         if blk is not None:
             self.cur_maturity = blk.mba.maturity
         # if self.cur_maturity not in self.maturities:
         #     return None
-        for rule in self.rules:
-            if self.cur_maturity not in rule.maturities:
+        # The AST is built at most once (for all optimizers sharing the context), and only if a rule needs it
+        if context is None:
+            context = InstructionContext(ins)
+        profiler = get_profiler()
+        for rule in self.get_rules_for_instruction(self.cur_maturity, ins.opcode):
+            if (rule_names is not None) and (rule.name not in rule_names):
                 continue
+            tmp = None
+            if rule.USE_AST:
+                tmp = context.ast
+                if tmp is None:
+                    continue
+            new_ins = None
+            is_exception = False
+            start_time = time.perf_counter()
             try:
-                new_ins = rule.check_and_replace(blk, ins)
-                if new_ins is not None:
-                    self.rules_usage_info[rule.name] += 1
-                    optimizer_logger.info("Rule {0} matched:".format(rule.name))
-                    optimizer_logger.info("  orig: {0}".format(format_minsn_t(ins)))
-                    optimizer_logger.info("  new : {0}".format(format_minsn_t(new_ins)))
-                    return new_ins
+                new_ins = rule.check_and_replace(blk, ins, ast=tmp, context=context)
             except RuntimeError as e:
+                is_exception = True
                 optimizer_logger.error("Runtime error during rule {0} for instruction {1}: {2}".format(rule, format_minsn_t(ins), e))
             except D810Exception as e:
+                is_exception = True
                 optimizer_logger.error("D810Exception during rule {0} for instruction {1}: {2}".format(rule, format_minsn_t(ins), e))
+            profiler.record(PROFILE_INS_RULE, rule.name, self.cur_maturity, time.perf_counter() - start_time,
+                            is_hit=new_ins is not None, is_exception=is_exception)
+            if new_ins is not None:
+                self.rules_usage_info[rule.name] += 1
+                self.last_matched_rule_name = rule.name
+                if optimizer_logger.isEnabledFor(logging.INFO):
+                    optimizer_logger.info("Rule {0} matched:".format(rule.name))
+                    optimizer_logger.info("  orig: {0}".format(format_minsn_t(ins)))
+                    optimizer_logger.info("  new : {0}".format(format_minsn_t(new_ins)))
+                return new_ins
         return None
 
     @property
@@ -0,0 +1,9 @@
+from d810.optimizers.instructions.handler import InstructionOptimizationRule, InstructionOptimizer
+
+
+class MbaRule(InstructionOptimizationRule):
+    USE_AST = True
+
+
+class MbaOptimizer(InstructionOptimizer):
+    RULE_CLASSES = [MbaRule]
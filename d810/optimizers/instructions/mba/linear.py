@@ -0,0 +1,292 @@
+import random
+import logging
+from typing import List, Dict, Tuple, Union
+from ida_hexrays import *
+
+from d810.optimizers.instructions.mba.handler import MbaRule
+from d810.ast import AstLeaf, AstConstant, AstNode
+from d810.hexrays_helpers import AND_TABLE
+from d810.hexrays_formatters import format_minsn_t
+
+rules_mba_logger = logging.getLogger('D810.rules.mba')
+
+LINEAR_MBA_ROOT_OPCODES = [m_add, m_sub, m_neg, m_mul, m_and, m_or, m_xor, m_bnot]
+BITWISE_TABLE_MAX_NB_VARIABLES = 3
+BITWISE_TABLE_MAX_COST = 16
+
+# Expressions are built as tuples before being converted to AST:
+#   ("x", i) is the i-th variable, ("c", value) a constant and (opcode, left[, right]) an operation
+VARIABLE_EXPRESSION = "x"
+CONSTANT_EXPRESSION = "c"
+
+
+def is_bitwise_expression(ast: Union[AstNode, AstLeaf], size: int) -> bool:
+    if ast.dest_size != size:
+        return False
+    if ast.is_leaf():
+        if ast.is_constant():
+            # Only the constants which are the same on every bit can appear in a bitwise expression
+            return ast.value in [0, AND_TABLE[size]]
+        return True
+    if ast.opcode == m_bnot:
+        return is_bitwise_expression(ast.left, size)
+    if ast.opcode in [m_and, m_or, m_xor]:
+        return is_bitwise_expression(ast.left, size) and is_bitwise_expression(ast.right, size)
+    return False
+
+
+def is_linear_mba_expression(ast: Union[AstNode, AstLeaf], size: int) -> bool:
+    # A linear MBA is a linear combination (with constant coefficients) of bitwise expressions of the variables
+    if ast.dest_size != size:
+        return False
+    if ast.is_leaf():
+        return True
+    if ast.opcode in [m_add, m_sub]:
+        return is_linear_mba_expression(ast.left, size) and is_linear_mba_expression(ast.right, size)
+    if ast.opcode in [m_neg, m_bnot]:
+        return is_linear_mba_expression(ast.left, size)
+    if ast.opcode == m_mul:
+        if ast.left.is_leaf() and ast.left.is_constant():
+            return is_linear_mba_expression(ast.right, size)
+        if ast.right.is_leaf() and ast.right.is_constant():
+            return is_linear_mba_expression(ast.left, size)
+        return False
+    if ast.opcode in [m_and, m_or, m_xor]:
+        return is_bitwise_expression(ast.left, size) and is_bitwise_expression(ast.right, size)
+    return False
+
+
+def get_expression_cost(expr: Tuple) -> int:
+    if expr[0] in [VARIABLE_EXPRESSION, CONSTANT_EXPRESSION]:
+        return 0
+    return 1 + sum(get_expression_cost(operand) for operand in expr[1:])
+
+
+class BitwiseExpressionTable(object):
+    # Smallest bitwise expression (with m_bnot, m_and, m_or and m_xor) of each boolean function of nb_variables
+    # variables. A boolean function is represented by its truth table: bit i is the value of the function when the
+    # variable j is True if and only if bit j of i is set.
+    def __init__(self, nb_variables: int):
+        self.nb_variables = nb_variables
+        self.nb_inputs = 1 << nb_variables
+        self.truth_table_mask = (1 << self.nb_inputs) - 1
+        self.expression_by_truth_table: Dict[int, Tuple] = {}
+        self.cost_by_truth_table: Dict[int, int] = {}
+        self._build()
+
+    def _add(self, truth_table: int, expr: Tuple, cost: int, truth_tables_of_cost: List[int]):
+        if truth_table in self.expression_by_truth_table.keys():
+            return
+        self.expression_by_truth_table[truth_table] = expr
+        self.cost_by_truth_table[truth_table] = cost
+        truth_tables_of_cost.append(truth_table)
+
+    def _build(self):
+        # Expressions are enumerated by increasing number of operations, so the first one found is the smallest
+        truth_tables_by_cost = [[]]
+        for var_index in range(self.nb_variables):
+            truth_table = sum(1 << i for i in range(self.nb_inputs) if (i >> var_index) & 1)
+            self._add(truth_table, (VARIABLE_EXPRESSION, var_index), 0, truth_tables_by_cost[0])
+
+        nb_functions = 1 << self.nb_inputs
+        cost = 0
+        while len(self.expression_by_truth_table) < nb_functions and cost < BITWISE_TABLE_MAX_COST:
+            cost += 1
+            truth_tables_of_cost = []
+            for truth_table in truth_tables_by_cost[cost - 1]:
+                self._add(truth_table ^ self.truth_table_mask,
+                          (m_bnot, self.expression_by_truth_table[truth_table]), cost, truth_tables_of_cost)
+            for left_cost in range(cost):
+                right_cost = cost - 1 - left_cost
+                if left_cost > right_cost:
+                    break
+                for left_truth_table in truth_tables_by_cost[left_cost]:
+                    left_expr = self.expression_by_truth_table[left_truth_table]
+                    for right_truth_table in truth_tables_by_cost[right_cost]:
+                        right_expr = self.expression_by_truth_table[right_truth_table]
+                        self._add(left_truth_table & right_truth_table, (m_and, left_expr, right_expr), cost,
+                                  truth_tables_of_cost)
+                        self._add(left_truth_table | right_truth_table, (m_or, left_expr, right_expr), cost,
+                                  truth_tables_of_cost)
+                        self._add(left_truth_table ^ right_truth_table, (m_xor, left_expr, right_expr), cost,
+                                  truth_tables_of_cost)
+            truth_tables_by_cost.append(truth_tables_of_cost)
+
+    def get_expression(self, truth_table: int) -> Union[None, Tuple]:
+        return self.expression_by_truth_table.get(truth_table & self.truth_table_mask)
+
+
+bitwise_expression_tables: Dict[int, BitwiseExpressionTable] = {}
+
+
+def get_bitwise_expression_table(nb_variables: int) -> BitwiseExpressionTable:
+    # Tables are only built when first needed (the one for 3 variables has 256 entries)
+    table = bitwise_expression_tables.get(nb_variables)
+    if table is None:
+        table = BitwiseExpressionTable(nb_variables)
+        bitwise_expression_tables[nb_variables] = table
+    return table
+
+
+def get_conjunction_expression(var_set: int) -> Tuple:
+    expr = None
+    var_index = 0
+    while var_set != 0:
+        if var_set & 1:
+            var_expr = (VARIABLE_EXPRESSION, var_index)
+            expr = var_expr if expr is None else (m_and, expr, var_expr)
+        var_set >>= 1
+        var_index += 1
+    return expr
+
+
+def get_linear_combination_expression(terms: List[Tuple[int, Tuple]], cst_value: int, size: int) -> Tuple:
+    # terms is a list of (coefficient, bitwise expression): coefficients above half of the range are subtracted
+    mask = AND_TABLE[size]
+    positive_exprs = []
+    negative_exprs = []
+    for coefficient, expr in terms:
+        if coefficient > (mask >> 1):
+            coefficient = (-coefficient) & mask
+            expr_list = negative_exprs
+        else:
+            expr_list = positive_exprs
+        expr_list.append(expr if coefficient == 1 else (m_mul, expr, (CONSTANT_EXPRESSION, coefficient)))
+    if cst_value != 0:
+        if (cst_value > (mask >> 1)) and len(positive_exprs) > 0:
+            negative_exprs.append((CONSTANT_EXPRESSION, (-cst_value) & mask))
+        else:
+            positive_exprs.append((CONSTANT_EXPRESSION, cst_value))
+
+    if len(positive_exprs) == 0:
+        if len(negative_exprs) == 0:
+            return CONSTANT_EXPRESSION, 0
+        res = (m_neg, negative_exprs[0])
+        negative_exprs = negative_exprs[1:]
+    else:
+        res = positive_exprs[0]
+        for expr in positive_exprs[1:]:
+            res = (m_add, res, expr)
+    for expr in negative_exprs:
+        res = (m_sub, res, expr)
+    return res
+
+
+def expression_to_ast(expr: Tuple, var_mops: List[mop_t], size: int) -> Union[AstNode, AstLeaf]:
+    if expr[0] == VARIABLE_EXPRESSION:
+        leaf = AstLeaf("x_{0}".format(expr[1]))
+        leaf.mop = var_mops[expr[1]]
+        return leaf
+    if expr[0] == CONSTANT_EXPRESSION:
+        cst_leaf = AstConstant("c_{0}".format(expr[1]))
+        cst_leaf.mop = mop_t()
+        cst_leaf.mop.make_number(expr[1], size)
+        return cst_leaf
+    if len(expr) == 2:
+        return AstNode(expr[0], expression_to_ast(expr[1], var_mops, size))
+    return AstNode(expr[0], expression_to_ast(expr[1], var_mops, size), expression_to_ast(expr[2], var_mops, size))
+
+
+class LinearMbaSimplification(MbaRule):
+    DESCRIPTION = "Simplify linear MBA expressions by computing their coefficients from their truth table"
+
+    def __init__(self):
+        super().__init__()
+        self.min_nb_opcode = 3
+        self.max_nb_variables = 3
+        self.nb_random_checks = 4
+        self.random = random.Random(0x810)
+
+    def configure(self, kwargs):
+        super().configure(kwargs)
+        if "min_nb_opcode" in kwargs.keys():
+            self.min_nb_opcode = kwargs["min_nb_opcode"]
+        if "max_nb_variables" in kwargs.keys():
+            self.max_nb_variables = kwargs["max_nb_variables"]
+        if "nb_random_checks" in kwargs.keys():
+            self.nb_random_checks = kwargs["nb_random_checks"]
+
+    def get_root_opcodes(self):
+        return LINEAR_MBA_ROOT_OPCODES
+
+    def check_and_replace(self, blk, ins, ast=None, context=None):
+        if (ast is None) or ast.is_leaf():
+            return None
+        leaf_info_list, _, opcodes = context.get_information() if context is not None else ast.get_information()
+        nb_variables = len(leaf_info_list)
+        if (len(opcodes) < self.min_nb_opcode) or (nb_variables == 0) or (nb_variables > self.max_nb_variables):
+            return None
+        size = ast.dest_size
+        if size not in AND_TABLE.keys() or not is_linear_mba_expression(ast, size):
+            return None
+
+        mask = AND_TABLE[size]
+        # A linear MBA is fully determined by its values when each variable is either 0 or -1 (all bits set)
+        signature = []
+        for var_set in range(1 << nb_variables):
+            leafs_value = [mask if (var_set >> i) & 1 else 0 for i in range(nb_variables)]
+            signature.append(ast.evaluate_with_leaf_info(leaf_info_list, leafs_value) & mask)
+        cst_value = signature[0]
+        # expr = cst_value + sum(coefficients[S] * AND(x_i for i in S)), coefficients are found by Mobius inversion
+        coefficients = [(cst_value - value) & mask for value in signature]
+        for i in range(nb_variables):
+            for var_set in range(1 << nb_variables):
+                if (var_set >> i) & 1:
+                    coefficients[var_set] = (coefficients[var_set] - coefficients[var_set ^ (1 << i)]) & mask
+        if not self.check_coefficients(ast, leaf_info_list, coefficients, cst_value, mask):
+            return None
+
+        new_expr = self.get_simplest_expression(signature, coefficients, cst_value, nb_variables, size)
+        if get_expression_cost(new_expr) >= len(opcodes):
+            return None
+        new_ast = expression_to_ast(new_expr, [leaf_info.ast.mop for leaf_info in leaf_info_list], size)
+        if new_ast.is_leaf():
+            new_ast = AstNode(m_mov, new_ast)
+        new_ins = new_ast.create_minsn(ast.ea, ast.dst_mop)
+        if rules_mba_logger.isEnabledFor(logging.DEBUG):
+            rules_mba_logger.debug("Linear MBA {0} simplified to {1}".format(format_minsn_t(ins),
+                                                                              format_minsn_t(new_ins)))
+        return new_ins
+
+    def check_coefficients(self, ast: AstNode, leaf_info_list, coefficients: List[int], cst_value: int,
+                           mask: int) -> bool:
+        # Safety net: the expression built from the coefficients must match the original one on random inputs
+        for _ in range(self.nb_random_checks):
+            leafs_value = [self.random.randint(0, mask) for _ in leaf_info_list]
+            res = cst_value
+            for var_set in range(1, len(coefficients)):
+                if coefficients[var_set] == 0:
+                    continue
+                conjunction_value = mask
+                for i, leaf_value in enumerate(leafs_value):
+                    if (var_set >> i) & 1:
+                        conjunction_value &= leaf_value
+                res += coefficients[var_set] * conjunction_value
+            if (res & mask) != (ast.evaluate_with_leaf_info(leaf_info_list, leafs_value) & mask):
+                rules_mba_logger.warning("Linear MBA check failed for {0}".format(ast))
+                return False
+        return True
+
+    @staticmethod
+    def get_simplest_expression(signature: List[int], coefficients: List[int], cst_value: int, nb_variables: int,
+                                size: int) -> Tuple:
+        mask = AND_TABLE[size]
+        candidates = [get_linear_combination_expression(
+            [(coefficient, get_conjunction_expression(var_set))
+             for var_set, coefficient in enumerate(coefficients) if var_set != 0 and coefficient != 0],
+            cst_value, size)]
+
+        variations = set((cst_value - value) & mask for value in signature)
+        variations.discard(0)
+        if len(variations) == 1 and nb_variables <= BITWISE_TABLE_MAX_NB_VARIABLES:
+            # expr = cst_value + a * e(x) where e is a bitwise expression: e is found in the table of the smallest
+            # bitwise expressions, as well as ~e since a * e == - a - a * ~e
+            coefficient = variations.pop()
+            truth_table = sum(1 << var_set for var_set, value in enumerate(signature) if value != cst_value)
+            table = get_bitwise_expression_table(nb_variables)
+            candidates.append(get_linear_combination_expression(
+                [(coefficient, table.get_expression(truth_table))], cst_value, size))
+            candidates.append(get_linear_combination_expression(
+                [((-coefficient) & mask, table.get_expression(~truth_table))], (cst_value - coefficient) & mask,
+                size))
+        return min(candidates, key=get_expression_cost)
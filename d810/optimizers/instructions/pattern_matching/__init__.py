@@ -14,6 +14,6 @@ from d810.optimizers.instructions.pattern_matching.rewrite_xor import *
 from d810.optimizers.instructions.pattern_matching.weird import *
 from d810.optimizers.instructions.pattern_matching.experimental import *
 
-PATTERN_MATCHING_RULES = [x() for x in get_all_subclasses(PatternMatchingRule)]
+PATTERN_MATCHING_RULE_CLASSES = get_all_subclasses(PatternMatchingRule)
 
 
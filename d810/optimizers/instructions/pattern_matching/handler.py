@@ -1,10 +1,14 @@
+import time
 import logging
 import itertools
 from ida_hexrays import *
-from typing import List, Union
-from d810.optimizers.instructions.handler import GenericPatternRule, InstructionOptimizer, InstructionOptimizationRule
-from d810.ast import minsn_to_ast, AstNode, AstLeaf
+from typing import List, Union, Tuple
+from d810.optimizers.instructions.handler import GenericPatternRule, InstructionOptimizer, InstructionOptimizationRule, \
+    InstructionContext
+from d810.ast import minsn_to_ast, AstNode, AstLeaf, AstConstant
 from d810.hexrays_formatters import format_minsn_t, format_mop_t
+from d810.pattern_cache import get_fuzzed_pattern_candidates
+from d810.profiler import get_profiler, PROFILE_INS_RULE
 
 optimizer_logger = logging.getLogger('D810.optimizer')
 pattern_search_logger = logging.getLogger('D810.pattern_search')
@@ -24,9 +28,20 @@ class PatternMatchingRule(GenericPatternRule):
         super().configure(kwargs)
         if fuzz_pattern is not None:
             self.fuzz_pattern = fuzz_pattern
-        self._generate_pattern_candidates()
-        pattern_search_logger.debug("Rule {0} configured with {1} patterns"
-                                    .format(self.__class__.__name__, len(self.pattern_candidates)))
+        # Pattern candidates are generated (or loaded from cache) the first time they are needed
+        self._pattern_candidates = None
+
+    @property
+    def pattern_candidates(self):
+        if self._pattern_candidates is None:
+            self._generate_pattern_candidates()
+            pattern_search_logger.debug("Rule {0} configured with {1} patterns"
+                                        .format(self.__class__.__name__, len(self._pattern_candidates)))
+        return self._pattern_candidates
+
+    @pattern_candidates.setter
+    def pattern_candidates(self, pattern_candidates):
+        self._pattern_candidates = pattern_candidates
 
     def _generate_pattern_candidates(self):
         self.fuzz_pattern = self.FUZZ_PATTERN
@@ -34,13 +49,13 @@ class PatternMatchingRule(GenericPatternRule):
             self.PATTERN.reset_mops()
         if not self.fuzz_pattern:
             if self.PATTERN is not None:
-                self.pattern_candidates = [self.PATTERN]
+                self._pattern_candidates = [self.PATTERN]
                 if self.PATTERNS is not None:
-                    self.pattern_candidates += [x for x in self.PATTERNS]
+                    self._pattern_candidates += [x for x in self.PATTERNS]
             else:
-                self.pattern_candidates = [x for x in self.PATTERNS]
+                self._pattern_candidates = [x for x in self.PATTERNS]
         else:
-            self.pattern_candidates = ast_generator(self.PATTERN)
+            self._pattern_candidates = get_fuzzed_pattern_candidates(self, "pattern", self.PATTERN, ast_generator)
 
     def check_candidate(self, candidate: AstNode):
         return True
@@ -53,98 +68,109 @@ class PatternMatchingRule(GenericPatternRule):
         new_instruction = self.get_replacement(candidate_pattern)
         return new_instruction
 
+    def check_matched_pattern_and_replace(self, rule_pattern_info: "RulePatternInfo", test_ast: AstNode,
+                                          matched_asts: List[Union[AstNode, AstLeaf]]):
+        candidate_pattern = rule_pattern_info.pattern
+        if not candidate_pattern.copy_mops_from_match(test_ast, rule_pattern_info.leafs, matched_asts):
+            return None
+        if not self.check_candidate(candidate_pattern):
+            return None
+        new_instruction = self.get_replacement(candidate_pattern)
+        return new_instruction
+
 
 class RulePatternInfo(object):
-    def __init__(self, rule, pattern):
+    def __init__(self, rule, pattern, index=0):
         self.rule = rule
         self.pattern = pattern
+        self.leafs = pattern.get_leaf_list()
+        self.index = index
+
+
+PATTERN_LEAF_TOKEN = "L"
+PATTERN_CONSTANT_TOKEN = "C"
 
 
-def signature_generator(ref_sig):
-    for i, x in enumerate(ref_sig):
-        if x not in ["N", "L"]:
-            for sig_suffix in signature_generator(ref_sig[i + 1:]):
-                yield ref_sig[:i] + ["L"] + sig_suffix
-    yield ref_sig
+def get_pattern_tokens(pattern: Union[AstNode, AstLeaf]) -> List:
+    # Preorder serialization of a pattern used as path in the PatternStorage discrimination tree:
+    #  - an AstNode is represented by its opcode and its operand layout, its operands follow
+    #  - an AstConstant matches any constant (or only the expected value if defined)
+    #  - an AstLeaf matches any sub-AST
+    if isinstance(pattern, AstConstant):
+        return [(PATTERN_CONSTANT_TOKEN, pattern.expected_value)]
+    if isinstance(pattern, AstLeaf):
+        return [PATTERN_LEAF_TOKEN]
+    tokens = [(pattern.opcode, pattern.left is not None, pattern.right is not None)]
+    if pattern.left is not None:
+        tokens += get_pattern_tokens(pattern.left)
+    if pattern.right is not None:
+        tokens += get_pattern_tokens(pattern.right)
+    return tokens
 
 
 class PatternStorage(object):
-    # The PatternStorage object is used to store patterns associated to rules
-    # A PatternStorage contains a dictionary (next_layer_patterns) where:
-    #  - keys are the signature of a pattern at a specific depth (i.e. the opcodes, the variable and constant)
-    #  - values are PatternStorage object for the next depth
-    # Additionally, it stores the rule objects which are resolved for the PatternStorage depth
-    def __init__(self, depth=1):
-        self.depth = depth
-        self.next_layer_patterns = {}
+    # The PatternStorage object is a discrimination tree storing all patterns associated to rules:
+    #  - each pattern is inserted using its preorder list of tokens (see get_pattern_tokens)
+    #  - next_nodes is a dictionary where keys are tokens and values are PatternStorage objects for the next token
+    #  - rule_resolved contains the patterns whose token path ends at this node
+    # Matching an AST is done in a single walk of the AST along the tree, so the cost does not depend on the number of
+    # stored patterns. Sub-ASTs matched by the pattern leafs are returned, thus patterns don't need to be checked again.
+    def __init__(self):
+        self.next_nodes = {}
         self.rule_resolved = []
+        self.nb_patterns = 0
 
     def add_pattern_for_rule(self, pattern: AstNode, rule: InstructionOptimizationRule):
-        layer_signature = self.layer_signature_to_key(pattern.get_depth_signature(self.depth))
-        if len(layer_signature.replace(",", "")) == (layer_signature.count("N")):
-            self.rule_resolved.append(RulePatternInfo(rule, pattern))
-        else:
-            if layer_signature not in self.next_layer_patterns.keys():
-                self.next_layer_patterns[layer_signature] = PatternStorage(self.depth + 1)
-            self.next_layer_patterns[layer_signature].add_pattern_for_rule(pattern, rule)
-
-    @staticmethod
-    def layer_signature_to_key(sig: List[str]) -> str:
-        return ",".join(sig)
-
-    @staticmethod
-    def is_layer_signature_compatible(instruction_signature: str, pattern_signature: str) -> bool:
-        if instruction_signature == pattern_signature:
-            return True
-        instruction_node_list = instruction_signature.split(",")
-        pattern_node_list = pattern_signature.split(",")
-        for ins_node_sig, pattern_node_sig in zip(instruction_node_list, pattern_node_list):
-            if pattern_node_sig not in ["L", "C", "N"] and ins_node_sig != pattern_node_sig:
-                return False
-        return True
-
-    def get_matching_rule_pattern_info(self, pattern: AstNode):
-        pattern_search_logger.info("Searching : {0}".format(pattern))
-        return self.explore_one_level(pattern, 1)
-
-    def explore_one_level(self, searched_pattern: AstNode, cur_level: int):
-        # We need to check if searched_pattern is in self.next_layer_patterns
-        # Easy solution: try/except self.next_layer_patterns[searched_pattern]
-        # Problem is that known patterns may not exactly match the microcode instruction, e.g.
-        #   -> Pattern layer 3 signature is ["L", "N", "15", "L"]
-        #   -> Multiple instruction can match that: ["L", "N", "15", "L"], ["C", "N", "15", "L"], ["C", "N", "15", "13"]
-        # This piece of code tries to handles that in a (semi) efficient way
-        if len(self.next_layer_patterns) == 0:
-            return []
-        searched_layer_signature = searched_pattern.get_depth_signature(cur_level)
-        nb_possible_signature = 2 ** (len(searched_layer_signature) - searched_layer_signature.count("N") - \
-                                searched_layer_signature.count("L"))
-        pattern_search_logger.debug("  Layer {0}: {1} -> {2} variations (storage has {3} signature)"
-                                    .format(cur_level, searched_layer_signature, nb_possible_signature,
-                                            len(self.next_layer_patterns)))
-        matched_rule_pattern_info = []
-        if nb_possible_signature < len(self.next_layer_patterns):
-            pattern_search_logger.debug("  => Using method 1")
-            for possible_sig in signature_generator(searched_layer_signature):
-                try:
-                    test_sig = self.layer_signature_to_key(possible_sig)
-                    pattern_storage = self.next_layer_patterns[test_sig]
-                    pattern_search_logger.info("    Compatible signature: {0} -> resolved: {1}"
-                                               .format(test_sig, pattern_storage.rule_resolved))
-                    matched_rule_pattern_info += pattern_storage.rule_resolved
-                    matched_rule_pattern_info += pattern_storage.explore_one_level(searched_pattern, cur_level + 1)
-                except KeyError:
-                    pass
-        else:
-            pattern_search_logger.debug("  => Using method 2")
-            searched_layer_signature_key = self.layer_signature_to_key(searched_layer_signature)
-            for test_sig, pattern_storage in self.next_layer_patterns.items():
-                if self.is_layer_signature_compatible(searched_layer_signature_key, test_sig):
-                    pattern_search_logger.info("    Compatible signature: {0} -> resolved: {1}"
-                                               .format(test_sig, pattern_storage.rule_resolved))
-                    matched_rule_pattern_info += pattern_storage.rule_resolved
-                    matched_rule_pattern_info += pattern_storage.explore_one_level(searched_pattern, cur_level + 1)
-        return matched_rule_pattern_info
+        cur_node = self
+        for token in get_pattern_tokens(pattern):
+            if token not in cur_node.next_nodes.keys():
+                cur_node.next_nodes[token] = PatternStorage()
+            cur_node = cur_node.next_nodes[token]
+        cur_node.rule_resolved.append(RulePatternInfo(rule, pattern, self.nb_patterns))
+        self.nb_patterns += 1
+
+    def get_matching_rule_pattern_info(self, ast: Union[AstNode, AstLeaf]) -> List[Tuple[RulePatternInfo, List]]:
+        # Returns a list of (RulePatternInfo, list of sub-ASTs matched by the pattern leafs), in insertion order
+        matches = []
+        nodes_to_explore = [(self, [ast], [])]
+        while len(nodes_to_explore) > 0:
+            cur_node, remaining_asts, matched_asts = nodes_to_explore.pop()
+            if len(remaining_asts) == 0:
+                for rule_pattern_info in cur_node.rule_resolved:
+                    matches.append((rule_pattern_info, matched_asts))
+                continue
+            cur_ast = remaining_asts[-1]
+            remaining_asts = remaining_asts[:-1]
+
+            next_node = cur_node.next_nodes.get(PATTERN_LEAF_TOKEN)
+            if next_node is not None:
+                nodes_to_explore.append((next_node, remaining_asts, matched_asts + [cur_ast]))
+
+            if cur_ast.is_leaf():
+                if cur_ast.is_constant():
+                    for token in [(PATTERN_CONSTANT_TOKEN, None), (PATTERN_CONSTANT_TOKEN, cur_ast.value)]:
+                        next_node = cur_node.next_nodes.get(token)
+                        if next_node is not None:
+                            nodes_to_explore.append((next_node, remaining_asts, matched_asts + [cur_ast]))
+                continue
+
+            next_node = cur_node.next_nodes.get((cur_ast.opcode, False, False))
+            if next_node is not None:
+                nodes_to_explore.append((next_node, remaining_asts, matched_asts))
+            if cur_ast.left is None:
+                continue
+            next_node = cur_node.next_nodes.get((cur_ast.opcode, True, False))
+            if next_node is not None:
+                nodes_to_explore.append((next_node, remaining_asts + [cur_ast.left], matched_asts))
+            if cur_ast.right is None:
+                continue
+            next_node = cur_node.next_nodes.get((cur_ast.opcode, True, True))
+            if next_node is not None:
+                nodes_to_explore.append((next_node, remaining_asts + [cur_ast.right, cur_ast.left], matched_asts))
+
+        matches.sort(key=lambda x: x[0].index)
+        pattern_search_logger.debug("{0} patterns matched".format(len(matches)))
+        return matches
 
 
 class PatternOptimizer(InstructionOptimizer):
@@ -152,8 +178,7 @@ class PatternOptimizer(InstructionOptimizer):
     # dictionary-like object (PatternStorage) when the plugin is loaded.
     # => it means that we generate a very large number of patterns
     #
-    # At runtime, we transform the microcode instruction in a list of keys that we search in the PatternStorage object
-    # to speed up the checks
+    # At runtime, we walk the AST of the microcode instruction along the PatternStorage discrimination tree
     # => we don't want to test all patterns, so we use the PatternStorage object to (quickly) get the patterns
     # which have the same shape as the microcode instruction
 
@@ -161,7 +186,7 @@ class PatternOptimizer(InstructionOptimizer):
 
     def __init__(self, maturities, log_dir=None):
         super().__init__(maturities, log_dir=log_dir)
-        self.pattern_storage = PatternStorage(depth=1)
+        self.pattern_storage = PatternStorage()
 
     def add_rule(self, rule: InstructionOptimizationRule):
         is_ok = super().add_rule(rule)
@@ -171,28 +196,41 @@ class PatternOptimizer(InstructionOptimizer):
             self.pattern_storage.add_pattern_for_rule(pattern, rule)
         return True
 
-    def get_optimized_instruction(self, blk: mblock_t, ins: minsn_t) -> Union[None, minsn_t]:
+    def get_optimized_instruction(self, blk: mblock_t, ins: minsn_t, rule_names: List[str] = None,
+                                  context: Union[None, InstructionContext] = None) -> Union[None, minsn_t]:
         if blk is not None:
             self.cur_maturity = blk.mba.maturity
         if self.cur_maturity not in self.maturities:
             return None
-        tmp = minsn_to_ast(ins)
+        tmp = context.ast if context is not None else minsn_to_ast(ins)
         if tmp is None:
             return None
 
         all_matchs = self.pattern_storage.get_matching_rule_pattern_info(tmp)
-        for rule_pattern_info in all_matchs:
+        profiler = get_profiler()
+        for rule_pattern_info, matched_asts in all_matchs:
+            rule = rule_pattern_info.rule
+            if (rule_names is not None) and (rule.name not in rule_names):
+                continue
+            new_ins = None
+            is_exception = False
+            start_time = time.perf_counter()
             try:
-                new_ins = rule_pattern_info.rule.check_pattern_and_replace(rule_pattern_info.pattern, tmp)
-                if new_ins is not None:
-                    self.rules_usage_info[rule_pattern_info.rule.name] += 1
-                    optimizer_logger.info("Rule {0} matched:".format(rule_pattern_info.rule.name))
-                    optimizer_logger.info("  orig: {0}".format(format_minsn_t(ins)))
-                    optimizer_logger.info("  new : {0}".format(format_minsn_t(new_ins)))
-                    return new_ins
+                new_ins = rule.check_matched_pattern_and_replace(rule_pattern_info, tmp, matched_asts)
             except RuntimeError as e:
+                is_exception = True
                 optimizer_logger.error("Error during rule {0} for instruction {1}: {2}"
-                                       .format(rule_pattern_info.rule, format_minsn_t(ins), e))
+                                       .format(rule, format_minsn_t(ins), e))
+            profiler.record(PROFILE_INS_RULE, rule.name, self.cur_maturity, time.perf_counter() - start_time,
+                            is_hit=new_ins is not None, is_exception=is_exception)
+            if new_ins is not None:
+                self.rules_usage_info[rule.name] += 1
+                self.last_matched_rule_name = rule.name
+                if optimizer_logger.isEnabledFor(logging.INFO):
+                    optimizer_logger.info("Rule {0} matched:".format(rule.name))
+                    optimizer_logger.info("  orig: {0}".format(format_minsn_t(ins)))
+                    optimizer_logger.info("  new : {0}".format(format_minsn_t(new_ins)))
+                return new_ins
         return None
 
 # AST equivalent pattern generation stuff
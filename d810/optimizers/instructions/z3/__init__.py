@@ -4,4 +4,4 @@ from d810.optimizers.instructions.z3.cst import *
 from d810.optimizers.instructions.z3.predicates import *
 
 
-Z3_RULES = [x() for x in get_all_subclasses(Z3Rule)]
+Z3_RULE_CLASSES = get_all_subclasses(Z3Rule)
@@ -4,6 +4,7 @@ from d810.ast import AstConstant, AstNode
 from d810.ast import minsn_to_ast
 from d810.errors import AstEvaluationException
 from d810.z3_utils import z3_check_mop_equality
+from d810.vectorized_ast import get_constant_candidate
 
 
 class Z3ConstantOptimization(Z3Rule):
@@ -22,19 +23,27 @@ class Z3ConstantOptimization(Z3Rule):
         if "min_nb_constant" in kwargs.keys():
             self.min_nb_constant = kwargs["min_nb_constant"]
 
-    def check_and_replace(self, blk, instruction):
-        tmp = minsn_to_ast(instruction)
+    def check_and_replace(self, blk, instruction, ast=None, context=None):
+        tmp = ast if ast is not None else minsn_to_ast(instruction)
         if tmp is None:
             return None
-        leaf_info_list, cst_leaf_values, opcodes = tmp.get_information()
+        if context is not None:
+            leaf_info_list, cst_leaf_values, opcodes = context.get_information()
+        else:
+            leaf_info_list, cst_leaf_values, opcodes = tmp.get_information()
         if len(leaf_info_list) == 1 and \
                 len(opcodes) >= self.min_nb_opcode and \
                 (len(cst_leaf_values) >= self.min_nb_constant):
             try:
-                val_0 = tmp.evaluate_with_leaf_info(leaf_info_list, [0])
-                val_1 = tmp.evaluate_with_leaf_info(leaf_info_list, [0xffffffff])
+                # Evaluating the AST on many inputs at once rejects most non constant expressions before calling Z3
+                is_evaluated, val_0 = get_constant_candidate(tmp)
+                if not is_evaluated:
+                    val_0 = tmp.evaluate_with_leaf_info(leaf_info_list, [0])
+                    val_1 = tmp.evaluate_with_leaf_info(leaf_info_list, [0xffffffff])
+                    if val_0 != val_1:
+                        val_0 = None
 
-                if val_0 == val_1:
+                if val_0 is not None:
                     c_res_mop = mop_t()
                     c_res_mop.make_number(val_0, tmp.mop.size)
                     is_ok = z3_check_mop_equality(tmp.mop, c_res_mop)
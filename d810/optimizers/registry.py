@@ -0,0 +1,42 @@
+import logging
+from typing import List, Dict, Callable, Union
+
+from d810.optimizers.handler import OptimizationRule
+
+logger = logging.getLogger('D810')
+
+
+class RuleRegistry(object):
+    # Catalog of the rules known by D810. Rules are registered by class and are only instantiated when a project uses
+    # them, so the cost of loading a project depends on the number of rules it enables.
+    # Each project load gets new rule instances: rules keep state (configuration, maturities, counters) which must not
+    # leak from a previous configuration.
+    def __init__(self):
+        self.rule_classes: Dict[str, type] = {}
+        self.rule_factories: Dict[str, Callable[[], OptimizationRule]] = {}
+
+    def register(self, rule_class: type, factory: Union[None, Callable[[], OptimizationRule]] = None):
+        rule_name = rule_class.get_rule_name()
+        if rule_name in self.rule_classes.keys():
+            logger.warning("Rule {0} is already registered, {1} is ignored".format(rule_name, rule_class))
+            return
+        self.rule_classes[rule_name] = rule_class
+        self.rule_factories[rule_name] = factory if factory is not None else rule_class
+
+    def get_rule_names(self) -> List[str]:
+        return list(self.rule_classes.keys())
+
+    def get_rule_description(self, rule_name: str) -> str:
+        return self.rule_classes[rule_name].get_rule_description()
+
+    def create_rule(self, rule_name: str) -> Union[None, OptimizationRule]:
+        rule_factory = self.rule_factories.get(rule_name)
+        if rule_factory is None:
+            logger.warning("Unknown rule {0}".format(rule_name))
+            return None
+        return rule_factory()
+
+    def create_rules(self, rule_names: List[str]) -> List[OptimizationRule]:
+        # Rules are returned in registration order
+        rule_names = set(rule_names)
+        return [self.create_rule(rule_name) for rule_name in self.rule_classes.keys() if rule_name in rule_names]
@@ -0,0 +1,109 @@
+import os
+import json
+import inspect
+import hashlib
+import logging
+from typing import List, Union, Callable
+
+from d810.ast import AstNode, AstLeaf, AstConstant
+
+logger = logging.getLogger('D810.pattern_search')
+
+# Increase this number each time the serialization format (or the way candidates are generated) changes
+PATTERN_CACHE_VERSION = 1
+PATTERN_CACHE_FILE_EXTENSION = ".json"
+
+# If None, pattern candidates are never cached on disk
+pattern_cache_dir = None
+
+
+def set_pattern_cache_dir(cache_dir: Union[None, str]):
+    global pattern_cache_dir
+    pattern_cache_dir = cache_dir
+
+
+def serialize_ast(ast: Union[None, AstNode, AstLeaf]):
+    if ast is None:
+        return None
+    if isinstance(ast, AstConstant):
+        return ["C", ast.name, ast.expected_value, ast.expected_size]
+    if isinstance(ast, AstLeaf):
+        return ["L", ast.name]
+    return ["N", ast.opcode, serialize_ast(ast.left), serialize_ast(ast.right)]
+
+
+def deserialize_ast(data) -> Union[None, AstNode, AstLeaf]:
+    if data is None:
+        return None
+    if data[0] == "C":
+        return AstConstant(data[1], data[2], data[3])
+    if data[0] == "L":
+        return AstLeaf(data[1])
+    return AstNode(data[1], deserialize_ast(data[2]), deserialize_ast(data[3]))
+
+
+def _get_source(obj) -> str:
+    try:
+        return inspect.getsource(obj)
+    except (OSError, TypeError):
+        return ""
+
+
+def get_pattern_cache_key(rule, base_pattern: AstNode, generator: Callable) -> str:
+    # The key changes if the rule code, the pattern to fuzz or the code generating candidates changes
+    key_hash = hashlib.sha256()
+    key_hash.update(str(PATTERN_CACHE_VERSION).encode())
+    key_hash.update(_get_source(rule.__class__).encode())
+    key_hash.update(json.dumps(serialize_ast(base_pattern)).encode())
+    key_hash.update(_get_source(inspect.getmodule(generator)).encode())
+    return key_hash.hexdigest()
+
+
+def get_pattern_cache_path(rule, cache_name: str) -> str:
+    return os.path.join(pattern_cache_dir, "{0}_{1}{2}".format(rule.name, cache_name, PATTERN_CACHE_FILE_EXTENSION))
+
+
+def load_pattern_candidates(cache_path: str, cache_key: str) -> Union[None, List[AstNode]]:
+    try:
+        with open(cache_path, "r") as fp:
+            cache_content = json.load(fp)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning("Can't read pattern cache file '{0}': {1}".format(cache_path, e))
+        return None
+    if cache_content.get("version") != PATTERN_CACHE_VERSION or cache_content.get("key") != cache_key:
+        return None
+    return [deserialize_ast(x) for x in cache_content["candidates"]]
+
+
+def save_pattern_candidates(cache_path: str, cache_key: str, pattern_candidates: List[AstNode]):
+    cache_content = {
+        "version": PATTERN_CACHE_VERSION,
+        "key": cache_key,
+        "candidates": [serialize_ast(x) for x in pattern_candidates]
+    }
+    tmp_cache_path = cache_path + ".tmp"
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with open(tmp_cache_path, "w") as fp:
+            json.dump(cache_content, fp)
+        os.replace(tmp_cache_path, cache_path)
+    except OSError as e:
+        logger.warning("Can't write pattern cache file '{0}': {1}".format(cache_path, e))
+
+
+def get_fuzzed_pattern_candidates(rule, cache_name: str, base_pattern: AstNode,
+                                  generator: Callable[[AstNode], List[AstNode]]) -> List[AstNode]:
+    # Returns generator(base_pattern), using the on-disk cache if it is enabled and up to date
+    if pattern_cache_dir is None:
+        return generator(base_pattern)
+    cache_path = get_pattern_cache_path(rule, cache_name)
+    cache_key = get_pattern_cache_key(rule, base_pattern, generator)
+    pattern_candidates = load_pattern_candidates(cache_path, cache_key)
+    if pattern_candidates is not None:
+        logger.debug("Rule {0}: {1} patterns loaded from cache".format(rule.name, len(pattern_candidates)))
+        return pattern_candidates
+    pattern_candidates = generator(base_pattern)
+    save_pattern_candidates(cache_path, cache_key, pattern_candidates)
+    return pattern_candidates
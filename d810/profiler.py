@@ -0,0 +1,169 @@
+import os
+import csv
+import json
+import logging
+from typing import Union, List, Dict
+
+from d810.hexrays_formatters import maturity_to_string
+
+logger = logging.getLogger('D810')
+
+PROFILE_FILENAME = "profile_{0:x}.{1}"
+PROFILE_EXPORT_FORMATS = ["json", "csv"]
+PROFILE_CSV_FIELDS = ["category", "name", "maturity", "nb_calls", "nb_hits", "hit_rate", "nb_exceptions",
+                      "total_time", "mean_time"]
+
+# Categories of profiled elements
+PROFILE_OPTIMIZER = "ins_optimizer"
+PROFILE_INS_RULE = "ins_rule"
+PROFILE_ANALYSIS_RULE = "analysis_rule"
+PROFILE_BLK_RULE = "blk_rule"
+PROFILE_UNFLATTENING_STEP = "unflattening_step"
+
+# Global counters
+PROFILE_AST_BUILD = "ast_build"
+PROFILE_Z3_SOLVER = "z3_solver"
+PROFILE_Z3_CACHE_HITS = "z3_cache_hits"
+PROFILE_Z3_UNKNOWN = "z3_unknown"
+PROFILE_Z3_PREFILTERED = "z3_prefiltered"
+PROFILE_EMULATOR_STEPS = "emulator_steps"
+PROFILE_MBA_VERIFY = "mba_verify"
+
+
+class ProfileEntry(object):
+    def __init__(self, category: str, name: str, maturity: int):
+        self.category = category
+        self.name = name
+        self.maturity = maturity
+        self.nb_calls = 0
+        self.nb_hits = 0
+        self.nb_exceptions = 0
+        self.total_time = 0.0
+
+    @property
+    def hit_rate(self) -> float:
+        if self.nb_calls == 0:
+            return 0.0
+        return self.nb_hits / self.nb_calls
+
+    def to_dict(self) -> Dict:
+        return {
+            "category": self.category,
+            "name": self.name,
+            "maturity": maturity_to_string(self.maturity) if self.maturity is not None else None,
+            "nb_calls": self.nb_calls,
+            "nb_hits": self.nb_hits,
+            "hit_rate": self.hit_rate,
+            "nb_exceptions": self.nb_exceptions,
+            "total_time": self.total_time,
+            "mean_time": self.total_time / self.nb_calls if self.nb_calls > 0 else 0.0,
+        }
+
+
+class D810Profiler(object):
+    # Collects, for the function being decompiled, the time spent, number of calls, hits and exceptions of each
+    # optimizer/rule at each maturity, as well as global counters (AST build time, Z3 solver time, emulator steps).
+    # When disabled, record methods return immediately.
+    def __init__(self):
+        self.is_enabled = False
+        self.export_format = "json"
+        self.func_ea = None
+        self.entries: Dict[tuple, ProfileEntry] = {}
+        self.counters: Dict[str, Dict[str, Union[int, float]]] = {}
+        self.last_profile: Union[None, Dict] = None
+
+    def configure(self, is_enabled: bool = False, export_format: str = "json"):
+        self.is_enabled = is_enabled
+        if export_format not in PROFILE_EXPORT_FORMATS:
+            logger.warning("Unknown profile export format '{0}', using json".format(export_format))
+            export_format = "json"
+        self.export_format = export_format
+        self.reset()
+
+    def reset(self):
+        self.func_ea = None
+        self.entries = {}
+        self.counters = {}
+
+    def start_function(self, func_ea: int):
+        self.reset()
+        self.func_ea = func_ea
+
+    def end_function(self, log_dir: Union[None, str] = None) -> Union[None, str]:
+        if not self.is_enabled or self.func_ea is None:
+            return None
+        self.last_profile = self.get_profile()
+        if log_dir is None:
+            return None
+        profile_path = os.path.join(log_dir, PROFILE_FILENAME.format(self.func_ea, self.export_format))
+        try:
+            os.makedirs(log_dir, exist_ok=True)
+            if self.export_format == "csv":
+                self.export_csv(profile_path, self.last_profile)
+            else:
+                self.export_json(profile_path, self.last_profile)
+        except OSError as e:
+            logger.warning("Can't write profile file '{0}': {1}".format(profile_path, e))
+            return None
+        return profile_path
+
+    def record(self, category: str, name: str, maturity: int, duration: float, is_hit: bool = False,
+               is_exception: bool = False):
+        if not self.is_enabled:
+            return
+        entry_key = (category, name, maturity)
+        entry = self.entries.get(entry_key)
+        if entry is None:
+            entry = ProfileEntry(category, name, maturity)
+            self.entries[entry_key] = entry
+        entry.nb_calls += 1
+        entry.total_time += duration
+        if is_hit:
+            entry.nb_hits += 1
+        if is_exception:
+            entry.nb_exceptions += 1
+
+    def add_counter(self, counter_name: str, duration: float = 0.0, nb: int = 1):
+        if not self.is_enabled:
+            return
+        counter = self.counters.get(counter_name)
+        if counter is None:
+            counter = {"nb": 0, "total_time": 0.0}
+            self.counters[counter_name] = counter
+        counter["nb"] += nb
+        counter["total_time"] += duration
+
+    def get_entries(self) -> List[ProfileEntry]:
+        # Most expensive first
+        return sorted(self.entries.values(), key=lambda x: x.total_time, reverse=True)
+
+    def get_profile(self) -> Dict:
+        return {
+            "func_ea": "0x{0:x}".format(self.func_ea) if self.func_ea is not None else None,
+            "counters": {name: dict(counter) for name, counter in self.counters.items()},
+            "entries": [entry.to_dict() for entry in self.get_entries()],
+        }
+
+    @staticmethod
+    def export_json(profile_path: str, profile: Dict):
+        with open(profile_path, "w") as fp:
+            json.dump(profile, fp, indent=2)
+
+    @staticmethod
+    def export_csv(profile_path: str, profile: Dict):
+        with open(profile_path, "w", newline="") as fp:
+            writer = csv.DictWriter(fp, fieldnames=PROFILE_CSV_FIELDS)
+            writer.writeheader()
+            for entry in profile["entries"]:
+                writer.writerow(entry)
+            # Global counters are exported as rows of the "counter" category
+            for name, counter in profile["counters"].items():
+                writer.writerow({"category": "counter", "name": name, "nb_calls": counter["nb"],
+                                 "total_time": counter["total_time"]})
+
+
+d810_profiler = D810Profiler()
+
+
+def get_profiler() -> D810Profiler:
+    return d810_profiler
@@ -1,4 +1,5 @@
 from __future__ import annotations
+import heapq
 import logging
 from typing import List, Union, Tuple, Dict
 from ida_hexrays import *
@@ -6,7 +7,7 @@ from ida_hexrays import *
 from d810.emulator import MicroCodeEnvironment, MicroCodeInterpreter
 from d810.cfg_utils import change_1way_block_successor, change_2way_block_conditional_successor, duplicate_block
 from d810.hexrays_hooks import InstructionDefUseCollector
-from d810.hexrays_helpers import equal_mops_ignore_size, get_mop_index, get_blk_index
+from d810.hexrays_helpers import get_mop_index, get_mop_key, get_blk_index
 from d810.hexrays_formatters import format_minsn_t, format_mop_t
 
 # This module can be use to find the instruction that define the value of a mop. Basically, you:
@@ -107,12 +108,15 @@ class MopHistory(object):
     def _execute_microcode(self) -> bool:
         if not self._is_dirty:
             return True
-        formatted_mop_searched_list = "['" + "', '".join([format_mop_t(x) for x in self.searched_mop_list]) + "']"
-        logger.debug("Computing: {0} for path {1}".format(formatted_mop_searched_list, self.block_serial_path))
+        is_debug_enabled = logger.isEnabledFor(logging.DEBUG)
+        if is_debug_enabled:
+            formatted_mop_searched_list = "['" + "', '".join([format_mop_t(x) for x in self.searched_mop_list]) + "']"
+            logger.debug("Computing: {0} for path {1}".format(formatted_mop_searched_list, self.block_serial_path))
         self._mc_current_environment = self._mc_initial_environment.get_copy()
         for blk_info in self.history:
             for blk_ins in blk_info.ins_list:
-                logger.debug("Executing: {0}.{1}".format(blk_info.blk.serial, format_minsn_t(blk_ins)))
+                if is_debug_enabled:
+                    logger.debug("Executing: {0}.{1}".format(blk_info.blk.serial, format_minsn_t(blk_ins)))
                 if not self._mc_interpreter.eval_instruction(blk_info.blk, blk_ins, self._mc_current_environment):
                     self._is_dirty = False
                     return False
@@ -166,9 +170,88 @@ def get_standard_and_memory_mop_lists(mop_in: mop_t) -> Tuple[List[mop_t], List[
         return [], []
 
 
-# A MopTracker will create new MopTracker to recursively track variable when multiple paths are possible,
-# The cur_mop_tracker_nb_path global variable is used to limit the number of MopTracker created
-cur_mop_tracker_nb_path = 0
+def get_block_fingerprint(blk: mblock_t) -> tuple:
+    if blk.head is None:
+        return blk.start, blk.end, None
+    return blk.start, blk.end, blk.head.ea, blk.head.opcode, blk.tail.ea, blk.tail.opcode
+
+
+class BlockDefSummary(object):
+    # Instructions of a block (from head to tail) with their def list and def/use mops, computed lazily.
+    # segment_memo: (start instruction index, search state key) -> indexes of the instructions which define the
+    # searched mops, so that trackers searching the same mops in the same block share the work.
+    def __init__(self, blk: mblock_t):
+        self.fingerprint = get_block_fingerprint(blk)
+        self.ins_list = []
+        cur_ins = blk.head
+        while cur_ins is not None:
+            self.ins_list.append(cur_ins)
+            cur_ins = cur_ins.next
+        self.def_lists = [None] * len(self.ins_list)
+        self.ins_mop_infos = [None] * len(self.ins_list)
+        self.segment_memo = {}
+
+    @staticmethod
+    def get_ins_index(ins: minsn_t) -> int:
+        ins_index = -1
+        while ins is not None:
+            ins_index += 1
+            ins = ins.prev
+        return ins_index
+
+    def get_def_list(self, blk: mblock_t, ins_index: int) -> mlist_t:
+        def_list = self.def_lists[ins_index]
+        if def_list is None:
+            def_list = blk.build_def_list(self.ins_list[ins_index], MAY_ACCESS | FULL_XDSU)
+            self.def_lists[ins_index] = def_list
+        return def_list
+
+    def get_ins_mop_info(self, ins_index: int) -> InstructionDefUseCollector:
+        ins_mop_info = self.ins_mop_infos[ins_index]
+        if ins_mop_info is None:
+            ins_mop_info = InstructionDefUseCollector()
+            self.ins_list[ins_index].for_all_ops(ins_mop_info)
+            self.ins_mop_infos[ins_index] = ins_mop_info
+        return ins_mop_info
+
+
+class MopTrackerCache(object):
+    # Block summaries shared by all MopTracker working on the same mba at the same maturity.
+    # A summary is rebuilt if its block looks different (see get_block_fingerprint), code modifying the CFG while
+    # trackers are used should also call invalidate_blocks (or reset).
+    def __init__(self):
+        self.mba_key = None
+        self.summary_by_serial: Dict[int, BlockDefSummary] = {}
+
+    def reset(self):
+        self.mba_key = None
+        self.summary_by_serial = {}
+
+    def get_block_summary(self, blk: mblock_t) -> BlockDefSummary:
+        mba_key = (blk.mba.entry_ea, blk.mba.maturity)
+        if mba_key != self.mba_key:
+            self.mba_key = mba_key
+            self.summary_by_serial = {}
+        summary = self.summary_by_serial.get(blk.serial)
+        if (summary is None) or (summary.fingerprint != get_block_fingerprint(blk)):
+            summary = BlockDefSummary(blk)
+            self.summary_by_serial[blk.serial] = summary
+        return summary
+
+    def invalidate_blocks(self, blk_serials: List[int]):
+        for blk_serial in blk_serials:
+            self.summary_by_serial.pop(blk_serial, None)
+
+    def invalidate_from_serial(self, first_blk_serial: int):
+        # Blocks inserted at first_blk_serial shift the serial of all following blocks
+        self.invalidate_blocks([x for x in self.summary_by_serial.keys() if x >= first_blk_serial])
+
+
+mop_tracker_cache = MopTrackerCache()
+
+
+def get_mop_tracker_cache() -> MopTrackerCache:
+    return mop_tracker_cache
 
 
 class MopTracker(object):
@@ -186,69 +269,95 @@ class MopTracker(object):
         self.avoid_list = []
         self.call_detected = False
         self.constant_mops = []
+        self.visited_blk_serials = set()
+        # Number of paths created by the current search (a MopTracker is copied for each predecessor explored)
+        self.nb_path = 0
 
-    @staticmethod
-    def reset():
-        global cur_mop_tracker_nb_path
-        cur_mop_tracker_nb_path = 0
+    def reset(self):
+        self.nb_path = 0
 
     def add_mop_definition(self, mop: mop_t, cst_value: int):
         self.constant_mops.append([mop, cst_value])
         self.history.add_mop_initial_value(mop, cst_value)
 
     def get_copy(self) -> MopTracker:
-        global cur_mop_tracker_nb_path
         new_mop_tracker = MopTracker(self._unresolved_mops, self.max_nb_block, self.max_path)
+        new_mop_tracker.mba = self.mba
+        new_mop_tracker.avoid_list = self.avoid_list
         new_mop_tracker._memory_unresolved_mops = [x for x in self._memory_unresolved_mops]
         new_mop_tracker.constant_mops = [[x[0], x[1]] for x in self.constant_mops]
         new_mop_tracker.history = self.history.get_copy()
-        cur_mop_tracker_nb_path += 1
+        new_mop_tracker.visited_blk_serials = set(self.visited_blk_serials)
         return new_mop_tracker
 
     def search_backward(self, blk: mblock_t, ins: minsn_t, avoid_list=None, must_use_pred=None,
                         stop_at_first_duplication=False) -> List[MopHistory]:
-        logger.debug("Searching backward (reg): {0}".format([format_mop_t(x) for x in self._unresolved_mops]))
-        logger.debug("Searching backward (mem): {0}".format([format_mop_t(x) for x in self._memory_unresolved_mops]))
-        logger.debug("Searching backward (cst): {0}"
-                     .format(["{0}: {1:x}".format(format_mop_t(x[0]), x[1]) for x in self.constant_mops]))
+        is_debug_enabled = logger.isEnabledFor(logging.DEBUG)
+        if is_debug_enabled:
+            logger.debug("Searching backward (reg): {0}".format([format_mop_t(x) for x in self._unresolved_mops]))
+            logger.debug("Searching backward (mem): {0}"
+                         .format([format_mop_t(x) for x in self._memory_unresolved_mops]))
+            logger.debug("Searching backward (cst): {0}"
+                         .format(["{0}: {1:x}".format(format_mop_t(x[0]), x[1]) for x in self.constant_mops]))
         self.mba = blk.mba
         self.avoid_list = avoid_list if avoid_list else []
+        self.nb_path = 0
+        # When several predecessors are possible, one MopTracker copy per predecessor is added to the work queue.
+        # Pending paths are explored by increasing length, so that a deep branch can't use the whole max_path budget
+        # before shorter paths are resolved. Each path is identified by the indexes of the predecessors taken: this
+        # gives the (depth-first) order of the returned histories.
+        work_queue = [(0, (), self, blk, ins)]
+        finished_paths = []
+        while len(work_queue) > 0:
+            _, pred_indexes, mop_tracker, cur_blk, cur_ins = heapq.heappop(work_queue)
+            blk_with_multiple_pred = mop_tracker.search_path(cur_blk, cur_ins, self.nb_path, stop_at_first_duplication)
+            if blk_with_multiple_pred is None:
+                mop_tracker.history.unresolved_mop_list = [x for x in mop_tracker._unresolved_mops]
+                finished_paths.append((pred_indexes, mop_tracker.history))
+                continue
+            if is_debug_enabled:
+                logger.debug("MopTracker creating child because multiple pred: {0}"
+                             .format(mop_tracker.history.block_serial_path))
+            if must_use_pred is not None and must_use_pred.serial in blk_with_multiple_pred.predset:
+                pred_blk_list = [must_use_pred]
+            else:
+                pred_blk_list = [self.mba.get_mblock(x) for x in blk_with_multiple_pred.predset]
+            for pred_index, pred_blk in enumerate(pred_blk_list):
+                new_tracker = mop_tracker.get_copy()
+                self.nb_path += 1
+                heapq.heappush(work_queue, (len(new_tracker.history.history), pred_indexes + (pred_index,),
+                                            new_tracker, pred_blk, None))
+        finished_paths.sort(key=lambda x: x[0])
+        return [mop_history for _, mop_history in finished_paths]
+
+    def search_path(self, blk: mblock_t, ins: Union[None, minsn_t], nb_path: int,
+                    stop_at_first_duplication=False) -> Union[None, mblock_t]:
+        # Returns the block whose predecessors must be explored, or None if the search of this path is over
         blk_with_multiple_pred = self.search_until_multiple_predecessor(blk, ins)
+        is_debug_enabled = logger.isEnabledFor(logging.DEBUG)
         if self.is_resolved():
-            logger.debug("MopTracker is resolved:  {0}".format(self.history.block_serial_path))
-            self.history.unresolved_mop_list = [x for x in self._unresolved_mops]
-            return [self.history]
+            if is_debug_enabled:
+                logger.debug("MopTracker is resolved:  {0}".format(self.history.block_serial_path))
+            return None
         elif blk_with_multiple_pred is None:
-            logger.debug("MopTracker unresolved: (blk_with_multiple_pred): {0}".format(self.history.block_serial_path))
-            self.history.unresolved_mop_list = [x for x in self._unresolved_mops]
-            return [self.history]
-        elif self.max_nb_block != -1 and len(self.history.block_serial_path) > self.max_nb_block:
-            logger.debug("MopTracker unresolved: (max_nb_block): {0}".format(self.history.block_serial_path))
-            self.history.unresolved_mop_list = [x for x in self._unresolved_mops]
-            return [self.history]
-        elif self.max_path != -1 and cur_mop_tracker_nb_path > self.max_path:
-            logger.debug("MopTracker unresolved: (max_path: {0}".format(cur_mop_tracker_nb_path))
-            self.history.unresolved_mop_list = [x for x in self._unresolved_mops]
-            return [self.history]
+            if is_debug_enabled:
+                logger.debug("MopTracker unresolved: (blk_with_multiple_pred): {0}"
+                             .format(self.history.block_serial_path))
+            return None
+        elif self.max_nb_block != -1 and len(self.history.history) > self.max_nb_block:
+            if is_debug_enabled:
+                logger.debug("MopTracker unresolved: (max_nb_block): {0}".format(self.history.block_serial_path))
+            return None
+        elif self.max_path != -1 and nb_path > self.max_path:
+            logger.debug("MopTracker unresolved: (max_path: {0}".format(nb_path))
+            return None
         elif self.call_detected:
-            logger.debug("MopTracker unresolved: (call): {0}".format(self.history.block_serial_path))
-            self.history.unresolved_mop_list = [x for x in self._unresolved_mops]
-            return [self.history]
-
-        if stop_at_first_duplication:
-            self.history.unresolved_mop_list = [x for x in self._unresolved_mops]
-            return [self.history]
-        logger.debug("MopTracker creating child because multiple pred: {0}".format(self.history.block_serial_path))
-        possible_histories = []
-        if must_use_pred is not None and must_use_pred.serial in blk_with_multiple_pred.predset:
-            new_tracker = self.get_copy()
-            possible_histories += new_tracker.search_backward(must_use_pred, None, self.avoid_list, must_use_pred)
-        else:
-            for blk_pred_serial in blk_with_multiple_pred.predset:
-                new_tracker = self.get_copy()
-                possible_histories += new_tracker.search_backward(self.mba.get_mblock(blk_pred_serial), None,
-                                                                  self.avoid_list, must_use_pred)
-        return possible_histories
+            if is_debug_enabled:
+                logger.debug("MopTracker unresolved: (call): {0}".format(self.history.block_serial_path))
+            return None
+        elif stop_at_first_duplication:
+            return None
+        return blk_with_multiple_pred
 
     def search_until_multiple_predecessor(self, blk: mblock_t, ins: Union[None, minsn_t] = None) -> Union[None, mblock_t]:
         # By default, we start searching from block tail
@@ -257,16 +366,16 @@ class MopTracker(object):
 
         while not self.is_resolved():
             # Explore one block
-            if cur_blk.serial in self.history.block_serial_path:
+            if cur_blk.serial in self.visited_blk_serials:
+                # Cycle
                 self.history.insert_block_in_path(cur_blk, 0)
                 return None
             if cur_blk.serial in self.avoid_list:
                 self.history.insert_block_in_path(cur_blk, 0)
                 return None
             self.history.insert_block_in_path(cur_blk, 0)
-            cur_ins = self.blk_find_def_backward(cur_blk, cur_ins)
-            while cur_ins:
-                cur_ins = self.blk_find_def_backward(cur_blk, cur_ins)
+            self.visited_blk_serials.add(cur_blk.serial)
+            self.search_block_backward(cur_blk, cur_ins)
             if cur_blk.npred() > 1:
                 return cur_blk
             elif cur_blk.npred() == 0:
@@ -299,64 +408,91 @@ class MopTracker(object):
             blk.append_use_list(ml, unresolved_mop, MUST_ACCESS)
         return ml
 
-    def blk_find_def_backward(self, blk: mblock_t, ins_start: minsn_t) -> Union[None, minsn_t]:
-        if self.is_resolved():
-            return None
-        ml = self._build_ml_list(blk)
-        if not ml:
-            logger.warning("blk_find_def_backward: _build_ml_list failed")
-            return None
-        ins_def = self._blk_find_ins_def_backward(blk, ins_start, ml)
-        if ins_def:
-            is_ok = self.update_history(blk, ins_def)
-            if not is_ok:
-                return None
-            ins_def = ins_def.prev
-        return ins_def
-
-    def update_history(self, blk: mblock_t, ins_def: minsn_t) -> bool:
-        logger.debug("Updating history with {0}.{1}".format(blk.serial, format_minsn_t(ins_def)))
+    def get_search_state_key(self) -> tuple:
+        # Sizes are part of the key: the searched locations (see _build_ml_list) depend on them
+        return (frozenset([get_mop_key(x, with_size=True) for x in self._unresolved_mops]),
+                frozenset([get_mop_key(x, with_size=True) for x in self._memory_unresolved_mops]),
+                frozenset([get_mop_key(x[0], with_size=True) for x in self.constant_mops]))
+
+    def search_block_backward(self, blk: mblock_t, ins_start: Union[None, minsn_t]):
+        # Add to the history all instructions of blk (from ins_start to head) which define the searched mops
+        if ins_start is None:
+            return
+        summary = mop_tracker_cache.get_block_summary(blk)
+        start_index = summary.get_ins_index(ins_start)
+        memo_key = (start_index, self.get_search_state_key())
+        def_indexes = summary.segment_memo.get(memo_key)
+        if def_indexes is not None:
+            for def_index in def_indexes:
+                if not self.update_history(blk, summary.ins_list[def_index], summary.get_ins_mop_info(def_index)):
+                    break
+            return
+
+        def_indexes = []
+        cur_index = start_index
+        while (cur_index >= 0) and (not self.is_resolved()):
+            ml = self._build_ml_list(blk)
+            if not ml:
+                logger.warning("search_block_backward: _build_ml_list failed")
+                break
+            def_index = self._blk_find_ins_def_index_backward(blk, summary, cur_index, ml)
+            if def_index is None:
+                break
+            def_indexes.append(def_index)
+            if not self.update_history(blk, summary.ins_list[def_index], summary.get_ins_mop_info(def_index)):
+                break
+            cur_index = def_index - 1
+        summary.segment_memo[memo_key] = def_indexes
+
+    def update_history(self, blk: mblock_t, ins_def: minsn_t,
+                       ins_mop_info: Union[None, InstructionDefUseCollector] = None) -> bool:
+        is_debug_enabled = logger.isEnabledFor(logging.DEBUG)
+        if is_debug_enabled:
+            logger.debug("Updating history with {0}.{1}".format(blk.serial, format_minsn_t(ins_def)))
         self.history.insert_ins_in_block(blk, ins_def, before=True)
         if ins_def.opcode == m_call:
             self.call_detected = True
             return False
-        ins_mop_info = InstructionDefUseCollector()
-        ins_def.for_all_ops(ins_mop_info)
+        if ins_mop_info is None:
+            ins_mop_info = InstructionDefUseCollector()
+            ins_def.for_all_ops(ins_mop_info)
 
         for target_mop in ins_mop_info.target_mops:
             resolved_mop_index = get_mop_index(target_mop, self._unresolved_mops)
             if resolved_mop_index != -1:
-                logger.debug("Removing {0} from unresolved mop".format(format_mop_t(target_mop)))
+                if is_debug_enabled:
+                    logger.debug("Removing {0} from unresolved mop".format(format_mop_t(target_mop)))
                 self._unresolved_mops.pop(resolved_mop_index)
         cleaned_unresolved_ins_mops = remove_segment_registers(ins_mop_info.unresolved_ins_mops)
         for ins_def_mop in cleaned_unresolved_ins_mops:
             ins_def_mop_index = get_mop_index(ins_def_mop, self._unresolved_mops)
             if ins_def_mop_index == -1:
-                logger.debug("Adding {0} in unresolved mop".format(format_mop_t(ins_def_mop)))
+                if is_debug_enabled:
+                    logger.debug("Adding {0} in unresolved mop".format(format_mop_t(ins_def_mop)))
                 self._unresolved_mops.append(ins_def_mop)
 
         for target_mop in ins_mop_info.target_mops:
             resolved_mop_index = get_mop_index(target_mop, self._memory_unresolved_mops)
             if resolved_mop_index != -1:
-                logger.debug("Removing {0} from memory unresolved mop".format(format_mop_t(target_mop)))
+                if is_debug_enabled:
+                    logger.debug("Removing {0} from memory unresolved mop".format(format_mop_t(target_mop)))
                 self._memory_unresolved_mops.pop(resolved_mop_index)
         for ins_def_mem_mop in ins_mop_info.memory_unresolved_ins_mops:
             ins_def_mop_index = get_mop_index(ins_def_mem_mop, self._memory_unresolved_mops)
             if ins_def_mop_index == -1:
-                logger.debug("Adding {0} in memory unresolved mop".format(format_mop_t(ins_def_mem_mop)))
+                if is_debug_enabled:
+                    logger.debug("Adding {0} in memory unresolved mop".format(format_mop_t(ins_def_mem_mop)))
                 self._memory_unresolved_mops.append(ins_def_mem_mop)
         return True
 
-    def _blk_find_ins_def_backward(self, blk: mblock_t, ins_start: minsn_t, ml: mlist_t) -> Union[None, minsn_t]:
-        cur_ins = ins_start
-        while cur_ins is not None:
-            def_list = blk.build_def_list(cur_ins, MAY_ACCESS | FULL_XDSU)
-            if ml.has_common(def_list):
-                return cur_ins
-            for mem_mop in self._memory_unresolved_mops:
-                if equal_mops_ignore_size(cur_ins.d, mem_mop):
-                    return cur_ins
-            cur_ins = cur_ins.prev
+    def _blk_find_ins_def_index_backward(self, blk: mblock_t, summary: BlockDefSummary, start_index: int,
+                                         ml: mlist_t) -> Union[None, int]:
+        memory_mop_keys = set([get_mop_key(x) for x in self._memory_unresolved_mops])
+        for ins_index in range(start_index, -1, -1):
+            if ml.has_common(summary.get_def_list(blk, ins_index)):
+                return ins_index
+            if (len(memory_mop_keys) > 0) and (get_mop_key(summary.ins_list[ins_index].d) in memory_mop_keys):
+                return ins_index
         return None
 
 
@@ -379,7 +515,47 @@ def get_block_with_multiple_predecessors(var_histories: List[MopHistory]) -> Tup
     return None, None
 
 
-def try_to_duplicate_one_block(var_histories: List[MopHistory]) -> Tuple[int, int]:
+def duplicate_block_for_predecessor(block_to_duplicate: mblock_t, pred_block: mblock_t,
+                                    pred_history_group: List[MopHistory],
+                                    verify: bool = True) -> Tuple[int, int, mblock_t, Union[None, mblock_t]]:
+    # Duplicate block_to_duplicate, make pred_block go to the copy and update the histories going through pred_block
+    mba = block_to_duplicate.mba
+    nb_duplication = 0
+    nb_change = 0
+    # Duplicated blocks are inserted before the last block
+    mop_tracker_cache.invalidate_from_serial(mba.qty - 1)
+    mop_tracker_cache.invalidate_blocks([pred_block.serial, pred_block.serial + 1])
+    duplicated_blk_jmp, duplicated_blk_default = duplicate_block(block_to_duplicate, verify=verify)
+    nb_duplication += 1 if duplicated_blk_jmp is not None else 0
+    nb_duplication += 1 if duplicated_blk_default is not None else 0
+    logger.debug("  Making {0} goto {1}".format(pred_block.serial, duplicated_blk_jmp.serial))
+    if (pred_block.tail is None) or (not is_mcode_jcond(pred_block.tail.opcode)):
+        change_1way_block_successor(pred_block, duplicated_blk_jmp.serial, verify=verify)
+        nb_change += 1
+    else:
+        if block_to_duplicate.serial == pred_block.tail.d.b:
+            change_2way_block_conditional_successor(pred_block, duplicated_blk_jmp.serial, verify=verify)
+            nb_change += 1
+        else:
+            logger.warning(" not sure this is suppose to happen")
+            change_1way_block_successor(pred_block.mba.get_mblock(pred_block.serial + 1),
+                                        duplicated_blk_jmp.serial, verify=verify)
+            nb_change += 1
+
+    block_to_duplicate_default_successor = mba.get_mblock(block_to_duplicate.serial + 1)
+    logger.debug("  Now, we fix var histories...")
+    for var_history in pred_history_group:
+        var_history.replace_block_in_path(block_to_duplicate, duplicated_blk_jmp)
+        if block_to_duplicate.tail is not None and is_mcode_jcond(block_to_duplicate.tail.opcode):
+            index_jump_block = get_blk_index(duplicated_blk_jmp, var_history.block_path)
+            if index_jump_block + 1 < len(var_history.block_path):
+                original_jump_block_successor = var_history.block_path[index_jump_block + 1]
+                if original_jump_block_successor.serial == block_to_duplicate_default_successor.serial:
+                    var_history.insert_block_in_path(duplicated_blk_default, index_jump_block + 1)
+    return nb_duplication, nb_change, duplicated_blk_jmp, duplicated_blk_default
+
+
+def try_to_duplicate_one_block(var_histories: List[MopHistory], verify: bool = True) -> Tuple[int, int]:
     nb_duplication = 0
     nb_change = 0
     if (len(var_histories) == 0) or (len(var_histories[0].block_path) == 0):
@@ -397,33 +573,10 @@ def try_to_duplicate_one_block(var_histories: List[MopHistory]) -> Tuple[int, in
             logger.debug("  Before {0}: {1}"
                          .format(pred_serial, [var_history.block_serial_path for var_history in pred_history_group]))
             pred_block = mba.get_mblock(pred_serial)
-            duplicated_blk_jmp, duplicated_blk_default = duplicate_block(block_to_duplicate)
-            nb_duplication += 1 if duplicated_blk_jmp is not None else 0
-            nb_duplication += 1 if duplicated_blk_default is not None else 0
-            logger.debug("  Making {0} goto {1}".format(pred_block.serial, duplicated_blk_jmp.serial))
-            if (pred_block.tail is None) or (not is_mcode_jcond(pred_block.tail.opcode)):
-                change_1way_block_successor(pred_block, duplicated_blk_jmp.serial)
-                nb_change += 1
-            else:
-                if block_to_duplicate.serial == pred_block.tail.d.b:
-                    change_2way_block_conditional_successor(pred_block, duplicated_blk_jmp.serial)
-                    nb_change += 1
-                else:
-                    logger.warning(" not sure this is suppose to happen")
-                    change_1way_block_successor(pred_block.mba.get_mblock(pred_block.serial + 1),
-                                                duplicated_blk_jmp.serial)
-                    nb_change += 1
-
-            block_to_duplicate_default_successor = mba.get_mblock(block_to_duplicate.serial + 1)
-            logger.debug("  Now, we fix var histories...")
-            for var_history in pred_history_group:
-                var_history.replace_block_in_path(block_to_duplicate, duplicated_blk_jmp)
-                if block_to_duplicate.tail is not None and is_mcode_jcond(block_to_duplicate.tail.opcode):
-                    index_jump_block = get_blk_index(duplicated_blk_jmp, var_history.block_path)
-                    if index_jump_block + 1 < len(var_history.block_path):
-                        original_jump_block_successor = var_history.block_path[index_jump_block + 1]
-                        if original_jump_block_successor.serial == block_to_duplicate_default_successor.serial:
-                            var_history.insert_block_in_path(duplicated_blk_default, index_jump_block + 1)
+            blk_nb_duplication, blk_nb_change, _, _ = duplicate_block_for_predecessor(block_to_duplicate, pred_block,
+                                                                                      pred_history_group, verify)
+            nb_duplication += blk_nb_duplication
+            nb_change += blk_nb_change
         i += 1
         logger.debug("  After {0}: {1}"
                      .format(pred_serial, [var_history.block_serial_path for var_history in pred_history_group]))
@@ -432,6 +585,158 @@ def try_to_duplicate_one_block(var_histories: List[MopHistory]) -> Tuple[int, in
     return nb_duplication, nb_change
 
 
+class BlockDuplicationPlanner(object):
+    # Computes, without modifying the mba, all the duplications that successive try_to_duplicate_one_block calls
+    # would do, then applies them in one batch with a single verification of the mba at the end.
+    # Histories are simulated as lists of block serials: new blocks are always inserted before the last block of the
+    # mba, so their serials can be predicted. Each prediction is checked before modifying the mba: if one is wrong,
+    # apply stops and reports it.
+    # Before MMAT_CALLS, changing the successor of a block ending with a call inserts a block just after it, which
+    # shifts the serials of the next blocks: such cases can't be planned (see is_plannable).
+    def __init__(self, var_histories: List[MopHistory]):
+        self.var_histories = var_histories
+        self.mba = var_histories[0].block_path[0].mba
+        self.qty = self.mba.qty
+        self.paths = [var_history.block_serial_path for var_history in var_histories]
+        self.jcond_serials = set()
+        self.has_call_block = False
+        for path in self.paths:
+            for blk_serial in path:
+                blk = self.mba.get_mblock(blk_serial)
+                if (blk.tail is not None) and is_mcode_jcond(blk.tail.opcode):
+                    self.jcond_serials.add(blk_serial)
+                if (blk.tail is not None) and (blk.tail.opcode == m_call):
+                    self.has_call_block = True
+        # List of (block serial, predecessor serial, history indexes, predicted copy serial,
+        #          predicted default block serial)
+        self.planned_duplications = []
+
+    @staticmethod
+    def _get_first_predecessors(path: List[int]) -> Dict[int, int]:
+        # Block serial -> predecessor serial for the first occurrence of each block (-1 if it starts the path)
+        first_predecessors = {}
+        for blk_index, blk_serial in enumerate(path):
+            if blk_serial not in first_predecessors.keys():
+                first_predecessors[blk_serial] = path[blk_index - 1] if blk_index > 0 else -1
+        return first_predecessors
+
+    def get_block_with_multiple_predecessors(self) -> Tuple[Union[None, int], Union[None, Dict[int, List[int]]]]:
+        # Same as get_block_with_multiple_predecessors, on block serials
+        first_predecessors_list = [self._get_first_predecessors(path) for path in self.paths]
+        for i, path in enumerate(self.paths):
+            for blk_index in range(1, len(path)):
+                blk_serial = path[blk_index]
+                pred_dict = {path[blk_index - 1]: [i]}
+                for j in range(i + 1, len(self.paths)):
+                    other_pred_serial = first_predecessors_list[j].get(blk_serial, -1)
+                    if other_pred_serial != -1:
+                        pred_dict.setdefault(other_pred_serial, []).append(j)
+                if len(pred_dict) > 1:
+                    return blk_serial, pred_dict
+        return None, None
+
+    def plan_one_block(self) -> bool:
+        blk_serial, pred_dict = self.get_block_with_multiple_predecessors()
+        if blk_serial is None:
+            return False
+        default_successor_serial = blk_serial + 1
+        for group_index, (pred_serial, history_indexes) in enumerate(pred_dict.items()):
+            # We do not duplicate first group
+            if group_index == 0:
+                continue
+            duplicated_serial = self.qty - 1
+            self.qty += 1
+            duplicated_default_serial = None
+            if blk_serial in self.jcond_serials:
+                duplicated_default_serial = duplicated_serial + 1
+                self.qty += 1
+                self.jcond_serials.add(duplicated_serial)
+            self.planned_duplications.append((blk_serial, pred_serial, history_indexes, duplicated_serial,
+                                               duplicated_default_serial))
+            for history_index in history_indexes:
+                path = self.paths[history_index]
+                blk_index = path.index(blk_serial) if blk_serial in path else -1
+                if blk_index > 0:
+                    path[blk_index] = duplicated_serial
+                if blk_serial in self.jcond_serials:
+                    index_jump_block = path.index(duplicated_serial) if duplicated_serial in path else -1
+                    if index_jump_block + 1 < len(path):
+                        if path[index_jump_block + 1] == default_successor_serial:
+                            path.insert(index_jump_block + 1, duplicated_default_serial)
+        return True
+
+    def is_plannable(self) -> bool:
+        return (self.mba.maturity >= MMAT_CALLS) and (not self.has_call_block)
+
+    def plan(self, max_nb_pass: int = 10) -> int:
+        nb_pass = 0
+        while nb_pass < max_nb_pass:
+            if not self.plan_one_block():
+                break
+            nb_pass += 1
+        return nb_pass
+
+    def get_planned_blocks(self, blk_serial: int, pred_serial: int, pred_history_group: List[MopHistory],
+                           duplicated_serial: int) -> Tuple[Union[None, mblock_t], Union[None, mblock_t]]:
+        # Blocks are taken from the (up to date) histories and must still have the serials predicted by the plan
+        if self.mba.qty - 1 != duplicated_serial:
+            return None, None
+        block_to_duplicate, pred_block = None, None
+        for var_history in pred_history_group:
+            serial_path = var_history.block_serial_path
+            blk_index = serial_path.index(blk_serial) if blk_serial in serial_path else -1
+            if (blk_index <= 0) or (serial_path[blk_index - 1] != pred_serial):
+                return None, None
+            block_to_duplicate = var_history.block_path[blk_index]
+            pred_block = var_history.block_path[blk_index - 1]
+        if (block_to_duplicate is None) or (block_to_duplicate.tail is not None and
+                                            block_to_duplicate.tail.opcode == m_call):
+            return None, None
+        if (pred_block.tail is not None) and is_mcode_jcond(pred_block.tail.opcode) and \
+                (block_to_duplicate.serial != pred_block.tail.d.b):
+            # The fall-through block of pred_block would be modified
+            fall_through_blk = self.mba.get_mblock(pred_block.serial + 1)
+            if (fall_through_blk.tail is not None) and (fall_through_blk.tail.opcode == m_call):
+                return None, None
+        elif (pred_block.tail is not None) and (pred_block.tail.opcode == m_call):
+            return None, None
+        return block_to_duplicate, pred_block
+
+    def apply(self) -> Tuple[int, int, bool]:
+        total_nb_duplication = 0
+        total_nb_change = 0
+        is_plan_respected = True
+        for blk_serial, pred_serial, history_indexes, duplicated_serial, duplicated_default_serial \
+                in self.planned_duplications:
+            pred_history_group = [self.var_histories[x] for x in history_indexes]
+            block_to_duplicate, pred_block = self.get_planned_blocks(blk_serial, pred_serial, pred_history_group,
+                                                                     duplicated_serial)
+            if block_to_duplicate is None:
+                logger.warning("Block duplication plan not respected for block {0} (predecessor {1})"
+                               .format(blk_serial, pred_serial))
+                is_plan_respected = False
+                break
+            nb_duplication, nb_change, duplicated_blk_jmp, duplicated_blk_default = \
+                duplicate_block_for_predecessor(block_to_duplicate, pred_block, pred_history_group, verify=False)
+            total_nb_duplication += nb_duplication
+            total_nb_change += nb_change
+            duplicated_blk_default_serial = duplicated_blk_default.serial if duplicated_blk_default is not None \
+                else None
+            if (duplicated_blk_jmp.serial != duplicated_serial) or \
+                    (duplicated_blk_default_serial != duplicated_default_serial):
+                logger.warning("Block duplication plan not respected for block {0}: {1} instead of {2}"
+                               .format(blk_serial, duplicated_blk_jmp.serial, duplicated_serial))
+                is_plan_respected = False
+                break
+        self.mba.mark_chains_dirty()
+        try:
+            self.mba.verify(True)
+        except RuntimeError as e:
+            logger.error("Error after block duplications: {0}".format(e))
+            raise e
+        return total_nb_duplication, total_nb_change, is_plan_respected
+
+
 def duplicate_histories(var_histories: List[MopHistory], max_nb_pass: int = 10) -> Tuple[int, int]:
     cur_pass = 0
     total_nb_duplication = 0
@@ -439,14 +744,23 @@ def duplicate_histories(var_histories: List[MopHistory], max_nb_pass: int = 10)
     logger.info("Trying to fix new var_history...")
     for i, var_history in enumerate(var_histories):
         logger.info(" start.{0}: {1}".format(i, var_history.block_serial_path))
-    while cur_pass < max_nb_pass:
-        logger.debug("Current path {0}".format(cur_pass))
-        nb_duplication, nb_change = try_to_duplicate_one_block(var_histories)
-        if nb_change == 0 and nb_duplication == 0:
-            break
-        total_nb_duplication += nb_duplication
-        total_nb_change += nb_change
-        cur_pass += 1
+    if (len(var_histories) > 0) and (len(var_histories[0].block_path) > 0):
+        planner = BlockDuplicationPlanner(var_histories)
+        is_plan_respected = False
+        if planner.is_plannable():
+            cur_pass = planner.plan(max_nb_pass)
+            total_nb_duplication, total_nb_change, is_plan_respected = planner.apply()
+        if not is_plan_respected:
+            # Histories are up to date with the duplications done (if any), we continue one block at a time
+            cur_pass = 0
+            while cur_pass < max_nb_pass:
+                logger.debug("Current path {0}".format(cur_pass))
+                nb_duplication, nb_change = try_to_duplicate_one_block(var_histories)
+                if nb_change == 0 and nb_duplication == 0:
+                    break
+                total_nb_duplication += nb_duplication
+                total_nb_change += nb_change
+                cur_pass += 1
     for i, var_history in enumerate(var_histories):
         logger.info(" end.{0}: {1}".format(i, var_history.block_serial_path))
     return total_nb_duplication, total_nb_change
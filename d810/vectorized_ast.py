@@ -0,0 +1,274 @@
+import logging
+from typing import List, Union, Dict, Tuple
+
+from ida_hexrays import *
+
+from d810.hexrays_helpers import get_mop_key, AND_TABLE, MSB_TABLE
+from d810.ast import AstLeaf, AstNode
+from d810.errors import UnsupportedAstException
+
+logger = logging.getLogger('D810.plugin')
+
+try:
+    import numpy as np
+    NUMPY_INSTALLED = True
+except ImportError:
+    logger.info("Vectorized AST evaluation disabled. Install numpy to enable it")
+    NUMPY_INSTALLED = False
+
+DEFAULT_NB_SAMPLES = 1024
+# Values tried for each variable, in addition to random ones (they are truncated to the variable size)
+EDGE_CASE_VALUES = [0, 1, 2, 0xffffffffffffffff, 0xfffffffffffffffe, 0x7f, 0x80, 0xff, 0x7fff, 0x8000, 0xffff,
+                    0x7fffffff, 0x80000000, 0xffffffff, 0x7fffffffffffffff, 0x8000000000000000]
+
+# If False, vectorized evaluation is never used (even if numpy is installed)
+use_vectorized_evaluation = True
+
+SUPPORTED_SIZES = [1, 2, 4, 8]
+UNARY_OPCODES = [m_mov, m_neg, m_lnot, m_bnot, m_xds, m_xdu, m_low, m_sets]
+BINARY_OPCODES = [m_add, m_sub, m_mul, m_udiv, m_umod, m_or, m_and, m_xor, m_shl, m_shr, m_sar, m_cfadd, m_ofadd,
+                  m_seto, m_setnz, m_setz, m_setae, m_setb, m_seta, m_setbe, m_setg, m_setge, m_setl, m_setle]
+
+
+def set_vectorized_evaluation(is_enabled: bool):
+    global use_vectorized_evaluation
+    use_vectorized_evaluation = is_enabled
+
+
+def is_vectorized_evaluation_enabled() -> bool:
+    return NUMPY_INSTALLED and use_vectorized_evaluation
+
+
+def _mask(values, size: int):
+    return values & np.uint64(AND_TABLE[size])
+
+
+def _sign_extend(values, size: int):
+    # Returns the int64 value of size-byte values
+    msb = np.uint64(MSB_TABLE[size])
+    return ((_mask(values, size) ^ msb) - msb).view(np.int64)
+
+
+def _get_msb(values, size: int):
+    return (values >> np.uint64(8 * size - 1)) & np.uint64(1)
+
+
+def _shift_count(values):
+    # Shift counts larger than 63 are undefined with numpy, the caller sets these lanes to the right value
+    return np.minimum(values, np.uint64(63))
+
+
+class VectorizedAst(object):
+    # An AST compiled into a flat list of numpy operations (one per distinct AST node, in evaluation order).
+    # Each operation computes a uint64 array from previously computed arrays and is masked to the node size, thus the
+    # AST is evaluated for many inputs at once. Variables are the non constant leafs of the AST, they are identified by
+    # their mop key, so several ASTs compiled with the same leaf_index_by_key share their variables.
+    def __init__(self, ast: Union[AstNode, AstLeaf], leaf_index_by_key: Dict = None, leaf_sizes: List[int] = None):
+        self.leaf_index_by_key = leaf_index_by_key if leaf_index_by_key is not None else {}
+        self.leaf_sizes = leaf_sizes if leaf_sizes is not None else []
+        self.operations: List[Tuple] = []
+        self.constants: Dict[int, int] = {}
+        self._slot_by_ast_id: Dict[int, int] = {}
+        self.result_slot = self._compile(ast)
+
+    @property
+    def nb_variables(self) -> int:
+        return len(self.leaf_sizes)
+
+    def _new_slot(self, ast) -> int:
+        slot = len(self._slot_by_ast_id)
+        self._slot_by_ast_id[id(ast)] = slot
+        return slot
+
+    def _compile(self, ast: Union[AstNode, AstLeaf]) -> int:
+        slot = self._slot_by_ast_id.get(id(ast))
+        if slot is not None:
+            return slot
+        if ast.is_leaf():
+            if ast.mop is None:
+                raise UnsupportedAstException("Can't compile a leaf without mop")
+            if ast.mop.size not in SUPPORTED_SIZES:
+                raise UnsupportedAstException("Can't compile a leaf of size {0}".format(ast.mop.size))
+            if ast.is_constant():
+                slot = self._new_slot(ast)
+                self.constants[slot] = ast.value & AND_TABLE[ast.mop.size]
+                return slot
+            leaf_key = ast.mop_key if ast.mop_key is not None else get_mop_key(ast.mop)
+            leaf_index = self.leaf_index_by_key.get(leaf_key)
+            if leaf_index is None:
+                leaf_index = len(self.leaf_sizes)
+                self.leaf_index_by_key[leaf_key] = leaf_index
+                self.leaf_sizes.append(ast.mop.size)
+            slot = self._new_slot(ast)
+            self.operations.append(("var", slot, leaf_index))
+            return slot
+        if ast.dest_size not in SUPPORTED_SIZES:
+            raise UnsupportedAstException("Can't compile a node of size {0}".format(ast.dest_size))
+        if ast.opcode in UNARY_OPCODES:
+            left_slot = self._compile(ast.left)
+            slot = self._new_slot(ast)
+            self.operations.append((ast.opcode, slot, left_slot, None, ast.dest_size, ast.left.dest_size, None))
+            return slot
+        if ast.opcode in BINARY_OPCODES:
+            left_slot = self._compile(ast.left)
+            right_slot = self._compile(ast.right)
+            slot = self._new_slot(ast)
+            self.operations.append((ast.opcode, slot, left_slot, right_slot, ast.dest_size, ast.left.dest_size,
+                                    ast.right.dest_size))
+            return slot
+        raise UnsupportedAstException("Can't compile opcode {0}".format(ast.opcode))
+
+    def evaluate(self, variable_values: List) -> Tuple:
+        # Returns (results, valid) where valid is False for inputs which can't be evaluated (e.g. division by zero)
+        nb_samples = len(variable_values[0]) if len(variable_values) > 0 else 1
+        values = [None] * len(self._slot_by_ast_id)
+        valid = np.ones(nb_samples, dtype=bool)
+        for slot, cst_value in self.constants.items():
+            values[slot] = np.full(nb_samples, cst_value, dtype=np.uint64)
+        for operation in self.operations:
+            if operation[0] == "var":
+                _, slot, leaf_index = operation
+                values[slot] = _mask(variable_values[leaf_index], self.leaf_sizes[leaf_index])
+                continue
+            opcode, slot, left_slot, right_slot, size, left_size, right_size = operation
+            left = values[left_slot]
+            right = values[right_slot] if right_slot is not None else None
+            res, res_valid = self._evaluate_operation(opcode, left, right, size, left_size, right_size)
+            values[slot] = _mask(res, size)
+            if res_valid is not None:
+                valid &= res_valid
+        return values[self.result_slot], valid
+
+    @staticmethod
+    def _evaluate_operation(opcode: int, left, right, size: int, left_size: int, right_size: int):
+        if opcode in [m_mov, m_xdu, m_low]:
+            return left, None
+        if opcode == m_neg:
+            return np.uint64(0) - left, None
+        if opcode == m_lnot:
+            return (left == 0).astype(np.uint64), None
+        if opcode == m_bnot:
+            return ~left, None
+        if opcode == m_xds:
+            return _sign_extend(left, left_size).view(np.uint64), None
+        if opcode == m_sets:
+            return (_sign_extend(left, left_size) < 0).astype(np.uint64), None
+        if opcode == m_add:
+            return left + right, None
+        if opcode == m_sub:
+            return left - right, None
+        if opcode == m_mul:
+            return left * right, None
+        if opcode in [m_udiv, m_umod]:
+            res_valid = right != 0
+            safe_right = np.where(res_valid, right, np.uint64(1))
+            if opcode == m_udiv:
+                return left // safe_right, res_valid
+            return left % safe_right, res_valid
+        if opcode == m_or:
+            return left | right, None
+        if opcode == m_and:
+            return left & right, None
+        if opcode == m_xor:
+            return left ^ right, None
+        if opcode == m_shl:
+            return np.where(right < 64, left << _shift_count(right), np.uint64(0)), None
+        if opcode == m_shr:
+            return np.where(right < 64, left >> _shift_count(right), np.uint64(0)), None
+        if opcode == m_sar:
+            return (_sign_extend(left, left_size) >> _shift_count(right).astype(np.int64)).view(np.uint64), None
+        if opcode in [m_cfadd, m_ofadd]:
+            res = left + right
+            if opcode == m_cfadd:
+                return _get_msb((left ^ right ^ res) ^ ((left ^ res) & ~(left ^ right)), left_size), None
+            return _get_msb((left ^ res) & ~(left ^ right), left_size), None
+        if opcode == m_seto:
+            res = left - right
+            return _get_msb((left ^ res) & (left ^ right), left_size), None
+        if opcode == m_setnz:
+            return (left != right).astype(np.uint64), None
+        if opcode == m_setz:
+            return (left == right).astype(np.uint64), None
+        if opcode == m_setae:
+            return (left >= right).astype(np.uint64), None
+        if opcode == m_setb:
+            return (left < right).astype(np.uint64), None
+        if opcode == m_seta:
+            return (left > right).astype(np.uint64), None
+        if opcode == m_setbe:
+            return (left <= right).astype(np.uint64), None
+        signed_left = _sign_extend(left, left_size)
+        signed_right = _sign_extend(right, right_size)
+        if opcode == m_setg:
+            return (signed_left > signed_right).astype(np.uint64), None
+        if opcode == m_setge:
+            return (signed_left >= signed_right).astype(np.uint64), None
+        if opcode == m_setl:
+            return (signed_left < signed_right).astype(np.uint64), None
+        return (signed_left <= signed_right).astype(np.uint64), None
+
+
+def compile_ast(ast: Union[AstNode, AstLeaf], leaf_index_by_key: Dict = None,
+                leaf_sizes: List[int] = None) -> Union[None, VectorizedAst]:
+    # Returns None if vectorized evaluation is disabled or if the AST uses an unsupported opcode
+    if (ast is None) or not is_vectorized_evaluation_enabled():
+        return None
+    try:
+        return VectorizedAst(ast, leaf_index_by_key, leaf_sizes)
+    except UnsupportedAstException as e:
+        logger.debug("Can't compile AST {0}: {1}".format(ast, e))
+        return None
+
+
+def generate_samples(leaf_sizes: List[int], nb_samples: int = DEFAULT_NB_SAMPLES, seed: int = 0) -> List:
+    # For each variable, nb_samples values: edge case values (same for all variables, then shifted between
+    # variables so that they are also combined together) followed by random values
+    rng = np.random.default_rng(seed)
+    nb_edge_cases = min(len(EDGE_CASE_VALUES), nb_samples)
+    edge_cases = np.array(EDGE_CASE_VALUES[:nb_edge_cases], dtype=np.uint64)
+    samples = []
+    for leaf_index, leaf_size in enumerate(leaf_sizes):
+        values = rng.integers(0, 2 ** 64, size=nb_samples, dtype=np.uint64, endpoint=False)
+        values[:nb_edge_cases] = edge_cases
+        if nb_samples >= 2 * nb_edge_cases:
+            values[nb_edge_cases:2 * nb_edge_cases] = np.roll(edge_cases, leaf_index)
+        samples.append(_mask(values, leaf_size))
+    return samples
+
+
+def get_constant_candidate(ast: Union[AstNode, AstLeaf], nb_samples: int = DEFAULT_NB_SAMPLES) -> Tuple[bool, Union[None, int]]:
+    # Returns (is_evaluated, value): if is_evaluated is False, the AST can't be evaluated with numpy.
+    # Otherwise, value is None if the AST is not constant (a counterexample was found) or the only value the AST
+    # takes on all samples (which still needs to be proven)
+    vectorized_ast = compile_ast(ast)
+    if vectorized_ast is None:
+        return False, None
+    results, valid = vectorized_ast.evaluate(generate_samples(vectorized_ast.leaf_sizes, nb_samples))
+    results = results[valid]
+    if len(results) == 0:
+        return False, None
+    if not np.all(results == results[0]):
+        return True, None
+    return True, int(results[0])
+
+
+def find_counterexample(ast1: Union[AstNode, AstLeaf], ast2: Union[AstNode, AstLeaf], check_equality: bool = True,
+                        nb_samples: int = DEFAULT_NB_SAMPLES) -> bool:
+    # If check_equality is True, returns True if an input for which ast1 != ast2 is found, thus ast1 == ast2 can't be
+    # proven. If check_equality is False, returns True if an input for which ast1 == ast2 is found.
+    # Returns False if no such input is found or if the ASTs can't be evaluated with numpy.
+    leaf_index_by_key = {}
+    leaf_sizes = []
+    vectorized_ast1 = compile_ast(ast1, leaf_index_by_key, leaf_sizes)
+    if vectorized_ast1 is None:
+        return False
+    vectorized_ast2 = compile_ast(ast2, leaf_index_by_key, leaf_sizes)
+    if vectorized_ast2 is None:
+        return False
+    samples = generate_samples(leaf_sizes, nb_samples)
+    results1, valid1 = vectorized_ast1.evaluate(samples)
+    results2, valid2 = vectorized_ast2.evaluate(samples)
+    valid = valid1 & valid2
+    if check_equality:
+        return bool(np.any((results1 != results2) & valid))
+    return bool(np.any((results1 == results2) & valid))
@@ -0,0 +1,149 @@
+import time
+import logging
+from collections import deque
+from typing import Union, List
+
+from ida_hexrays import mbl_array_t
+
+from d810.hexrays_formatters import maturity_to_string
+from d810.profiler import get_profiler, PROFILE_MBA_VERIFY
+
+logger = logging.getLogger('D810.optimizer')
+
+# Verify the mba after each rewrite
+VERIFICATION_ALWAYS = "always"
+# Verify the mba once, when the maturity changes or when the decompilation ends
+VERIFICATION_END_OF_MATURITY = "end_of_maturity"
+# Verify the mba every N rewrites (and when the maturity changes)
+VERIFICATION_SAMPLED = "sampled"
+# Verify the mba only when an error occurs while optimizing
+VERIFICATION_ON_ERROR = "on_error"
+VERIFICATION_POLICIES = [VERIFICATION_ALWAYS, VERIFICATION_END_OF_MATURITY, VERIFICATION_SAMPLED,
+                         VERIFICATION_ON_ERROR]
+
+REWRITE_JOURNAL_MAX_SIZE = 1000
+
+
+class RewriteJournalEntry(object):
+    def __init__(self, maturity: int, ea: int, blk_serial: Union[None, int], optimizer_name: str,
+                 rule_name: Union[None, str]):
+        self.maturity = maturity
+        self.ea = ea
+        self.blk_serial = blk_serial
+        self.optimizer_name = optimizer_name
+        self.rule_name = rule_name
+
+    def __str__(self):
+        return "{0} at 0x{1:x} (blk {2}, maturity {3})".format(
+            self.rule_name if self.rule_name is not None else self.optimizer_name, self.ea, self.blk_serial,
+            maturity_to_string(self.maturity))
+
+
+class RewriteJournal(object):
+    # Rewrites done since the last successful mba verification, used to find which rules may have corrupted the mba
+    def __init__(self, max_size: int = REWRITE_JOURNAL_MAX_SIZE):
+        self.entries = deque(maxlen=max_size)
+        self.nb_rewrites = 0
+
+    def add(self, entry: RewriteJournalEntry):
+        self.entries.append(entry)
+        self.nb_rewrites += 1
+
+    def clear(self):
+        self.entries.clear()
+        self.nb_rewrites = 0
+
+    def get_rule_names(self) -> List[str]:
+        rule_names = []
+        for entry in self.entries:
+            rule_name = entry.rule_name if entry.rule_name is not None else entry.optimizer_name
+            if rule_name not in rule_names:
+                rule_names.append(rule_name)
+        return rule_names
+
+    def __len__(self):
+        return self.nb_rewrites
+
+
+class VerificationPolicy(object):
+    # Decides when the mba is verified after microcode rewrites. Verifying the whole mba is expensive, so it can be
+    # done only at the end of each maturity, every N rewrites or only when an error occurs. Rewrites done since the
+    # last successful verification are kept in a journal, so that a verification failure can be attributed to them.
+    def __init__(self):
+        self.policy = VERIFICATION_ALWAYS
+        self.sample_period = 1
+        self.current_maturity = None
+        self.journal = RewriteJournal()
+
+    def configure(self, policy: str = VERIFICATION_ALWAYS, sample_period: int = 1):
+        if policy not in VERIFICATION_POLICIES:
+            logger.warning("Unknown verification policy '{0}', using {1}".format(policy, VERIFICATION_ALWAYS))
+            policy = VERIFICATION_ALWAYS
+        self.policy = policy
+        self.sample_period = max(1, sample_period)
+        self.start_function()
+
+    def start_function(self):
+        self.current_maturity = None
+        self.journal.clear()
+
+    def add_rewrite(self, mba: mbl_array_t, ea: int, blk_serial: Union[None, int], optimizer_name: str,
+                    rule_name: Union[None, str] = None):
+        # Only records the rewrite: the mba may not be consistent yet (see after_rewrite)
+        self.journal.add(RewriteJournalEntry(mba.maturity, ea, blk_serial, optimizer_name, rule_name))
+
+    def after_rewrite(self, mba: mbl_array_t):
+        # Called once the mba has been modified by the last rewrite added to the journal
+        if self.policy == VERIFICATION_ALWAYS:
+            self.verify(mba)
+        elif (self.policy == VERIFICATION_SAMPLED) and (len(self.journal) >= self.sample_period):
+            self.verify(mba)
+
+    def check_maturity(self, mba: mbl_array_t):
+        # Must be called before the mba is modified, so that rewrites of the previous maturity are verified on a
+        # consistent mba
+        if mba.maturity == self.current_maturity:
+            return
+        if self.current_maturity is not None:
+            self.end_maturity(mba)
+        self.current_maturity = mba.maturity
+
+    def end_maturity(self, mba: mbl_array_t):
+        if self.policy in [VERIFICATION_END_OF_MATURITY, VERIFICATION_SAMPLED] and len(self.journal) > 0:
+            self.verify(mba)
+
+    def end_function(self, mba: mbl_array_t):
+        self.end_maturity(mba)
+        self.start_function()
+
+    def on_error(self, mba: mbl_array_t):
+        # An optimization failed: check if the rewrites not verified yet corrupted the mba
+        if len(self.journal) == 0:
+            return
+        try:
+            self.verify(mba)
+        except RuntimeError:
+            pass
+
+    def verify(self, mba: mbl_array_t):
+        start_time = time.perf_counter()
+        try:
+            mba.verify(True)
+        except RuntimeError as e:
+            logger.error("mba verification failed at maturity {0} after {1} rewrite(s) by {2}: {3}"
+                         .format(maturity_to_string(mba.maturity), len(self.journal),
+                                 self.journal.get_rule_names(), e))
+            for entry in self.journal.entries:
+                logger.error("  rewrite: {0}".format(entry))
+            self.journal.clear()
+            raise e
+        finally:
+            get_profiler().add_counter(PROFILE_MBA_VERIFY, time.perf_counter() - start_time)
+        self.journal.clear()
+
+
+verification_policy = VerificationPolicy()
+
+
+def get_verification_policy() -> VerificationPolicy:
+    return verification_policy
@@ -1,11 +1,19 @@
+import os
+import json
+import time
 import logging
-from typing import List, Union
+from collections import OrderedDict
+from typing import List, Union, Dict
+import ida_kernwin
 from ida_hexrays import *
 
-from d810.hexrays_helpers import get_mop_index
+from d810.hexrays_helpers import get_mop_index, get_mop_key
 from d810.hexrays_formatters import format_minsn_t, opcode_to_string
 from d810.ast import mop_to_ast, minsn_to_ast, AstLeaf, AstNode
 from d810.errors import D810Z3Exception
+from d810.vectorized_ast import find_counterexample
+from d810.profiler import get_profiler, PROFILE_Z3_SOLVER, PROFILE_Z3_CACHE_HITS, PROFILE_Z3_UNKNOWN, \
+    PROFILE_Z3_PREFILTERED
 
 logger = logging.getLogger('D810.plugin')
 z3_file_logger = logging.getLogger('D810.z3_test')
@@ -27,25 +35,192 @@ except ImportError:
     Z3_INSTALLED = False
 
 
+# Increase this number each time the canonical query format (or the way queries are translated to Z3) changes
+Z3_QUERY_CACHE_VERSION = 1
+Z3_QUERY_CACHE_FILENAME = "z3_query_cache.json"
+DEFAULT_Z3_QUERY_CACHE_SIZE = 8192
+
+Z3_QUERY_EQUALITY = "eq"
+Z3_QUERY_INEQUALITY = "neq"
+
+
+class Z3QueryCache(object):
+    # LRU cache of Z3 query results indexed by canonical query keys (see get_z3_query_key).
+    # If cache_path is not None, results are loaded from and saved to this file.
+    def __init__(self, max_size: int = DEFAULT_Z3_QUERY_CACHE_SIZE):
+        self.max_size = max_size
+        self.results: OrderedDict = OrderedDict()
+        self.cache_path = None
+        self.is_dirty = False
+
+    def get(self, query_key: str) -> Union[None, bool]:
+        result = self.results.get(query_key)
+        if result is not None:
+            self.results.move_to_end(query_key)
+        return result
+
+    def add(self, query_key: str, result: bool):
+        self.results[query_key] = result
+        self.results.move_to_end(query_key)
+        if len(self.results) > self.max_size:
+            self.results.popitem(last=False)
+        self.is_dirty = True
+
+    def clear(self):
+        self.results = OrderedDict()
+        self.is_dirty = False
+
+    def set_cache_path(self, cache_path: Union[None, str]):
+        self.cache_path = cache_path
+        self.clear()
+        if self.cache_path is not None:
+            self.load()
+
+    def get_version(self) -> str:
+        # Query keys contain raw opcode numbers, which may change with the IDA version
+        z3_version = z3.get_version_string() if Z3_INSTALLED else None
+        return "{0}:{1}:{2}".format(Z3_QUERY_CACHE_VERSION, z3_version, ida_kernwin.get_kernel_version())
+
+    def load(self):
+        try:
+            with open(self.cache_path, "r") as fp:
+                cache_content = json.load(fp)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning("Can't read Z3 query cache file '{0}': {1}".format(self.cache_path, e))
+            return
+        if cache_content.get("version") != self.get_version():
+            return
+        for query_key, result in cache_content["results"][-self.max_size:]:
+            self.results[query_key] = result
+        logger.debug("{0} Z3 query results loaded from cache".format(len(self.results)))
+
+    def save(self):
+        if (self.cache_path is None) or (not self.is_dirty):
+            return
+        cache_content = {
+            "version": self.get_version(),
+            "results": [[query_key, result] for query_key, result in self.results.items()]
+        }
+        tmp_cache_path = self.cache_path + ".tmp"
+        try:
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            with open(tmp_cache_path, "w") as fp:
+                json.dump(cache_content, fp)
+            os.replace(tmp_cache_path, self.cache_path)
+            self.is_dirty = False
+        except OSError as e:
+            logger.warning("Can't write Z3 query cache file '{0}': {1}".format(self.cache_path, e))
+
+
+# Value used by Z3 for "no timeout"
+Z3_NO_TIMEOUT = 4294967295
+
+
+class Z3Budget(object):
+    # Limits the time spent in the Z3 solver: each query has a timeout and all queries made during the decompilation
+    # of a function share a total budget. A limit of 0 means no limit. Queries which time out or which are made once
+    # the budget is exhausted have an unknown result.
+    def __init__(self):
+        self.query_timeout = 0
+        self.function_budget = 0
+        self.func_ea = None
+        self.time_spent = 0.0
+        self.nb_unknown_queries = 0
+
+    def configure(self, query_timeout: int = 0, function_budget: int = 0):
+        self.query_timeout = query_timeout
+        self.function_budget = function_budget
+        self.start_function(None)
+
+    def start_function(self, func_ea: Union[None, int]):
+        self.func_ea = func_ea
+        self.time_spent = 0.0
+        self.nb_unknown_queries = 0
+
+    def get_query_timeout(self) -> Union[None, int]:
+        # Returns the timeout (in ms) of the next query, None if the function budget is exhausted
+        query_timeout = self.query_timeout if self.query_timeout > 0 else Z3_NO_TIMEOUT
+        if self.function_budget <= 0:
+            return query_timeout
+        remaining_budget = int(self.function_budget - 1000 * self.time_spent)
+        if remaining_budget <= 0:
+            return None
+        return min(query_timeout, remaining_budget)
+
+    def add_query(self, duration: float, is_unknown: bool):
+        self.time_spent += duration
+        if is_unknown:
+            self.nb_unknown_queries += 1
+
+
+z3_budget = Z3Budget()
+z3_query_cache = Z3QueryCache()
+# Solver reused (with push/pop) by all queries and BitVec variables already created, by name
+z3_solver = None
+z3_var_by_name = {}
+
+
+def get_z3_query_cache() -> Z3QueryCache:
+    return z3_query_cache
+
+
+def get_z3_budget() -> Z3Budget:
+    return z3_budget
+
+
+def get_z3_solver():
+    global z3_solver
+    if z3_solver is None:
+        z3_solver = z3.Solver()
+    return z3_solver
+
+
+def get_z3_var(var_name: str):
+    z3_var = z3_var_by_name.get(var_name)
+    if z3_var is None:
+        z3_var = z3.BitVec(var_name, 32)
+        z3_var_by_name[var_name] = z3_var
+    return z3_var
+
+
+def get_canonical_ast_key(ast: Union[AstNode, AstLeaf], leaf_index_by_key: Dict) -> str:
+    # Structural representation of an AST where variables are renamed by order of first occurrence.
+    # Two queries with the same canonical keys are translated to the same Z3 expressions (see create_z3_vars).
+    if ast.is_leaf():
+        if ast.is_constant():
+            return "#{0:x}".format(ast.value)
+        leaf_key = ast.mop_key if ast.mop_key is not None else get_mop_key(ast.mop)
+        leaf_index = leaf_index_by_key.setdefault(leaf_key, len(leaf_index_by_key))
+        return "x{0}".format(leaf_index)
+    if ast.right is None:
+        return "({0} {1})".format(ast.opcode, get_canonical_ast_key(ast.left, leaf_index_by_key))
+    return "({0} {1} {2})".format(ast.opcode, get_canonical_ast_key(ast.left, leaf_index_by_key),
+                                  get_canonical_ast_key(ast.right, leaf_index_by_key))
+
+
+def get_z3_query_key(query_type: str, ast_list: List[Union[AstNode, AstLeaf]]) -> str:
+    leaf_index_by_key = {}
+    return "{0}:{1}".format(query_type, ":".join([get_canonical_ast_key(ast, leaf_index_by_key)
+                                                    for ast in ast_list]))
+
+
 def create_z3_vars(leaf_list: List[AstLeaf]):
     if not Z3_INSTALLED:
         raise D810Z3Exception("Z3 is not installed")
-    known_leaf_list = []
+    leaf_index_by_key = {}
     known_leaf_z3_var_list = []
     for leaf in leaf_list:
         if not leaf.is_constant():
-            leaf_index = get_mop_index(leaf.mop, known_leaf_list)
-            if leaf_index == -1:
-                known_leaf_list.append(leaf.mop)
-                leaf_index = len(known_leaf_list) - 1
-                if leaf.mop.size in [1, 2, 4, 8]:
-                    # Normally, we should create variable based on their size
-                    # but for now it can cause issue when instructions like XDU are used, hence this ugly fix
-                    # known_leaf_z3_var_list.append(z3.BitVec("x_{0}".format(leaf_index), 8 * leaf.mop.size))
-                    known_leaf_z3_var_list.append(z3.BitVec("x_{0}".format(leaf_index), 32))
-                    pass
-                else:
-                    known_leaf_z3_var_list.append(z3.BitVec("x_{0}".format(leaf_index), 32))
+            leaf_key = leaf.mop_key if leaf.mop_key is not None else get_mop_key(leaf.mop)
+            leaf_index = leaf_index_by_key.get(leaf_key)
+            if leaf_index is None:
+                leaf_index = len(known_leaf_z3_var_list)
+                leaf_index_by_key[leaf_key] = leaf_index
+                # Normally, we should create variable based on their size (i.e. 8 * leaf.mop.size)
+                # but for now it can cause issue when instructions like XDU are used, hence this ugly fix
+                known_leaf_z3_var_list.append(get_z3_var("x_{0}".format(leaf_index)))
             leaf.z3_var = known_leaf_z3_var_list[leaf_index]
             leaf.z3_var_name = "x_{0}".format(leaf_index)
     return known_leaf_z3_var_list
@@ -99,7 +274,10 @@ def ast_to_z3_expression(ast: Union[AstNode, AstLeaf], use_bitvecval=False):
 def mop_list_to_z3_expression_list(mop_list: List[mop_t]):
     if not Z3_INSTALLED:
         raise D810Z3Exception("Z3 is not installed")
-    ast_list = [mop_to_ast(mop) for mop in mop_list]
+    return ast_list_to_z3_expression_list([mop_to_ast(mop) for mop in mop_list])
+
+
+def ast_list_to_z3_expression_list(ast_list: List[Union[AstNode, AstLeaf]]):
     ast_leaf_list = []
     for ast in ast_list:
         ast_leaf_list += ast.get_leaf_list()
@@ -107,26 +285,69 @@ def mop_list_to_z3_expression_list(mop_list: List[mop_t]):
     return [ast_to_z3_expression(ast) for ast in ast_list]
 
 
+def check_z3_solver_is_unsat(s) -> Union[None, bool]:
+    # Returns None if the result is unknown (query timeout or Z3 budget of the function exhausted)
+    query_timeout = z3_budget.get_query_timeout()
+    if query_timeout is None:
+        z3_budget.add_query(0.0, is_unknown=True)
+        get_profiler().add_counter(PROFILE_Z3_UNKNOWN)
+        return None
+    s.set("timeout", query_timeout)
+    start_time = time.perf_counter()
+    check_result = s.check()
+    duration = time.perf_counter() - start_time
+    is_unknown = check_result == z3.unknown
+    z3_budget.add_query(duration, is_unknown)
+    get_profiler().add_counter(PROFILE_Z3_SOLVER, duration)
+    if is_unknown:
+        get_profiler().add_counter(PROFILE_Z3_UNKNOWN)
+        logger.debug("Z3 query result is unknown after {0:.3f}s: {1}".format(duration, s.reason_unknown()))
+        return None
+    return check_result == z3.unsat
+
+
+def z3_check_mop_query(query_type: str, mop1: mop_t, mop2: mop_t) -> bool:
+    # Returns True if mop1 and mop2 are proven to be always equal (Z3_QUERY_EQUALITY)
+    # or always different (Z3_QUERY_INEQUALITY)
+    ast_list = [mop_to_ast(mop1), mop_to_ast(mop2)]
+    query_key = get_z3_query_key(query_type, ast_list)
+    is_unsat = z3_query_cache.get(query_key)
+    if is_unsat is not None:
+        get_profiler().add_counter(PROFILE_Z3_CACHE_HITS)
+        return is_unsat
+    # An input for which the relation doesn't hold is usually found without calling Z3
+    if find_counterexample(ast_list[0], ast_list[1], check_equality=(query_type == Z3_QUERY_EQUALITY)):
+        get_profiler().add_counter(PROFILE_Z3_PREFILTERED)
+        z3_query_cache.add(query_key, False)
+        return False
+    z3_mop1, z3_mop2 = ast_list_to_z3_expression_list(ast_list)
+    s = get_z3_solver()
+    s.push()
+    try:
+        if query_type == Z3_QUERY_EQUALITY:
+            s.add(z3.Not(z3_mop1 == z3_mop2))
+        else:
+            s.add(z3_mop1 == z3_mop2)
+        is_unsat = check_z3_solver_is_unsat(s)
+    finally:
+        s.pop()
+    if is_unsat is None:
+        # Unknown results are not cached: the query may succeed with more time
+        return False
+    z3_query_cache.add(query_key, is_unsat)
+    return is_unsat
+
+
 def z3_check_mop_equality(mop1: mop_t, mop2: mop_t) -> bool:
     if not Z3_INSTALLED:
         raise D810Z3Exception("Z3 is not installed")
-    z3_mop1, z3_mop2 = mop_list_to_z3_expression_list([mop1, mop2])
-    s = z3.Solver()
-    s.add(z3.Not(z3_mop1 == z3_mop2))
-    if s.check().r == -1:
-        return True
-    return False
+    return z3_check_mop_query(Z3_QUERY_EQUALITY, mop1, mop2)
 
 
 def z3_check_mop_inequality(mop1: mop_t, mop2: mop_t) -> bool:
     if not Z3_INSTALLED:
         raise D810Z3Exception("Z3 is not installed")
-    z3_mop1, z3_mop2 = mop_list_to_z3_expression_list([mop1, mop2])
-    s = z3.Solver()
-    s.add(z3_mop1 == z3_mop2)
-    if s.check().r == -1:
-        return True
-    return False
+    return z3_check_mop_query(Z3_QUERY_INEQUALITY, mop1, mop2)
 
 
 def rename_leafs(leaf_list: List[AstLeaf]) -> List[str]: